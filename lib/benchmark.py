@@ -0,0 +1,583 @@
+"""
+Mask R-CNN
+Benchmarks for performance sensitive parts of the code.
+
+------------------------------------------------------------
+
+Usage: run from the root directory of the project as such:
+
+    # Find the TensorFlow thread settings with the best inference
+    # throughput when running 2 processes on this machine, each pinned
+    # to its own half of the cores
+    python3 -m lib.benchmark threads --processes=2 --pin
+
+    # Time build_rpn_targets(), with and without an AnchorGrid, against
+    # the original per-anchor loop
+    python3 -m lib.benchmark rpn_targets
+
+    # Time compute_overlaps() against the original column loop
+    python3 -m lib.benchmark overlaps
+
+    # Time non_max_suppression() against the original implementation
+    # on 100, 1k and 10k boxes
+    python3 -m lib.benchmark nms
+
+    # Time minimize_mask() and expand_mask() against resizing all
+    # instances in one batched matmul
+    python3 -m lib.benchmark mini_masks
+
+    # Compare speed and mAP of proposal settings on 100 minival images
+    python3 -m lib.benchmark proposals --model=/path/to/mask_rcnn_coco.h5 \
+        --dataset=/path/to/coco/ --limit=100
+"""
+
+import os
+import time
+import itertools
+import multiprocessing
+import numpy as np
+
+from lib.config import Config
+
+
+class BenchmarkConfig(Config):
+    """Inference configuration with the same network as the COCO model."""
+    NAME = "benchmark"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1 + 80
+
+
+############################################################
+#  Session Threading
+############################################################
+
+def run_inference_process(intra, inter, cores, weights_path, iterations,
+                          barrier, results):
+    """Builds an inference model with the given settings and times detect().
+    Runs in a child process. All processes wait at the barrier before
+    timing so they run at the same time. Puts the mean seconds per image in
+    the results queue.
+    """
+    # Import in the child so every process gets its own TF runtime
+    from lib import model as modellib
+
+    config = BenchmarkConfig()
+    config.INTRA_OP_PARALLELISM_THREADS = intra
+    config.INTER_OP_PARALLELISM_THREADS = inter
+    config.CPU_AFFINITY = cores
+    model = modellib.MaskRCNN(mode="inference", config=config,
+                              model_dir=os.path.join(os.getcwd(), "logs"))
+    if weights_path:
+        model.load_weights(weights_path, by_name=True)
+
+    image = np.random.randint(0, 255, (480, 640, 3)).astype(np.uint8)
+    model.warmup()
+    barrier.wait()
+
+    t = time.time()
+    for _ in range(iterations):
+        model.detect([image])
+    results.put((time.time() - t) / iterations)
+
+
+def benchmark_threads(intra_values, inter_values, processes=1, pin=False,
+                      weights_path=None, iterations=10):
+    """Measures inference throughput of several processes running at once
+    for each combination of intra-op and inter-op thread counts.
+
+    intra_values, inter_values: Lists of thread counts to try. 0 means the
+        TensorFlow default.
+    processes: Number of inference processes to run at the same time.
+    pin: If True, each process is pinned to its own slice of the cores.
+    weights_path: Optional weights to load. Random weights are fine for
+        timing, but real weights give realistic detection counts.
+    iterations: Number of timed detect() calls per process.
+
+    Returns a list of (intra, inter, images per second, seconds per image)
+    sorted from the highest throughput to the lowest.
+    """
+    # Every process builds its own model. This is the only place a child
+    # process uses TF, and a forked child can't use the TF runtime and
+    # session it inherits from its parent, so spawn fresh interpreters.
+    context = multiprocessing.get_context("spawn")
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity")\
+        else list(range(multiprocessing.cpu_count()))
+    slices = [cores[i::processes] for i in range(processes)] if pin\
+        else [None] * processes
+
+    results = []
+    for intra, inter in itertools.product(intra_values, inter_values):
+        barrier = context.Barrier(processes)
+        queue = context.Queue()
+        workers = [context.Process(target=run_inference_process,
+                                   args=(intra, inter, slices[i], weights_path,
+                                         iterations, barrier, queue))
+                   for i in range(processes)]
+        for w in workers:
+            w.start()
+        times = [queue.get() for _ in workers]
+        for w in workers:
+            w.join()
+
+        throughput = sum(1 / t for t in times)
+        latency = np.mean(times)
+        print("intra {:3}  inter {:3}  {:8.2f} images/s  {:8.3f} s/image".format(
+            intra, inter, throughput, latency))
+        results.append((intra, inter, throughput, latency))
+    return sorted(results, key=lambda r: -r[2])
+
+
+############################################################
+#  Training Targets
+############################################################
+
+def random_gt_boxes(image_shape, count, random_state):
+    """Generates random GT boxes [count, (y1, x1, y2, x2, class_id)]
+    between 8 and 400 pixels in size.
+    """
+    h, w = image_shape[:2]
+    y1 = random_state.randint(0, h - 8, count)
+    x1 = random_state.randint(0, w - 8, count)
+    y2 = np.minimum(y1 + random_state.randint(8, 400, count), h)
+    x2 = np.minimum(x1 + random_state.randint(8, 400, count), w)
+    class_ids = random_state.randint(1, 81, count)
+    return np.stack([y1, x1, y2, x2, class_ids], axis=1).astype(np.int32)
+
+
+def build_rpn_targets_loop(image_shape, anchors, gt_boxes, config):
+    """The original implementation of build_rpn_targets(), which loops over
+    GT boxes and positive anchors. Kept as a reference for benchmarks.
+    """
+    from lib import utils
+
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
+    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
+    anchor_area = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+
+    overlaps = np.zeros((anchors.shape[0], gt_boxes.shape[0]))
+    for i in range(overlaps.shape[1]):
+        gt = gt_boxes[i][:4]
+        overlaps[:, i] = utils.compute_iou(gt, anchors, gt_box_area[i], anchor_area)
+
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[anchor_iou_max < 0.3] = -1
+    gt_iou_argmax = np.argmax(overlaps, axis=0)
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE - np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+
+    ids = np.where(rpn_match == 1)[0]
+    ix = 0
+    for i, a in zip(ids, anchors[ids]):
+        gt = gt_boxes[anchor_iou_argmax[i], :4]
+        gt_h = gt[2] - gt[0]
+        gt_w = gt[3] - gt[1]
+        gt_center_y = gt[0] + 0.5 * gt_h
+        gt_center_x = gt[1] + 0.5 * gt_w
+        a_h = a[2] - a[0]
+        a_w = a[3] - a[1]
+        a_center_y = a[0] + 0.5 * a_h
+        a_center_x = a[1] + 0.5 * a_w
+        rpn_bbox[ix] = [
+            (gt_center_y - a_center_y) / a_h,
+            (gt_center_x - a_center_x) / a_w,
+            np.log(gt_h / a_h),
+            np.log(gt_w / a_w),
+        ]
+        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
+        ix += 1
+
+    return rpn_match, rpn_bbox
+
+
+def benchmark_rpn_targets(gt_counts=(1, 10, 50, 100), iterations=5):
+    """Times build_rpn_targets() against build_rpn_targets_loop() with
+    anchor stride 1 (261,888 anchors for 1024x1024 images), with dense
+    overlaps and with an AnchorGrid, and checks that all of them return
+    the same targets for the same random seed.
+    """
+    from lib import utils
+    from lib import model as modellib
+
+    config = BenchmarkConfig()
+    config.RPN_ANCHOR_STRIDE = 1
+    anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                   config.RPN_ANCHOR_RATIOS,
+                                   config.BACKBONE_SHAPES,
+                                   config.BACKBONE_STRIDES,
+                                   config.RPN_ANCHOR_STRIDE)
+    anchors = anchor_grid.anchors
+    print("Anchors: {}".format(anchors.shape[0]))
+
+    def build_rpn_targets_grid(image_shape, anchors, gt_boxes, config):
+        return modellib.build_rpn_targets(image_shape, anchors, gt_boxes, config,
+                                          anchor_grid=anchor_grid)
+
+    random_state = np.random.RandomState(0)
+    for count in gt_counts:
+        gt_boxes = random_gt_boxes(config.IMAGE_SHAPE, count, random_state)
+        times = []
+        identical = True
+        for fn in [build_rpn_targets_loop, modellib.build_rpn_targets,
+                   build_rpn_targets_grid]:
+            np.random.seed(1)
+            t = time.time()
+            for _ in range(iterations):
+                targets = fn(config.IMAGE_SHAPE, anchors, gt_boxes, config)
+            times.append((time.time() - t) / iterations)
+            if fn is build_rpn_targets_loop:
+                reference = targets
+            identical &= all(np.array_equal(a, b) for a, b in zip(reference, targets))
+        print("GT boxes {:4}  loop {:8.4f}s  vectorized {:8.4f}s  grid {:8.4f}s  "
+              "speedup {:5.1f}x  identical: {}".format(
+                  count, times[0], times[1], times[2], times[0] / times[2],
+                  identical))
+
+
+############################################################
+#  Box Overlaps
+############################################################
+
+def compute_overlaps_loop(boxes1, boxes2):
+    """The original implementation of compute_overlaps(), which fills the
+    matrix one column at a time. Kept as a reference for benchmarks.
+    """
+    from lib import utils
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
+    for i in range(overlaps.shape[1]):
+        overlaps[:, i] = utils.compute_iou(boxes2[i], boxes1, area2[i], area1)
+    return overlaps
+
+
+def benchmark_overlaps(gt_counts=(1, 10, 50, 100), iterations=5):
+    """Times compute_overlaps() in float64 and float32 against
+    compute_overlaps_loop() on anchors x GT boxes, with the anchors of
+    1024x1024 images at stride 1 (261,888) and stride 2 (65,472). Checks
+    that the float64 overlaps are identical and prints the largest error
+    of the float32 ones.
+    """
+    from lib import utils
+
+    config = BenchmarkConfig()
+    random_state = np.random.RandomState(0)
+    for stride in [1, 2]:
+        anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                 config.RPN_ANCHOR_RATIOS,
+                                                 config.BACKBONE_SHAPES,
+                                                 config.BACKBONE_STRIDES,
+                                                 stride)
+        print("Anchors: {}".format(anchors.shape[0]))
+        for count in gt_counts:
+            gt_boxes = random_gt_boxes(config.IMAGE_SHAPE, count, random_state)[:, :4]
+            times = []
+            for fn in [compute_overlaps_loop, utils.compute_overlaps,
+                       lambda a, b: utils.compute_overlaps(a, b, dtype=np.float32)]:
+                t = time.time()
+                for _ in range(iterations):
+                    overlaps = fn(anchors, gt_boxes)
+                times.append((time.time() - t) / iterations)
+                if fn is compute_overlaps_loop:
+                    reference = overlaps
+                elif fn is utils.compute_overlaps:
+                    identical = np.array_equal(reference, overlaps)
+            error = np.max(np.abs(reference - overlaps))
+            print("GT boxes {:4}  loop {:8.4f}s  float64 {:8.4f}s  float32 {:8.4f}s  "
+                  "speedup {:5.1f}x / {:5.1f}x  identical: {}  float32 error {:.1e}".format(
+                      count, times[0], times[1], times[2], times[0] / times[1],
+                      times[0] / times[2], identical, error))
+
+
+############################################################
+#  Non-Max Suppression
+############################################################
+
+def non_max_suppression_loop(boxes, scores, threshold):
+    """The original implementation of non_max_suppression(), which picks
+    one box at a time and deletes the boxes it overlaps from the index
+    array. Kept as a reference for benchmarks.
+    """
+    from lib import utils
+
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    ixs = scores.argsort()[::-1]
+    pick = []
+    while len(ixs) > 0:
+        i = ixs[0]
+        pick.append(i)
+        iou = utils.compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
+        remove_ixs = np.where(iou > threshold)[0] + 1
+        ixs = np.delete(ixs, remove_ixs)
+        ixs = np.delete(ixs, 0)
+    return np.array(pick, dtype=np.int32)
+
+
+def random_clustered_boxes(count, random_state, image_size=1024):
+    """Generates [count, (y1, x1, y2, x2)] float32 boxes and scores that
+    cluster around a few objects, like the detections of a model do.
+    """
+    objects = max(count // 20, 1)
+    centers = random_state.uniform(0, image_size, [objects, 2])
+    sizes = random_state.uniform(16, 256, [objects, 2])
+    ids = random_state.randint(0, objects, count)
+    center = centers[ids] + random_state.normal(0, 0.1, [count, 2]) * sizes[ids]
+    size = sizes[ids] * random_state.uniform(0.8, 1.2, [count, 2])
+    boxes = np.concatenate([center - size / 2, center + size / 2], axis=1)
+    scores = random_state.uniform(0, 1, count)
+    return boxes.astype(np.float32), scores.astype(np.float32)
+
+
+def benchmark_nms(box_counts=(100, 1000, 10000), thresholds=(0.3, 0.7),
+                  iterations=5):
+    """Times non_max_suppression() against non_max_suppression_loop(),
+    with and without a limit of 100 output boxes, and checks that they
+    pick the same boxes.
+    """
+    from lib import utils
+
+    random_state = np.random.RandomState(0)
+    for count in box_counts:
+        boxes, scores = random_clustered_boxes(count, random_state)
+        for threshold in thresholds:
+            times = []
+            for fn in [non_max_suppression_loop, utils.non_max_suppression,
+                       lambda b, s, t: utils.non_max_suppression(
+                           b, s, t, max_output_size=100)]:
+                t = time.time()
+                for _ in range(iterations):
+                    pick = fn(boxes, scores, threshold)
+                times.append((time.time() - t) / iterations)
+                if fn is non_max_suppression_loop:
+                    reference = pick
+                elif fn is utils.non_max_suppression:
+                    identical = np.array_equal(reference, pick)
+            identical &= np.array_equal(reference[:100], pick)
+            print("Boxes {:6}  threshold {:.1f}  kept {:5}  loop {:8.4f}s  "
+                  "blocked {:8.4f}s  top 100 {:8.4f}s  speedup {:5.1f}x  "
+                  "identical: {}".format(
+                      count, threshold, len(reference), times[0], times[1],
+                      times[2], times[0] / times[1], identical))
+
+
+############################################################
+#  Mini Masks
+############################################################
+
+def random_instance_masks(image_shape, count, random_state):
+    """Generates [height, width, count] elliptical masks with sizes from
+    16 to 700 pixels, spread evenly on a log scale like COCO objects.
+    """
+    h, w = image_shape[:2]
+    masks = np.zeros([h, w, count], dtype=bool)
+    y, x = np.ogrid[:h, :w]
+    for i in range(count):
+        size = np.exp(random_state.uniform(np.log(16), np.log(700), 2)).astype(int)
+        y1 = random_state.randint(0, h - size[0])
+        x1 = random_state.randint(0, w - size[1])
+        masks[:, :, i] = ((y - y1 - size[0] / 2) / (size[0] / 2)) ** 2 + \
+            ((x - x1 - size[1] / 2) / (size[1] / 2)) ** 2 <= 1
+    return masks
+
+
+def minimize_mask_batched(bbox, mask, mini_shape):
+    """minimize_mask() with all instances in one batched matmul. Every crop
+    is padded to the largest box. Kept to show that this is slower than
+    resizing each box on its own.
+    """
+    from lib import utils
+
+    boxes = bbox[:, :4].astype(np.int32)
+    h = boxes[:, 2] - boxes[:, 0]
+    w = boxes[:, 3] - boxes[:, 1]
+    crops = np.zeros([len(boxes), h.max(), w.max()], dtype=np.float32)
+    weights_y = np.zeros([len(boxes), mini_shape[0], h.max()], dtype=np.float32)
+    weights_x = np.zeros([len(boxes), mini_shape[1], w.max()], dtype=np.float32)
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        crops[i, :y2 - y1, :x2 - x1] = mask[y1:y2, x1:x2, i]
+        weights_y[i, :, :y2 - y1] = utils.bilinear_resize_weights(y2 - y1, mini_shape[0])
+        weights_x[i, :, :x2 - x1] = utils.bilinear_resize_weights(x2 - x1, mini_shape[1])
+    m = np.matmul(np.matmul(weights_y, crops), weights_x.transpose(0, 2, 1))
+    return m.transpose(1, 2, 0) >= 0.5
+
+
+def benchmark_mini_masks(instance_counts=(1, 10, 60), iterations=5):
+    """Times minimize_mask() against minimize_mask_batched(), and
+    expand_mask(), on random masks in a 1024x1024 image. Prints how many
+    mini-mask pixels differ, which are only values within float rounding
+    of the threshold.
+    """
+    from lib import utils
+
+    config = BenchmarkConfig()
+    random_state = np.random.RandomState(0)
+    for count in instance_counts:
+        masks = random_instance_masks(config.IMAGE_SHAPE, count, random_state)
+        boxes = utils.extract_bboxes(masks)
+        times = []
+        for fn in [utils.minimize_mask, minimize_mask_batched]:
+            t = time.time()
+            for _ in range(iterations):
+                mini_masks = fn(boxes, masks, config.MINI_MASK_SHAPE)
+            times.append((time.time() - t) / iterations)
+            if fn is utils.minimize_mask:
+                reference = mini_masks
+        t = time.time()
+        for _ in range(iterations):
+            utils.expand_mask(boxes, reference, config.IMAGE_SHAPE)
+        expand_time = (time.time() - t) / iterations
+        print("Instances {:4}  minimize {:8.4f}s  batched {:8.4f}s  "
+              "loop speedup {:5.1f}x  differing pixels {}  expand {:8.4f}s".format(
+                  count, times[0], times[1], times[1] / times[0],
+                  np.count_nonzero(reference != mini_masks), expand_time))
+
+
+############################################################
+#  Proposal Settings
+############################################################
+
+# (PRE_NMS_LIMIT, RPN_NMS_THRESHOLD, POST_NMS_ROIS_INFERENCE) to try. A
+# lower NMS threshold removes more overlapping anchors, so the proposal
+# count is reached with more diverse boxes. A higher one keeps more of them.
+PROPOSAL_SETTINGS = [
+    (10000, 0.7, 1000),
+    (10000, 0.7, 600),
+    (10000, 0.7, 300),
+    (6000, 0.7, 300),
+    (3000, 0.7, 300),
+    (10000, 0.7, 100),
+    (10000, 0.6, 1000),
+    (10000, 0.8, 1000),
+    (6000, 0.6, 300),
+    (6000, 0.8, 300),
+]
+
+
+def benchmark_proposals(weights_path, dataset_dir, limit=100,
+                        settings=PROPOSAL_SETTINGS):
+    """Measures speed and accuracy of an inference model with different
+    proposal settings, on the first images of COCO minival. The settings
+    are changed with MaskRCNN.set_proposal_params(), so the model is only
+    built once.
+
+    weights_path: Weights of a COCO model to load.
+    dataset_dir: Directory of the MS-COCO dataset.
+    limit: Number of validation images to run on.
+    settings: List of (pre-NMS limit, NMS threshold, proposal count).
+
+    Returns a list of (settings, seconds per image, mAP@0.5, mAP@[.5:.95]).
+    """
+    from lib import utils
+    from lib import coco
+    from lib import model as modellib
+
+    config = BenchmarkConfig()
+    model = modellib.MaskRCNN(mode="inference", config=config,
+                              model_dir=os.path.join(os.getcwd(), "logs"))
+    model.load_weights(weights_path, by_name=True)
+
+    dataset = coco.CocoDataset()
+    dataset.load_coco(dataset_dir, "minival")
+    dataset.prepare()
+    image_ids = dataset.image_ids[:limit]
+    images = [dataset.load_image(image_id) for image_id in image_ids]
+    gt = []
+    for image_id in image_ids:
+        mask, class_ids = dataset.load_mask(image_id)
+        gt.append((utils.extract_bboxes(mask), class_ids))
+    model.warmup()
+
+    results = []
+    for pre_nms_limit, nms_threshold, proposal_count in settings:
+        model.set_proposal_params(pre_nms_limit=pre_nms_limit,
+                                  nms_threshold=nms_threshold,
+                                  proposal_count=proposal_count)
+        t = time.time()
+        detections = [model.detect([image])[0] for image in images]
+        latency = (time.time() - t) / len(images)
+        APs = utils.compute_dataset_ap(
+            (gt_boxes, gt_class_ids, r["rois"], r["class_ids"], r["scores"])
+            for (gt_boxes, gt_class_ids), r in zip(gt, detections))
+        # Images without GT boxes have no AP
+        mAP50 = np.nanmean(APs[:, 0])
+        mAP = np.nanmean(APs)
+        print("pre-NMS {:6}  NMS threshold {:.2f}  proposals {:5}  "
+              "{:8.3f} s/image  mAP@0.5 {:.3f}  mAP@[.5:.95] {:.3f}".format(
+                  pre_nms_limit, nms_threshold, proposal_count, latency,
+                  mAP50, mAP))
+        results.append(((pre_nms_limit, nms_threshold, proposal_count),
+                        latency, mAP50, mAP))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Benchmark Mask R-CNN components.')
+    parser.add_argument("command",
+                        metavar="<command>",
+                        help="'threads', 'rpn_targets', 'overlaps', 'nms', "
+                             "'mini_masks' or 'proposals'")
+    parser.add_argument('--processes', required=False, type=int, default=1,
+                        help="Number of inference processes to run at once")
+    parser.add_argument('--pin', required=False, action="store_true",
+                        help="Pin each process to its own slice of the cores")
+    parser.add_argument('--model', required=False,
+                        metavar="/path/to/weights.h5",
+                        help="Path to weights file to load")
+    parser.add_argument('--iterations', required=False, type=int, default=10,
+                        help="Number of timed iterations")
+    parser.add_argument('--dataset', required=False,
+                        metavar="/path/to/coco/",
+                        help="Directory of the MS-COCO dataset, for 'proposals'")
+    parser.add_argument('--limit', required=False, type=int, default=100,
+                        help="Number of validation images for 'proposals'")
+    args = parser.parse_args()
+
+    if args.command == "threads":
+        # Try powers of two up to the number of cores each process gets
+        cores = multiprocessing.cpu_count() // args.processes
+        intra_values = [0] + [2 ** i for i in range(cores.bit_length())]
+        results = benchmark_threads(intra_values, [0, 1, 2],
+                                    processes=args.processes, pin=args.pin,
+                                    weights_path=args.model,
+                                    iterations=args.iterations)
+        intra, inter, throughput, latency = results[0]
+        print("\nBest: INTRA_OP_PARALLELISM_THREADS = {}, "
+              "INTER_OP_PARALLELISM_THREADS = {} ({:.2f} images/s)".format(
+                  intra, inter, throughput))
+    elif args.command == "rpn_targets":
+        benchmark_rpn_targets(iterations=args.iterations)
+    elif args.command == "overlaps":
+        benchmark_overlaps(iterations=args.iterations)
+    elif args.command == "nms":
+        benchmark_nms(iterations=args.iterations)
+    elif args.command == "mini_masks":
+        benchmark_mini_masks(iterations=args.iterations)
+    elif args.command == "proposals":
+        assert args.model and args.dataset, \
+            "Arguments --model and --dataset are required for 'proposals'"
+        benchmark_proposals(args.model, args.dataset, limit=args.limit)
+    else:
+        print("'{}' is not recognized. Use 'threads', 'rpn_targets', "
+              "'overlaps', 'nms', 'mini_masks' or 'proposals'".format(
+                  args.command))
@@ -25,11 +25,36 @@ Usage: import the module (see Jupyter notebooks for examples), or run from
 
     # Run COCO evaluatoin on the last model you trained
     python3 coco.py evaluate --dataset=/path/to/coco/ --model=last
+
+    # Run COCO evaluation on all of minival instead of the first 500 images
+    python3 coco.py evaluate --dataset=/path/to/coco/ --model=last --limit=0
+
+    # Save results to a journal while evaluating. Run the same command
+    # again to continue an evaluation that was interrupted.
+    python3 coco.py evaluate --dataset=/path/to/coco/ --model=last \
+        --journal=/path/to/results.jsonl
+
+    # Export the inference graph and COCO weights to a frozen graph
+    python3 coco.py export --model=coco --output=/path/to/mask_rcnn_coco.pb
+
+    # Pack images and annotations into large shards, and train from them
+    python3 coco.py pack --dataset=/path/to/coco/ --output=/path/to/packed/
+    python3 coco.py train --packed=/path/to/packed/ --model=coco
 """
 
 import os
+import io
+import copy
+import json
 import time
+import hashlib
+import itertools
+import collections
+import concurrent.futures
 import numpy as np
+import scipy.misc
+import scipy.ndimage
+import skimage.color
 
 # Download and install the Python COCO tools from https://github.com/waleedka/coco
 # That's a fork from the original https://github.com/pdollar/coco with a bug
@@ -82,9 +107,135 @@ class CocoConfig(Config):
 #  Dataset
 ############################################################
 
+def coco_paths(dataset_dir, subset):
+    """Returns the image directory and annotations file of a COCO subset
+    (train, val, minival, val35k).
+    """
+    image_dir = os.path.join(dataset_dir, "train2014" if subset == "train"
+                             else "val2014")
+    json_path_dict = {
+        "train": "annotations/instances_train2014.json",
+        "val": "annotations/instances_val2014.json",
+        "minival": "annotations/instances_minival2014.json",
+        "val35k": "annotations/instances_valminusminival2014.json",
+    }
+    return image_dir, os.path.join(dataset_dir, json_path_dict[subset])
+
+
+def pack_annotations(coco, image_ids):
+    """Converts the annotations of the given images to flat arrays, with
+    the segmentations as compressed RLE strings. Annotations are grouped
+    by image, in the order of image_ids.
+
+    Returns a dict of arrays:
+    ann_starts: [images + 1] index of the first annotation of each image.
+        The last value is the number of annotations.
+    ann_ids: [annotations] COCO annotation IDs
+    category_ids: [annotations] COCO category IDs
+    iscrowd: [annotations] bool
+    bboxes: [annotations, (x, y, width, height)] COCO boxes
+    rle_starts: [annotations + 1] offset of each RLE string in rle_counts
+    rle_counts: [bytes] uint8. Concatenated compressed RLE strings.
+    """
+    # For its annotation conversion functions
+    dataset = CocoDataset()
+    ann_starts = [0]
+    ann_ids = []
+    category_ids = []
+    iscrowd = []
+    bboxes = []
+    rle_starts = [0]
+    rle_counts = []
+    for image_id in image_ids:
+        info = coco.imgs[image_id]
+        annotations = coco.loadAnns(coco.getAnnIds(imgIds=[image_id]))
+        for annotation in annotations:
+            rle = dataset.annToRLE(annotation, info["height"], info["width"])
+            counts = rle["counts"]
+            if not isinstance(counts, bytes):
+                counts = counts.encode("ascii")
+            ann_ids.append(annotation["id"])
+            category_ids.append(annotation["category_id"])
+            iscrowd.append(annotation["iscrowd"])
+            bboxes.append(annotation["bbox"])
+            rle_counts.append(counts)
+            rle_starts.append(rle_starts[-1] + len(counts))
+        ann_starts.append(ann_starts[-1] + len(annotations))
+    return {
+        "ann_starts": np.array(ann_starts, dtype=np.int64),
+        "ann_ids": np.array(ann_ids, dtype=np.int64),
+        "category_ids": np.array(category_ids, dtype=np.int32),
+        "iscrowd": np.array(iscrowd, dtype=bool),
+        "bboxes": np.array(bboxes, dtype=np.float32).reshape([-1, 4]),
+        "rle_starts": np.array(rle_starts, dtype=np.int64),
+        "rle_counts": np.frombuffer(b"".join(rle_counts), dtype=np.uint8),
+    }
+
+
+def build_annotation_index(coco):
+    """Builds a columnar index of the images, classes and annotations of a
+    COCO object. NumPy arrays take a fraction of the memory of the
+    annotation dicts, and can be saved and loaded quickly.
+
+    Returns a dict of arrays:
+    image_ids, widths, heights, file_names: [images] sorted by image ID
+    class_ids, class_names: [classes] sorted by class ID
+    And the annotations of the images. See pack_annotations().
+    """
+    image_ids = sorted(coco.imgs.keys())
+    class_ids = sorted(coco.getCatIds())
+    index = {
+        "image_ids": np.array(image_ids, dtype=np.int64),
+        "widths": np.array([coco.imgs[i]["width"] for i in image_ids], dtype=np.int32),
+        "heights": np.array([coco.imgs[i]["height"] for i in image_ids], dtype=np.int32),
+        "file_names": np.array([coco.imgs[i]["file_name"] for i in image_ids]),
+        "class_ids": np.array(class_ids, dtype=np.int32),
+        "class_names": np.array([coco.loadCats(i)[0]["name"] for i in class_ids]),
+    }
+    index.update(pack_annotations(coco, image_ids))
+    return index
+
+
+# Increment when the format of build_annotation_index() changes
+ANNOTATION_INDEX_VERSION = 1
+
+
+def load_annotation_index(annotations_path, coco=None, cache=True):
+    """Returns the columnar index of a COCO annotations file. See
+    build_annotation_index().
+
+    The index is cached next to the annotations file, in a .index.npz file,
+    and rebuilt when the size or modification time of the annotations file
+    changes. Loading the cache takes seconds rather than minutes.
+
+    coco: Optional COCO object of the annotations file. Avoids loading
+        it again if the index needs to be built.
+    cache: If False, always builds the index and doesn't save it.
+    """
+    cache_path = os.path.splitext(annotations_path)[0] + ".index.npz"
+    stat = os.stat(annotations_path)
+    source = np.array([ANNOTATION_INDEX_VERSION, stat.st_size, int(stat.st_mtime)],
+                      dtype=np.int64)
+    if cache and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if np.array_equal(cached["source"], source):
+            return {k: cached[k] for k in cached.files}
+
+    if coco is None:
+        coco = COCO(annotations_path)
+    index = build_annotation_index(coco)
+    index["source"] = source
+    if cache:
+        try:
+            np.savez(cache_path, **index)
+        except (IOError, OSError):
+            print("Can't write annotation index cache ", cache_path)
+    return index
+
+
 class CocoDataset(utils.Dataset):
     def load_coco(self, dataset_dir, subset, class_ids=None,
-                  class_map=None, return_coco=False):
+                  class_map=None, return_coco=False, cache_index=True):
         """Load a subset of the COCO dataset.
         dataset_dir: The root directory of the COCO dataset.
         subset: What to load (train, val, minival, val35k)
@@ -92,50 +243,83 @@ class CocoDataset(utils.Dataset):
         class_map: TODO: Not implemented yet. Supports maping classes from
             different datasets to the same class ID.
         return_coco: If True, returns the COCO object.
+        cache_index: If True, caches the annotations index on disk next to
+            the annotations file. See load_annotation_index().
         """
         # Path
-        image_dir = os.path.join(dataset_dir, "train2014" if subset == "train"
-                                 else "val2014")
-
-        # Create COCO object
-        json_path_dict = {
-            "train": "annotations/instances_train2014.json",
-            "val": "annotations/instances_val2014.json",
-            "minival": "annotations/instances_minival2014.json",
-            "val35k": "annotations/instances_valminusminival2014.json",
-        }
-        coco = COCO(os.path.join(dataset_dir, json_path_dict[subset]))
+        image_dir, annotations_path = coco_paths(dataset_dir, subset)
+
+        # Create COCO object. Only needed by the caller, or if the
+        # annotations index isn't cached yet.
+        coco = COCO(annotations_path) if return_coco else None
+        index = load_annotation_index(annotations_path, coco, cache=cache_index)
+
+        self.add_annotation_index(
+            index, class_ids,
+            lambda rows: {"path": [os.path.join(image_dir, f)
+                                   for f in index["file_names"][rows].tolist()]})
+        if return_coco:
+            return coco
+
+    def add_annotation_index(self, index, class_ids, image_columns):
+        """Adds the classes and images of an annotations index. See
+        build_annotation_index(). Like load_coco(), only images with
+        annotations of the given classes are added. Their annotations stay
+        in the index, and each image refers to its range of them.
 
+        class_ids: Classes to load, or None for all of them.
+        image_columns: Function that returns a dict of extra attributes of
+            the images in the given rows of the index, with a list or array
+            of values for each. Must include "path".
+        """
         # Load all classes or a subset?
+        all_class_ids = [int(i) for i in index["class_ids"]]
         if not class_ids:
-            # All classes
-            class_ids = sorted(coco.getCatIds())
+            class_ids = all_class_ids
 
-        # All images or a subset?
-        if class_ids:
-            image_ids = []
-            for id in class_ids:
-                image_ids.extend(list(coco.getImgIds(catIds=[id])))
-            # Remove duplicates
-            image_ids = list(set(image_ids))
-        else:
-            # All images
-            image_ids = list(coco.imgs.keys())
+        # Images with at least one annotation of the given classes
+        ann_starts = index["ann_starts"]
+        ann_images = np.repeat(np.arange(len(index["image_ids"])), np.diff(ann_starts))
+        rows = np.unique(ann_images[np.isin(index["category_ids"], class_ids)])
 
         # Add classes
+        names = dict(zip(all_class_ids, index["class_names"]))
         for i in class_ids:
-            self.add_class("coco", i, coco.loadCats(i)[0]["name"])
+            self.add_class("coco", i, str(names[i]))
 
         # Add images
-        for i in image_ids:
-            self.add_image(
-                "coco", image_id=i,
-                path=os.path.join(image_dir, coco.imgs[i]['file_name']),
-                width=coco.imgs[i]["width"],
-                height=coco.imgs[i]["height"],
-                annotations=coco.loadAnns(coco.getAnnIds(imgIds=[i], iscrowd=False)))
-        if return_coco:
-            return coco
+        columns = image_columns(rows)
+        self.add_images(
+            "coco", index["image_ids"][rows], columns.pop("path"),
+            width=index["widths"][rows],
+            height=index["heights"][rows],
+            ann_index=np.full([len(rows)], index, dtype=object),
+            ann_start=ann_starts[rows],
+            ann_end=ann_starts[rows + 1],
+            **columns)
+
+    def load_annotations(self, image_id):
+        """Returns the COCO annotation dicts of the image, excluding crowd
+        annotations. They're built from the annotations index on request,
+        with the segmentation as compressed RLE.
+        """
+        info = self.image_info[image_id]
+        index = info["ann_index"]
+        annotations = []
+        for a in range(info["ann_start"], info["ann_end"]):
+            if index["iscrowd"][a]:
+                continue
+            start, end = index["rle_starts"][a:a + 2]
+            annotations.append({
+                "id": int(index["ann_ids"][a]),
+                "image_id": info["id"],
+                "category_id": int(index["category_ids"][a]),
+                "iscrowd": 0,
+                "bbox": index["bboxes"][a].tolist(),
+                "segmentation": {"size": [info["height"], info["width"]],
+                                 "counts": index["rle_counts"][start:end].tobytes()},
+            })
+        return annotations
 
     def load_mask(self, image_id):
         """Load instance masks for the given image.
@@ -152,34 +336,92 @@ class CocoDataset(utils.Dataset):
         # If not a COCO image, delegate to parent class.
         image_info = self.image_info[image_id]
         if image_info["source"] != "coco":
-            return super(self.__class__).load_mask(image_id)
+            return super(CocoDataset, self).load_mask(image_id)
 
-        instance_masks = []
-        class_ids = []
-        annotations = self.image_info[image_id]["annotations"]
-        # Build mask of shape [height, width, instance_count] and list
-        # of class IDs that correspond to each channel of the mask.
-        for annotation in annotations:
-            class_id = self.map_source_class_id(
-                "coco.{}".format(annotation['category_id']))
-            if class_id:
-                m = self.annToMask(annotation, image_info["height"],
-                                   image_info["width"])
-                # Some objects are so small that they're less than 1 pixel area
-                # and end up rounded out. Skip those objects.
-                if m.max() < 1:
-                    continue
-                instance_masks.append(m)
-                class_ids.append(class_id)
-
-        # Pack instance masks into an array
+        rles, class_ids = self.load_rles(image_id)
         if class_ids:
-            mask = np.stack(instance_masks, axis=2)
+            # Decode all masks at once. [height, width, instance_count]
+            mask = maskUtils.decode(rles)
             class_ids = np.array(class_ids, dtype=np.int32)
             return mask, class_ids
         else:
             # Call super class to return an empty mask
-            return super(self.__class__).load_mask(image_id)
+            return super(CocoDataset, self).load_mask(image_id)
+
+    def load_mask_resized(self, image_id, scale, padding):
+        """Decodes the instance masks of the image directly into a resized
+        and padded mask array, one instance at a time. This avoids building
+        the full size [height, width, instance_count] array and resizing it.
+
+        Returns the same as load_mask().
+        """
+        image_info = self.image_info[image_id]
+        rles, class_ids = self.load_rles(image_id) if image_info["source"] == "coco" \
+            else ([], [])
+        if not class_ids:
+            return super(CocoDataset, self).load_mask_resized(image_id, scale, padding)
+
+        # Same size as scipy.ndimage.zoom() output in resize_mask()
+        h = int(round(image_info["height"] * scale))
+        w = int(round(image_info["width"] * scale))
+        (top, bottom), (left, right) = padding[:2] if padding else [(0, 0), (0, 0)]
+        mask = np.zeros([top + h + bottom, left + w + right, len(rles)], dtype=np.uint8)
+        for i, rle in enumerate(rles):
+            m = maskUtils.decode(rle)
+            if scale != 1:
+                scipy.ndimage.zoom(m, scale, order=0,
+                                   output=mask[top:top + h, left:left + w, i])
+            else:
+                mask[top:top + h, left:left + w, i] = m
+        return mask, np.array(class_ids, dtype=np.int32)
+
+    def load_rles(self, image_id):
+        """Returns the compressed RLEs and class IDs of the instances in the
+        image, skipping crowds and objects without pixels. The annotations
+        index stores every segmentation as RLE, so polygons are rasterized
+        once when the index is built, and not again in every epoch or
+        process. See load_annotation_index().
+
+        Returns:
+        rles: List of compressed RLE dicts
+        class_ids: List of class IDs of the RLEs
+        """
+        info = self.image_info[image_id]
+        index = info["ann_index"]
+        rles = []
+        class_ids = []
+        for a in range(info["ann_start"], info["ann_end"]):
+            if index["iscrowd"][a]:
+                continue
+            # None if the class isn't loaded
+            class_id = self.class_from_source_map.get(
+                "coco.{}".format(index["category_ids"][a]))
+            if class_id:
+                start, end = index["rle_starts"][a:a + 2]
+                rle = {"size": [info["height"], info["width"]],
+                       "counts": index["rle_counts"][start:end].tobytes()}
+                # Skip objects that have no pixels
+                if maskUtils.area(rle):
+                    rles.append(rle)
+                    class_ids.append(class_id)
+        return rles, class_ids
+
+    def annotation_key(self, image_id):
+        """Hashes the annotations of an image loaded from an annotations
+        index, rather than the whole index.
+        """
+        info = self.image_info[image_id]
+        if "ann_index" not in info:
+            return super(CocoDataset, self).annotation_key(image_id)
+        index = info["ann_index"]
+        start, end = info["ann_start"], info["ann_end"]
+        key = hashlib.md5(repr(sorted((k, v) for k, v in info.items()
+                                      if k != "ann_index")).encode("utf-8"))
+        for name in ["ann_ids", "category_ids", "iscrowd", "bboxes"]:
+            key.update(np.ascontiguousarray(index[name][start:end]).tobytes())
+        rle_start, rle_end = index["rle_starts"][[start, end]]
+        key.update(index["rle_counts"][rle_start:rle_end].tobytes())
+        return key.hexdigest()
 
     def image_reference(self, image_id):
         """Return a link to the image in the COCO Website."""
@@ -220,10 +462,150 @@ class CocoDataset(utils.Dataset):
         return m
 
 
+############################################################
+#  Packed Dataset
+############################################################
+
+def pack_coco(dataset_dir, subset, output_dir, shard_bytes=2**30):
+    """Packs the images and annotations of a COCO subset into a few large
+    files that can be read sequentially. Use PackedCocoDataset to read them.
+
+    Writes to output_dir:
+    <subset>_<shard>.bin: The JPEG files, as they are, one after the other.
+        A new shard is started when one reaches shard_bytes.
+    <subset>_index.npz: The shard, offset and size of each image, and the
+        annotations index. See build_annotation_index().
+    """
+    image_dir, annotations_path = coco_paths(dataset_dir, subset)
+    coco = COCO(annotations_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    image_ids = sorted(coco.imgs.keys())
+    shards = np.zeros([len(image_ids)], dtype=np.int32)
+    offsets = np.zeros([len(image_ids)], dtype=np.int64)
+    lengths = np.zeros([len(image_ids)], dtype=np.int64)
+    shard = 0
+    f = open(os.path.join(output_dir, "{}_{:04d}.bin".format(subset, shard)), "wb")
+    try:
+        for i, image_id in enumerate(image_ids):
+            with open(os.path.join(image_dir, coco.imgs[image_id]["file_name"]), "rb") as image_file:
+                data = image_file.read()
+            if f.tell() and f.tell() + len(data) > shard_bytes:
+                f.close()
+                shard += 1
+                f = open(os.path.join(output_dir, "{}_{:04d}.bin".format(subset, shard)), "wb")
+            shards[i] = shard
+            offsets[i] = f.tell()
+            lengths[i] = len(data)
+            f.write(data)
+    finally:
+        f.close()
+
+    index = build_annotation_index(coco)
+    np.savez(os.path.join(output_dir, "{}_index.npz".format(subset)),
+             num_shards=shard + 1, shards=shards, offsets=offsets,
+             lengths=lengths, **index)
+
+
+class PackedCocoDataset(CocoDataset):
+    """Reads COCO images and annotations packed by pack_coco(). Images are
+    read from a few large files rather than one file each, which is much
+    faster on network storage.
+    """
+
+    def __init__(self, class_map=None):
+        super(PackedCocoDataset, self).__init__(class_map)
+        # Image shards of the loaded subsets. {(subset, shard): uint8 array}
+        self.shards = {}
+
+    def load_packed(self, pack_dir, subset, class_ids=None, mmap=True):
+        """Load a subset of the COCO dataset from packed files.
+        pack_dir: The directory written by pack_coco().
+        subset: What to load (train, val, minival, val35k)
+        class_ids: If provided, only loads images that have the given classes.
+        mmap: If True, memory-maps the image shards. Otherwise reads all of
+            them into memory with large sequential reads.
+        """
+        index = np.load(os.path.join(pack_dir, "{}_index.npz".format(subset)))
+        packed = {k: index[k] for k in index.files}
+        for shard in range(int(packed["num_shards"])):
+            path = os.path.join(pack_dir, "{}_{:04d}.bin".format(subset, shard))
+            if mmap:
+                self.shards[(subset, shard)] = np.memmap(path, dtype=np.uint8, mode="r")
+            else:
+                self.shards[(subset, shard)] = np.fromfile(path, dtype=np.uint8)
+
+        self.add_annotation_index(
+            packed, class_ids,
+            lambda rows: {"path": [None] * len(rows),
+                          "shard": [(subset, s) for s in packed["shards"][rows].tolist()],
+                          "offset": packed["offsets"][rows],
+                          "length": packed["lengths"][rows]})
+
+    def load_image(self, image_id):
+        """Decodes the image from its shard."""
+        info = self.image_info[image_id]
+        if "shard" not in info:
+            return super(PackedCocoDataset, self).load_image(image_id)
+        data = self.shards[info["shard"]][info["offset"]:info["offset"] + info["length"]]
+        image = scipy.misc.imread(io.BytesIO(data.tobytes()))
+        # If grayscale. Convert to RGB for consistency.
+        if image.ndim != 3:
+            image = skimage.color.gray2rgb(image)
+        return image
+
+
 ############################################################
 #  COCO Evaluation
 ############################################################
 
+def encode_coco_results(image_id, rois, category_ids, scores, masks):
+    """Converts the detections of one image to COCO results, with the masks
+    encoded to RLE. Used by build_coco_results() and evaluate_coco().
+    image_id: COCO image ID
+    rois: [N, (y1, x1, y2, x2)] detection bounding boxes
+    category_ids: [N] COCO category IDs
+    scores: [N] float probability scores
+    masks: [H, W, N] instance binary masks
+
+    Returns the results as columns, a dict of:
+    image_id: [N] COCO image IDs
+    category_id: [N] COCO category IDs
+    bbox: [N, (x, y, width, height)]
+    score: [N] scores
+    segmentation: List of N RLE dicts
+    """
+    count = rois.shape[0]
+    bbox = np.around(rois, 1).reshape([count, 4])
+    if count:
+        # Encode all masks in one call from a single Fortran ordered
+        # buffer, instead of copying each mask to Fortran order
+        segmentation = maskUtils.encode(np.asfortranarray(masks, dtype=np.uint8))
+    else:
+        segmentation = []
+    return {
+        "image_id": np.full([count], image_id, dtype=np.int64),
+        "category_id": np.array(category_ids, dtype=np.int64).reshape([count]),
+        "bbox": np.stack([bbox[:, 1], bbox[:, 0],
+                          bbox[:, 3] - bbox[:, 1], bbox[:, 2] - bbox[:, 0]], axis=1),
+        "score": np.array(scores, dtype=np.float64).reshape([count]),
+        "segmentation": segmentation,
+    }
+
+
+def coco_result_records(columns):
+    """Converts result columns from encode_coco_results() to the list of
+    result dicts that COCO.loadRes() takes.
+    """
+    return [{"image_id": image_id, "category_id": category_id, "bbox": bbox,
+             "score": score, "segmentation": segmentation}
+            for image_id, category_id, bbox, score, segmentation in zip(
+                columns["image_id"].tolist(), columns["category_id"].tolist(),
+                columns["bbox"].tolist(), columns["score"].tolist(),
+                columns["segmentation"])]
+
+
 def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     """Arrange resutls to match COCO specs in http://cocodataset.org/#format
     """
@@ -231,31 +613,189 @@ def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     if rois is None:
         return []
 
+    category_ids = [dataset.get_source_class_id(class_id, "coco")
+                    for class_id in class_ids]
     results = []
     for image_id in image_ids:
-        # Loop through detections
-        for i in range(rois.shape[0]):
-            class_id = class_ids[i]
-            score = scores[i]
-            bbox = np.around(rois[i], 1)
-            mask = masks[:, :, i]
-
-            result = {
-                "image_id": image_id,
-                "category_id": dataset.get_source_class_id(class_id, "coco"),
-                "bbox": [bbox[1], bbox[0], bbox[3]-bbox[1], bbox[2]-bbox[0]],
-                "score": score,
-                "segmentation": maskUtils.encode(np.asfortranarray(mask))
-            }
-            results.append(result)
+        results.extend(coco_result_records(
+            encode_coco_results(image_id, rois, category_ids, scores, masks)))
     return results
 
 
-def evaluate_coco(dataset, coco, eval_type="bbox", limit=0):
+def load_coco_results(coco, records):
+    """Builds the COCO object of detection results, like COCO.loadRes(),
+    from an iterable of result records. The records are added as they're
+    read, so results can be streamed from a result journal without
+    collecting them in a list first.
+    coco: The COCO object of the dataset
+    records: Iterable of result dicts, as from coco_result_records()
+    """
+    results = COCO()
+    results.dataset["images"] = [img for img in coco.dataset["images"]]
+    results.dataset["categories"] = copy.deepcopy(coco.dataset["categories"])
+    annotations = results.dataset["annotations"] = []
+    coco_image_ids = set(coco.getImgIds())
+    for record in records:
+        assert record["image_id"] in coco_image_ids, \
+            "Results do not correspond to current coco set"
+        # Same attributes as loadRes() adds to results with boxes
+        record["area"] = record["bbox"][2] * record["bbox"][3]
+        record["id"] = len(annotations) + 1
+        record["iscrowd"] = 0
+        annotations.append(record)
+    results.createIndex()
+    return results
+
+
+def prefetch_images(dataset, image_ids, threads=4):
+    """Loads images in a pool of threads and yields them in order. Keeps
+    at most 2 images per thread loaded ahead, so memory use doesn't grow
+    with the number of images. Decoding images releases the GIL, so
+    threads are enough to keep up with the model.
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        image_ids = iter(image_ids)
+        for image_id in image_ids:
+            pending.append(executor.submit(dataset.load_image, image_id))
+            if len(pending) >= 2 * threads:
+                break
+        while pending:
+            image = pending.popleft().result()
+            for image_id in itertools.islice(image_ids, 1):
+                pending.append(executor.submit(dataset.load_image, image_id))
+            yield image
+
+
+# Config attributes that change the detections. A result journal is only
+# continued if they and the weights are the same as when it was started.
+RESULT_JOURNAL_CONFIG_KEYS = [
+    "NUM_CLASSES", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_PADDING",
+    "MEAN_PIXEL", "BACKBONE_STRIDES", "RPN_ANCHOR_SCALES", "RPN_ANCHOR_RATIOS",
+    "RPN_ANCHOR_STRIDE", "RPN_BBOX_STD_DEV", "PRE_NMS_LIMIT",
+    "RPN_NMS_THRESHOLD", "POST_NMS_ROIS_INFERENCE", "POOL_SIZE",
+    "MASK_POOL_SIZE", "MASK_SHAPE", "BBOX_STD_DEV", "DETECTION_MAX_INSTANCES",
+    "DETECTION_MIN_CONFIDENCE", "DETECTION_NMS_THRESHOLD",
+]
+
+
+def result_journal_header(model):
+    """Returns the header line of a result journal of the model, a dict
+    with the path of its weights and its config.
+    """
+    weights_path = model.weights_path and os.path.abspath(model.weights_path)
+    config = {k: np.array(v).tolist() for k, v in model.config.to_dict().items()}
+    # Round trip through JSON, so it compares equal to a header read back
+    return json.loads(json.dumps({"weights": weights_path, "config": config}))
+
+
+def write_result_journal(journal, image_id, columns):
+    """Appends the results of one image to a result journal, a file with
+    a header line and then one JSON line per evaluated image. Images
+    without detections get a line as well, so the journal records which
+    images are done.
+    journal: File opened for appending text
+    image_id: COCO image ID
+    columns: Result columns from encode_coco_results()
+    """
+    segmentation = columns["segmentation"]
+    line = {
+        "image_id": image_id,
+        "category_id": columns["category_id"].tolist(),
+        "bbox": columns["bbox"].tolist(),
+        "score": columns["score"].tolist(),
+        "size": segmentation[0]["size"] if segmentation else None,
+        "counts": [rle["counts"].decode("ascii") for rle in segmentation],
+    }
+    journal.write(json.dumps(line) + "\n")
+
+
+def read_result_journal(path):
+    """Reads a result journal written by write_result_journal().
+    Skips the header line, and a last line that was cut short by a crash.
+
+    Yields (image_id, result columns) for each image.
+    """
+    with open(path, "r") as f:
+        for line in itertools.islice(f, 1, None):
+            if not line.endswith("\n"):
+                break
+            line = json.loads(line)
+            count = len(line["score"])
+            yield line["image_id"], {
+                "image_id": np.full([count], line["image_id"], dtype=np.int64),
+                "category_id": np.array(line["category_id"], dtype=np.int64),
+                "bbox": np.array(line["bbox"], dtype=np.float64).reshape([count, 4]),
+                "score": np.array(line["score"], dtype=np.float64),
+                "segmentation": [{"size": line["size"], "counts": c.encode("ascii")}
+                                 for c in line["counts"]],
+            }
+
+
+def read_result_journal_header(path):
+    """Returns the header of a result journal, or None if it's empty or
+    the header line was cut short by a crash. See result_journal_header().
+    """
+    with open(path, "r") as f:
+        line = f.readline()
+    return json.loads(line) if line.endswith("\n") else None
+
+
+def open_result_journal(path, header):
+    """Opens a result journal for appending, after removing a last line
+    that was cut short by a crash. A new journal starts with the header.
+    An existing one must have been started with the same weights and
+    config, so the results of different models aren't mixed.
+    header: The header of the model, from result_journal_header().
+
+    Returns the open file and the set of COCO image IDs already in it.
+    """
+    done = set()
+    existing = read_result_journal_header(path) if os.path.exists(path) else None
+    if existing is not None:
+        config = existing.get("config", {})
+        changed = [k for k in RESULT_JOURNAL_CONFIG_KEYS
+                   if config.get(k) != header["config"].get(k)]
+        if existing.get("weights") != header["weights"]:
+            changed.insert(0, "weights")
+        if changed:
+            raise Exception(
+                "Result journal {} was started with different {}. Use a new "
+                "journal for other weights or settings.".format(path, ", ".join(changed)))
+        done = set(image_id for image_id, _ in read_result_journal(path))
+        with open(path, "rb+") as f:
+            data = f.read()
+            f.truncate(data.rfind(b"\n") + 1)
+        return open(path, "a"), done
+    journal = open(path, "w")
+    journal.write(json.dumps(header) + "\n")
+    return journal, done
+
+
+def evaluate_coco(model, dataset, coco, eval_type="bbox", limit=0,
+                  loader_threads=4, encode_processes=1, journal_path=None):
     """Runs official COCO evaluation.
+    model: A MaskRCNN model in inference mode
     dataset: A Dataset object with valiadtion data
+    coco: The COCO object of the dataset, as returned by load_coco()
     eval_type: "bbox" or "segm" for bounding box or segmentation evaluation
     limit: if not 0, it's the number of images to use for evaluation
+    loader_threads: Number of threads loading images ahead of the model.
+    encode_processes: Number of processes encoding masks to RLE.
+    journal_path: Optional path of a result journal. Results are appended
+        to it as images finish instead of being kept in memory, and images
+        already in it are skipped, so an interrupted evaluation continues
+        where it stopped. The final evaluation reads the results back
+        from the journal. It records the weights path and config of the
+        model, and isn't continued with different ones.
+
+    Images are run through the model BATCH_SIZE at a time. While the model
+    runs on a batch, the next images are loaded in threads, and the masks
+    of the previous batches are encoded in other processes. Decoding images
+    and running TF release the GIL, but RLE encoding holds it, so encoding
+    in threads would stall the loop that feeds the model.
+
+    Returns the COCOeval object.
     """
     # Pick COCO images from the dataset
     image_ids = dataset.image_ids
@@ -266,28 +806,87 @@ def evaluate_coco(dataset, coco, eval_type="bbox", limit=0):
 
     # Get corresponding COCO image IDs.
     coco_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
+    batch_size = model.config.BATCH_SIZE
 
-    t_prediction = 0
-    t_start = time.time()
-
+    # Skip images that are in the journal already
     results = []
-    for i, image_id in enumerate(image_ids):
-        # Load image
-        image = dataset.load_image(image_id)
-
-        # Run detection
-        t = time.time()
-        r = model.detect([image], verbose=0)[0]
-        t_prediction += (time.time() - t)
+    journal = None
+    if journal_path:
+        journal, done = open_result_journal(journal_path, result_journal_header(model))
+        if done:
+            print("Resuming from journal with {} images done".format(len(done)))
+        image_ids = [image_id for image_id, coco_image_id
+                     in zip(image_ids, coco_image_ids)
+                     if coco_image_id not in done]
+
+    def finish(coco_image_id, columns):
+        if journal:
+            write_result_journal(journal, coco_image_id, columns)
+        else:
+            results.extend(coco_result_records(columns))
 
-        # Convert results to COCO format
-        image_results = build_coco_results(dataset, coco_image_ids[i:i+1],
-                                           r["rois"], r["class_ids"],
-                                           r["scores"], r["masks"])
-        results.extend(image_results)
+    t_prediction = 0
+    t_start = time.time()
 
-    # Load results. This modifies results with additional attributes.
-    coco_results = coco.loadRes(results)
+    with concurrent.futures.ProcessPoolExecutor(encode_processes) as executor:
+        # (COCO image ID, result) of images being encoded, in order
+        pending = collections.deque()
+        images = prefetch_images(dataset, image_ids, loader_threads)
+        try:
+            for start in range(0, len(image_ids), batch_size):
+                batch = list(itertools.islice(images, batch_size))
+                count = len(batch)
+                # The graph has a fixed batch size. Pad the last batch by
+                # repeating its last image.
+                batch += batch[-1:] * (batch_size - count)
+
+                # Run detection
+                t = time.time()
+                r = model.detect(batch, verbose=0)
+                t_prediction += (time.time() - t)
+
+                # Convert results to COCO format in the encoding processes
+                for i in range(count):
+                    image_id = image_ids[start + i]
+                    category_ids = [dataset.get_source_class_id(class_id, "coco")
+                                    for class_id in r[i]["class_ids"]]
+                    coco_image_id = dataset.image_info[image_id]["id"]
+                    pending.append((coco_image_id, executor.submit(
+                        encode_coco_results, coco_image_id, r[i]["rois"],
+                        category_ids, r[i]["scores"], r[i]["masks"])))
+
+                # Collect finished images. Wait if the encoding falls behind,
+                # so that the masks waiting for it don't fill the memory.
+                while pending and (pending[0][1].done() or
+                                   len(pending) > 4 * batch_size):
+                    finish(pending[0][0], pending.popleft()[1].result())
+                if journal:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            while pending:
+                finish(pending[0][0], pending.popleft()[1].result())
+        except BaseException:
+            # Keep the images that are done, also if detection fails. Images
+            # that can't be saved are skipped, so the original error is the
+            # one that's raised.
+            for coco_image_id, result in pending:
+                try:
+                    finish(coco_image_id, result.result())
+                except Exception:
+                    pass
+            raise
+        finally:
+            if journal:
+                journal.close()
+
+    # Load results. This modifies results with additional attributes. The
+    # records of a journal are read one image at a time.
+    if journal:
+        coco_image_id_set = set(coco_image_ids)
+        results = (record for image_id, columns in read_result_journal(journal_path)
+                   if image_id in coco_image_id_set
+                   for record in coco_result_records(columns))
+    coco_results = load_coco_results(coco, results)
 
     # Evaluate
     cocoEval = COCOeval(coco, coco_results, eval_type)
@@ -297,9 +896,9 @@ def evaluate_coco(dataset, coco, eval_type="bbox", limit=0):
     cocoEval.summarize()
 
     print("Prediction time: {}. Average {}/image".format(
-        t_prediction, t_prediction/len(image_ids)))
+        t_prediction, t_prediction/max(len(image_ids), 1)))
     print("Total time: ", time.time() - t_start)
-
+    return cocoEval
 
 
 ############################################################
@@ -314,27 +913,63 @@ if __name__ == '__main__':
         description='Train Mask R-CNN on MS COCO.')
     parser.add_argument("command",
                         metavar="<command>",
-                        help="'train' or 'evaluate' on MS COCO")
-    parser.add_argument('--dataset', required=True,
+                        help="'train', 'evaluate', 'export' or 'pack' on MS COCO")
+    parser.add_argument('--dataset', required=False,
                         metavar="/path/to/coco/",
                         help='Directory of the MS-COCO dataset')
-    parser.add_argument('--model', required=True,
+    parser.add_argument('--packed', required=False,
+                        metavar="/path/to/packed/",
+                        help="Directory written by 'pack'. Used instead of --dataset")
+    parser.add_argument('--model', required=False,
                         metavar="/path/to/weights.h5",
                         help="Path to weights .h5 file or 'coco'")
+    parser.add_argument('--output', required=False,
+                        metavar="/path/to/output",
+                        help="Path of the frozen graph written by 'export', "
+                             "or the directory written by 'pack'")
+    parser.add_argument('--limit', required=False, type=int, default=500,
+                        metavar="<image count>",
+                        help="Images to use for evaluation (default=500). "
+                             "0 for all of minival")
+    parser.add_argument('--batch-size', required=False, type=int, default=1,
+                        metavar="<image count>",
+                        help="Images per batch of 'evaluate' and 'export' "
+                             "(default=1)")
+    parser.add_argument('--journal', required=False,
+                        metavar="/path/to/results.jsonl",
+                        help="Result journal of 'evaluate'. Continues the "
+                             "evaluation if the file exists")
     args = parser.parse_args()
     print("Command: ", args.command)
     print("Model: ", args.model)
     print("Dataset: ", args.dataset)
+    if args.command == "train":
+        assert args.dataset or args.packed, \
+            "Argument --dataset or --packed is required for training"
+    if args.command == "evaluate":
+        # COCOeval needs the original annotations file
+        assert args.dataset, "Argument --dataset is required for evaluation"
+    if args.command != "pack":
+        assert args.model, "Argument --model is required"
+
+    # Packing the dataset doesn't need a model
+    if args.command == "pack":
+        assert args.dataset and args.output, \
+            "Arguments --dataset and --output are required for packing"
+        for subset in ["train", "val35k", "minival"]:
+            print("Packing ", subset)
+            pack_coco(args.dataset, subset, args.output)
+        exit()
 
     # Configurations
     if args.command == "train":
         config = CocoConfig()
     else:
         class InferenceConfig(CocoConfig):
-            # Set batch size to 1 since we'll be running inference on
-            # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
+            # Batch size = GPU_COUNT * IMAGES_PER_GPU. Evaluation runs the
+            # images through the model this many at a time.
             GPU_COUNT = 1
-            IMAGES_PER_GPU = 1
+            IMAGES_PER_GPU = args.batch_size
         config = InferenceConfig()
     config.print()
 
@@ -366,14 +1001,23 @@ if __name__ == '__main__':
     if args.command == "train":
         # Training dataset. Use the training set and 35K from the
         # validation set, as as in the Mask RCNN paper.
-        dataset_train = CocoDataset()
-        dataset_train.load_coco(args.dataset, "train")
-        dataset_train.load_coco(args.dataset, "val35k")
+        if args.packed:
+            dataset_train = PackedCocoDataset()
+            dataset_train.load_packed(args.packed, "train")
+            dataset_train.load_packed(args.packed, "val35k")
+        else:
+            dataset_train = CocoDataset()
+            dataset_train.load_coco(args.dataset, "train")
+            dataset_train.load_coco(args.dataset, "val35k")
         dataset_train.prepare()
 
         # Validation dataset
-        dataset_val = CocoDataset()
-        dataset_val.load_coco(args.dataset, "minival")
+        if args.packed:
+            dataset_val = PackedCocoDataset()
+            dataset_val.load_packed(args.packed, "minival")
+        else:
+            dataset_val = CocoDataset()
+            dataset_val.load_coco(args.dataset, "minival")
         dataset_val.prepare()
 
         # This training schedule is an example. Update to fit your needs.
@@ -408,8 +1052,11 @@ if __name__ == '__main__':
         coco = dataset_val.load_coco(args.dataset, "minival", return_coco=True)
         dataset_val.prepare()
 
-        # TODO: evaluating on 500 images. Set to 0 to evaluate on all images.
-        evaluate_coco(dataset_val, coco, "bbox", limit=500)
+        evaluate_coco(model, dataset_val, coco, "bbox", limit=args.limit,
+                      journal_path=args.journal)
+    elif args.command == "export":
+        model.export_frozen_graph(
+            args.output or os.path.join(ROOT_DIR, "mask_rcnn_coco.pb"))
     else:
         print("'{}' is not recognized. "
-              "Use 'train' or 'evaluate'".format(args.command))
+              "Use 'train', 'evaluate', 'export' or 'pack'".format(args.command))
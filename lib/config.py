@@ -71,7 +71,16 @@ class Config(object):
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
 
+    # Number of top scoring anchors that go into the RPN non-maximum
+    # supression, and its IoU threshold
+    PRE_NMS_LIMIT = 10000
+    RPN_NMS_THRESHOLD = 0.7
+
     # ROIs kept after non-maximum supression (training and inference)
+    # These, PRE_NMS_LIMIT and RPN_NMS_THRESHOLD can be changed on a built
+    # model with MaskRCNN.set_proposal_params(). Fewer inference ROIs make
+    # the classifier head cheaper. Run "python3 -m lib.benchmark proposals"
+    # to see the effect on speed and accuracy.
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
 
@@ -135,6 +144,35 @@ class Config(object):
     # train the RPN.
     USE_RPN_ROIS = True
 
+    # Number of processes building training batches. If 0, training uses
+    # data_generator() with Keras multiprocessing workers. Otherwise it uses
+    # a DataLoader, which assembles batches in shared memory.
+    DATA_LOADER_PROCESSES = 0
+
+    # Directory to cache resized images, masks and RPN targets in. If set,
+    # each image is cached the first time training uses it and read back in
+    # later epochs. Needs IMAGE_SHAPE bytes per image, which is hundreds of
+    # GB for all of COCO. None to disable. See TargetCache in model.py.
+    TARGET_CACHE_DIR = None
+
+    # TensorFlow session threading, applied when MaskRCNN is created.
+    # Threads used to run a single op (e.g. a convolution) and to run
+    # independent ops in parallel. 0 lets TensorFlow decide, which usually
+    # means one thread per core. When running several processes on one
+    # machine, lower these so they don't compete for the same cores.
+    # Run "python3 -m lib.benchmark threads" to find good values.
+    INTRA_OP_PARALLELISM_THREADS = 0
+    INTER_OP_PARALLELISM_THREADS = 0
+
+    # CPU cores to pin the process to, for example [0, 1, 2, 3].
+    # None to run on any core. Only supported on Linux.
+    CPU_AFFINITY = None
+
+    # Number of detect() calls MaskRCNN.warmup() runs before the first real
+    # detection. The first calls finalize the graph and warm up the memory
+    # allocator, which makes them much slower than the following ones.
+    WARMUP_ITERATIONS = 2
+
     def __init__(self):
         """Set values of computed attributes."""
         # Effective batch size
@@ -149,10 +187,14 @@ class Config(object):
               int(math.ceil(self.IMAGE_SHAPE[1] / stride))]
              for stride in self.BACKBONE_STRIDES])
 
+    def to_dict(self):
+        """Returns the configuration values as a dict."""
+        return {a: getattr(self, a) for a in dir(self)
+                if not a.startswith("__") and not callable(getattr(self, a))}
+
     def print(self):
         """Display Configuration values."""
         print("\nConfigurations:")
-        for a in dir(self):
-            if not a.startswith("__") and not callable(getattr(self, a)):
-                print("{:30} {}".format(a, getattr(self, a)))
+        for key, value in sorted(self.to_dict().items()):
+            print("{:30} {}".format(key, value))
         print("\n")
@@ -11,11 +11,17 @@ import os
 import random
 import datetime
 import re
+import json
+import hashlib
 import logging
+import ctypes
+import multiprocessing
+import queue
 from collections import OrderedDict
 import numpy as np
 import scipy.misc
 import tensorflow as tf
+from tensorflow.python.ops import gen_image_ops
 import keras
 import keras.backend as K
 import keras.layers as KL
@@ -47,6 +53,28 @@ def log(text, array=None):
     print(text)
 
 
+def session_config(config):
+    """Returns a tf.ConfigProto with the thread counts set in the config,
+    or None if TensorFlow should use its defaults.
+    """
+    if not (config.INTRA_OP_PARALLELISM_THREADS or
+            config.INTER_OP_PARALLELISM_THREADS):
+        return None
+    return tf.ConfigProto(
+        intra_op_parallelism_threads=config.INTRA_OP_PARALLELISM_THREADS,
+        inter_op_parallelism_threads=config.INTER_OP_PARALLELISM_THREADS)
+
+
+def set_cpu_affinity(config):
+    """Pins the current process to the cores in config.CPU_AFFINITY."""
+    if config.CPU_AFFINITY is None:
+        return
+    if not hasattr(os, "sched_setaffinity"):
+        logging.warning("CPU_AFFINITY is not supported on this platform.")
+        return
+    os.sched_setaffinity(0, config.CPU_AFFINITY)
+
+
 class BatchNorm(KL.BatchNormalization):
     """Batch Normalization class. Subclasses the Keras BN class and
     hardcodes training=False so the BN layer doesn't update
@@ -176,42 +204,42 @@ def resnet_graph(input_image, architecture, stage5=False):
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, 4] where each row is y1, x1, y2, x2
-    deltas: [N, 4] where each row is [dy, dx, log(dh), log(dw)]
+    boxes: [..., 4] where each row is y1, x1, y2, x2
+    deltas: [..., 4] where each row is [dy, dx, log(dh), log(dw)]
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
 def clip_boxes_graph(boxes, window):
     """
-    boxes: [N, 4] each row is y1, x1, y2, x2
+    boxes: [..., 4] each row is y1, x1, y2, x2
     window: [4] in the form y1, x1, y2, x2
     """
     # Split corners
     wy1, wx1, wy2, wx2 = tf.split(window, 4)
-    y1, x1, y2, x2 = tf.split(boxes, 4, axis=1)
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=-1)
     # Clip
     y1 = tf.maximum(tf.minimum(y1, wy2), wy1)
     x1 = tf.maximum(tf.minimum(x1, wx2), wx1)
     y2 = tf.maximum(tf.minimum(y2, wy2), wy1)
     x2 = tf.maximum(tf.minimum(x2, wx2), wx1)
-    clipped = tf.concat([y1, x1, y2, x2], axis=1, name="clipped_boxes")
+    clipped = tf.concat([y1, x1, y2, x2], axis=-1, name="clipped_boxes")
     return clipped
 
 
@@ -227,17 +255,39 @@ class ProposalLayer(KE.Layer):
 
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
+
+    The pre-NMS limit, NMS threshold and proposal count are read from
+    variables, so they can be changed between runs without rebuilding the
+    graph. See MaskRCNN.set_proposal_params().
     """
     def __init__(self, proposal_count, nms_threshold, anchors,
-                 config=None, **kwargs):
+                 config=None, pre_nms_limit=10000, dynamic=False, **kwargs):
         """
         anchors: [N, (y1, x1, y2, x2)] anchors defined in image coordinates
+        pre_nms_limit: Number of top scoring anchors to run NMS on.
+        dynamic: If True, proposals are padded to the current proposal
+            count instead of the one the layer was built with, so fewer
+            ROIs go through the following layers when it's lowered.
         """
         super(ProposalLayer, self).__init__(**kwargs)
         self.config = config
         self.proposal_count = proposal_count
         self.nms_threshold = nms_threshold
         self.anchors = anchors.astype(np.float32)
+        self.pre_nms_limit = pre_nms_limit
+        self.dynamic = dynamic
+
+    def build(self, input_shape):
+        # The settings are non-trainable weights of the layer. They're
+        # initialized from the arguments above rather than loaded from
+        # weight files (see MaskRCNN.load_weights()).
+        def setting(name, value, dtype):
+            return self.add_weight(name, (), dtype=dtype, trainable=False,
+                                   initializer=lambda shape: np.array(value, dtype))
+        self.pre_nms_limit_var = setting("pre_nms_limit", self.pre_nms_limit, "int32")
+        self.nms_threshold_var = setting("nms_threshold", self.nms_threshold, "float32")
+        self.proposal_count_var = setting("proposal_count", self.proposal_count, "int32")
+        super(ProposalLayer, self).build(input_shape)
 
     def call(self, inputs):
         # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
@@ -249,55 +299,58 @@ class ProposalLayer(KE.Layer):
         anchors = self.anchors
 
         # Improve performance by trimming to top anchors by score
-        # and doing the rest on the smaller subset.
-        pre_nms_limit = min(10000, self.anchors.shape[0])
-        ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True, name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                    self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                    self.config.IMAGES_PER_GPU)
-        anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x), 
-                                     self.config.IMAGES_PER_GPU,
-                                     names=["pre_nms_anchors"])
+        # and doing the rest on the smaller subset. Everything up to NMS
+        # runs on the whole batch at once, so the graph doesn't grow with
+        # the batch size.
+        pre_nms_limit = tf.minimum(self.pre_nms_limit_var, self.anchors.shape[0])
+        scores, ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
+                                 name="top_anchors")
+        # Gather the deltas of the top anchors of each image. Indices of
+        # [batch, pre_nms_limit, (image, anchor)]
+        batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(ix)[0]), 1),
+                           [1, pre_nms_limit])
+        deltas = tf.gather_nd(deltas, tf.stack([batch_ix, ix], axis=2))
+        anchors = tf.gather(anchors, ix, name="pre_nms_anchors")
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([anchors, deltas],
-                                   lambda x, y: apply_box_deltas_graph(x, y),
-                                   self.config.IMAGES_PER_GPU,
-                                   names=["refined_anchors"])
+        boxes = tf.identity(apply_box_deltas_graph(anchors, deltas),
+                            name="refined_anchors")
 
         # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
         height, width = self.config.IMAGE_SHAPE[:2]
         window = np.array([0, 0, height, width]).astype(np.float32)
-        boxes = utils.batch_slice(boxes,
-                                   lambda x: clip_boxes_graph(x, window),
-                                   self.config.IMAGES_PER_GPU, 
-                                   names=["refined_anchors_clipped"])
+        boxes = tf.identity(clip_boxes_graph(boxes, window),
+                            name="refined_anchors_clipped")
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
         # for small objects, so we're skipping it.
 
         # Normalize dimensions to range of 0 to 1.
-        normalized_boxes = boxes / np.array([[height, width, height, width]])
-
-        # Non-max suppression
-        def nms(normalized_boxes, scores):
-            indices = tf.image.non_max_suppression(
-                normalized_boxes, scores, self.proposal_count,
-                self.nms_threshold, name="rpn_non_max_suppression")
+        normalized_boxes = boxes / np.array([[height, width, height, width]],
+                                            dtype=np.float32)
+
+        # Non-max suppression. Only this part runs per image, in a
+        # tf.map_fn() loop, which is one subgraph for any batch size.
+        def nms(inputs):
+            normalized_boxes, scores = inputs
+            # tf.image.non_max_suppression() in TF 1.3 only takes the IoU
+            # threshold as a Python float. The V2 op takes it as a tensor.
+            indices = gen_image_ops.non_max_suppression_v2(
+                normalized_boxes, scores, self.proposal_count_var,
+                self.nms_threshold_var, name="rpn_non_max_suppression")
             proposals = tf.gather(normalized_boxes, indices)
             # Pad if needed
-            padding = self.proposal_count - tf.shape(proposals)[0]
+            padding = self.proposal_count_var - tf.shape(proposals)[0]
             proposals = tf.concat([proposals, tf.zeros([padding, 4])], 0)
+            proposals.set_shape([None if self.dynamic else self.proposal_count, 4])
             return proposals
-        proposals = utils.batch_slice([normalized_boxes, scores], nms,
-                                       self.config.IMAGES_PER_GPU)
+        proposals = tf.map_fn(nms, (normalized_boxes, scores), dtype=tf.float32)
         return proposals
 
     def compute_output_shape(self, input_shape):
-        return (None, self.proposal_count, 4)
+        return (None, None if self.dynamic else self.proposal_count, 4)
 
 
 ############################################################
@@ -401,8 +454,11 @@ class PyramidROIAlign(KE.Layer):
         ix = tf.gather(box_to_level[:,2], ix)
         pooled = tf.gather(pooled, ix)
 
-        # Re-add the batch dimension
-        pooled = tf.expand_dims(pooled, 0)
+        # Re-add the batch dimension. Boxes are sorted by batch, so this
+        # splits them back into [batch, num_boxes, height, width, channels]
+        shape = [tf.shape(boxes)[0], tf.shape(boxes)[1]] + \
+            list(self.pool_shape) + [tf.shape(pooled)[3]]
+        pooled = tf.reshape(pooled, shape)
         return pooled
 
     def compute_output_shape(self, input_shape):
@@ -669,9 +725,12 @@ def refine_detections(rois, probs, deltas, window, config):
         # Pick detections of this class
         ixs = np.where(pre_nms_class_ids == class_id)[0]
         # Apply NMS
+        # No more than DETECTION_MAX_INSTANCES of a class can make it into
+        # the top detections, so stop NMS there.
         class_keep = utils.non_max_suppression(
             pre_nms_rois[ixs], pre_nms_scores[ixs],
-            config.DETECTION_NMS_THRESHOLD)
+            config.DETECTION_NMS_THRESHOLD,
+            max_output_size=config.DETECTION_MAX_INSTANCES)
         # Map indicies
         class_keep = keep[ixs[class_keep]]
         nms_keep = np.union1d(nms_keep, class_keep)
@@ -690,6 +749,29 @@ def refine_detections(rois, probs, deltas, window, config):
     return result
 
 
+def build_detections(rois, mrcnn_class, mrcnn_bbox, windows, config):
+    """Runs refine_detections() on each image of a batch and packs the
+    results into one zero padded array.
+
+    rois: [batch, N, (y1, x1, y2, x2)] in normalized coordinates
+    mrcnn_class: [batch, N, num_classes]. Class probabilities.
+    mrcnn_bbox: [batch, N, num_classes, (dy, dx, log(dh), log(dw))]
+    windows: [batch, (y1, x1, y2, x2)] in image coordinates.
+
+    Returns: [batch, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
+    in pixels.
+    """
+    batch_detections = np.zeros(
+        [rois.shape[0], config.DETECTION_MAX_INSTANCES, 6], dtype=np.float32)
+    for b in range(rois.shape[0]):
+        detections = refine_detections(
+            rois[b], mrcnn_class[b], mrcnn_bbox[b], windows[b], config)
+        # Remaining rows stay zero if detections < DETECTION_MAX_INSTANCES
+        assert detections.shape[0] <= config.DETECTION_MAX_INSTANCES
+        batch_detections[b, :detections.shape[0]] = detections
+    return batch_detections
+
+
 class DetectionLayer(KE.Layer):
     """Takes classified proposal boxes and their bounding box deltas and
     returns the final detection boxes.
@@ -705,26 +787,9 @@ class DetectionLayer(KE.Layer):
 
     def call(self, inputs):
         def wrapper(rois, mrcnn_class, mrcnn_bbox, image_meta):
-            # currently supports one image per batch
-            b = 0
-            _, _, window, _ = parse_image_meta(image_meta)
-            detections = refine_detections(
-                rois[b], mrcnn_class[b], mrcnn_bbox[b], window[b], self.config)
-            # Pad with zeros if detections < DETECTION_MAX_INSTANCES
-            gap = self.config.DETECTION_MAX_INSTANCES - detections.shape[0]
-            assert gap >= 0
-            if gap > 0:
-                detections = np.pad(detections, [(0, gap), (0, 0)],
-                                    'constant', constant_values=0)
-
-            # Cast to float32
-            # TODO: track where float64 is introduced
-            detections = detections.astype(np.float32)
-
-            # Reshape output
-            # [batch, num_detections, (y1, x1, y2, x2, class_score)] in pixels
-            return np.reshape(detections,
-                              [1, self.config.DETECTION_MAX_INSTANCES, 6])
+            _, _, windows, _ = parse_image_meta(image_meta)
+            return build_detections(rois, mrcnn_class, mrcnn_bbox, windows,
+                                    self.config)
 
         # Return wrapped function
         return tf.py_func(wrapper, inputs, tf.float32)
@@ -853,8 +918,10 @@ def fpn_classifier_graph(rois, feature_maps,
     x = KL.TimeDistributed(KL.Dense(num_classes*4, activation='linear'),
                            name='mrcnn_bbox_fc')(shared)
     # Reshape to [batch, boxes, num_classes, (dy, dx, log(dh), log(dw))]
-    s = K.int_shape(x)
-    mrcnn_bbox = KL.Reshape((s[1], num_classes, 4), name="mrcnn_bbox")(x)
+    # The number of boxes might only be known at runtime.
+    mrcnn_bbox = KL.Lambda(
+        lambda t: tf.reshape(t, [tf.shape(t)[0], -1, num_classes, 4]),
+        name="mrcnn_bbox")(x)
 
     return mrcnn_class_logits, mrcnn_probs, mrcnn_bbox
 
@@ -1111,14 +1178,13 @@ def load_image_gt(dataset, config, image_id, augment=False,
     """
     # Load image and mask
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
     shape = image.shape
     image, window, scale, padding = utils.resize_image(
         image, 
         min_dim=config.IMAGE_MIN_DIM, 
         max_dim=config.IMAGE_MAX_DIM,
         padding=config.IMAGE_PADDING)
-    mask = utils.resize_mask(mask, scale, padding)
+    mask, class_ids = dataset.load_mask_resized(image_id, scale, padding)
 
     # Random horizontal flips.
     if augment:
@@ -1181,15 +1247,8 @@ def build_detection_targets(rpn_rois, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
-
     # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i][:4]
-        overlaps[:,i] = utils.compute_iou(gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes[:, :4])
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1263,62 +1322,94 @@ def build_detection_targets(rpn_rois, gt_boxes, gt_masks, config):
     # Generate class-specific target masks.
     masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES), 
                      dtype=np.float32)
-    for i in pos_ids:
-        class_id = class_ids[i]
-        assert class_id > 0, "class id must be greater than 0"
-        gt_id = roi_gt_assignment[i]
-        class_mask = gt_masks[:, :, gt_id]
-        
-        if config.USE_MINI_MASK:
-            # Create a mask placeholder, the size of the image
-            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
-            # GT box
-            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id][:4]
-            gt_w = gt_x2 - gt_x1
-            gt_h = gt_y2 - gt_y1
-            # Resize mini mask to size of GT box
-            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
-                np.round(scipy.misc.imresize(class_mask.astype(float), (gt_h, gt_w), 
-                                             interp='nearest') / 255.0).astype(bool)
-            # Place the mini batch in the placeholder
-            class_mask = placeholder
-            
-        # Pick part of the mask and resize it
-        y1, x1, y2, x2 = rois[i][:4].astype(np.int32)
-        m = class_mask[y1:y2, x1:x2]
-        mask = scipy.misc.imresize(m.astype(float), config.MASK_SHAPE, interp='nearest') / 255.0
-        masks[i,:,:,class_id] = mask
-        
+    # Crop the part of the GT mask under each positive ROI and resize it.
+    # Mini-masks are mapped through their GT box, so there is no need to
+    # expand them to full size first.
+    masks[pos_ids, :, :, class_ids[pos_ids]] = utils.crop_and_resize_masks(
+        gt_masks, rois[pos_ids], roi_gt_assignment[pos_ids], config.MASK_SHAPE,
+        mini_mask_boxes=gt_boxes[:, :4] if config.USE_MINI_MASK else None)
+
     return rois, class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_boxes, config):
+def match_anchors_sparse(num_anchors, gt_boxes, anchor_grid):
+    """Finds the best GT box of each anchor and the best anchor of each GT
+    box from the sparse overlaps of an AnchorGrid. Gives the same results as
+    np.argmax() over the dense overlaps matrix, including how ties and
+    anchors or GT boxes without any overlap are resolved.
+
+    Returns:
+    anchor_iou_argmax: [num_anchors] index of the GT box with the highest IoU.
+    anchor_iou_max: [num_anchors] the highest IoU of each anchor.
+    gt_iou_argmax: [num_gt_boxes] index of the anchor with the highest IoU.
+    """
+    anchor_ids, gt_ids, ious = anchor_grid.overlaps(gt_boxes[:, :4])
+
+    # argmax returns the first of equal values, and index 0 if all are 0.
+    # So take the max IoU of each anchor, and then the lowest GT index that
+    # has it. And the same for GT boxes.
+    anchor_iou_max = np.zeros([num_anchors])
+    np.maximum.at(anchor_iou_max, anchor_ids, ious)
+    best = ious == anchor_iou_max[anchor_ids]
+    anchor_iou_argmax = np.full([num_anchors], gt_boxes.shape[0], dtype=np.int64)
+    np.minimum.at(anchor_iou_argmax, anchor_ids[best], gt_ids[best])
+    anchor_iou_argmax[anchor_iou_max == 0] = 0
+
+    gt_iou_max = np.zeros([gt_boxes.shape[0]])
+    np.maximum.at(gt_iou_max, gt_ids, ious)
+    best = ious == gt_iou_max[gt_ids]
+    gt_iou_argmax = np.full([gt_boxes.shape[0]], num_anchors, dtype=np.int64)
+    np.minimum.at(gt_iou_argmax, gt_ids[best], anchor_ids[best])
+    gt_iou_argmax[gt_iou_max == 0] = 0
+    return anchor_iou_argmax, anchor_iou_max, gt_iou_argmax
+
+
+def build_rpn_targets(image_shape, anchors, gt_boxes, config, anchor_grid=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2, class_id)]
+    anchor_grid: Optional utils.AnchorGrid of the same anchors. If provided,
+        only the IoU of anchors near each GT box is computed. The targets are
+        the same either way, but this is much faster with many anchors.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    rpn_match, anchor_iou_argmax = match_rpn_anchors(anchors, gt_boxes, anchor_grid)
+    return sample_rpn_targets(anchors, gt_boxes, rpn_match, anchor_iou_argmax, config)
+
+
+def match_rpn_anchors(anchors, gt_boxes, anchor_grid=None):
+    """Matches anchors to GT boxes. This is the first half of
+    build_rpn_targets(), which only depends on the boxes. The random
+    subsampling is done by sample_rpn_targets().
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2, class_id)]
+    anchor_grid: Optional utils.AnchorGrid of the same anchors.
+
+    Returns:
+    rpn_match: [N] (int32) 1 = positive anchor, -1 = negative anchor, 0 = neutral
+    anchor_iou_argmax: [N] index of the GT box with the highest IoU with
+        each anchor.
+    """
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
 
-    # Areas of anchors and GT boxes
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
-    anchor_area = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
-
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    # Each cell contains the IoU of an anchor and GT box.
-    overlaps = np.zeros((anchors.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i][:4]
-        overlaps[:,i] = utils.compute_iou(gt, anchors, gt_box_area[i], anchor_area)
+    if anchor_grid is not None:
+        anchor_iou_argmax, anchor_iou_max, gt_iou_argmax = \
+            match_anchors_sparse(anchors.shape[0], gt_boxes, anchor_grid)
+    else:
+        # Compute overlaps [num_anchors, num_gt_boxes]
+        # Each cell contains the IoU of an anchor and GT box.
+        overlaps = utils.compute_overlaps(anchors, gt_boxes[:, :4])
+        anchor_iou_argmax = np.argmax(overlaps, axis=1)
+        anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+        gt_iou_argmax = np.argmax(overlaps, axis=0)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1329,15 +1420,27 @@ def build_rpn_targets(image_shape, anchors, gt_boxes, config):
     # match it to the closest anchor (even if its max IoU is < 0.3).
     #
     # 1. Set negative anchors first. It gets overwritten if a gt box is matched to them.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[anchor_iou_max < 0.3] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
+    return rpn_match, anchor_iou_argmax
+
+
+def sample_rpn_targets(anchors, gt_boxes, rpn_match, anchor_iou_argmax, config):
+    """Subsamples the matches of match_rpn_anchors() to balance positive
+    and negative anchors, and computes the deltas of the positive anchors.
+    This is the second half of build_rpn_targets().
+
+    rpn_match: [N] matches from match_rpn_anchors(). Modified in place.
+    anchor_iou_argmax: [N] GT box of each anchor from match_rpn_anchors().
+
+    Returns the same as build_rpn_targets().
+    """
+    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
 
     # Subsample to balance positive and negative anchors
     # Don't let positives be more than half the anchors
@@ -1358,109 +1461,90 @@ def build_rpn_targets(image_shape, anchors, gt_boxes, config):
     # For positive anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinment() rather that duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i], :4]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    # Closest gt box (it might have IoU < 0.7)
+    gt = gt_boxes[anchor_iou_argmax[ids], :4]
+    a = anchors[ids]
+
+    # Convert coordinates to center plus width/height.
+    # This is box_refinement() in float64 rather than float32, so that the
+    # targets don't lose precision.
+    # GT Box
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    # Anchor
+    a_h = a[:, 2] - a[:, 0]
+    a_w = a[:, 3] - a[:, 1]
+    a_center_y = a[:, 0] + 0.5 * a_h
+    a_center_x = a[:, 1] + 0.5 * a_w
+
+    # Compute the bbox refinement that the RPN should predict.
+    rpn_bbox[:ids.shape[0]] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    # Normalize
+    rpn_bbox[:ids.shape[0]] /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
 
-def generate_random_rois(image_shape, count, gt_boxes):
+def generate_random_rois(image_shape, count, gt_boxes, random_state=None):
     """Generates ROI proposals similar to what a region proposal network
     would generate.
 
     image_shape: [Height, Width, Depth]
     count: Number of ROIs to generate
     gt_boxes: [N, (y1, x1, y2, x2, class_id)] Ground trugh boxes in pixels.
+    random_state: Optional np.random.RandomState for reproducible ROIs.
+        Uses the global numpy random state by default.
 
     Returns: [count, (y1, x1, y2, x2)] ROI boxes in pixels.
     """
-    # placeholder
-    rois = np.zeros((count, 4), dtype=np.int32)
-    
+    if random_state is None:
+        random_state = np.random
+
     # Generate random ROIs around GT boxes (90% of count)
     rois_per_box = int(0.9 * count / gt_boxes.shape[0])
-    for i in range(gt_boxes.shape[0]):
-        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i,:4]
-        h = gt_y2 - gt_y1
-        w = gt_x2 - gt_x1
-        # random boundaries
-        r_y1 = max(gt_y1-h, 0)
-        r_y2 = min(gt_y2+h, image_shape[0])
-        r_x1 = max(gt_x1-w, 0)
-        r_x2 = min(gt_x2+w, image_shape[1])
-        
-        # To avoid generating boxes with zero area, we generate double what
-        # we need and filter out the extra. If we get fewer valid boxes 
-        # than we need, we loop and try again.
-        while True:
-            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box*2, 2))
-            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box*2, 2))
-            # Filter out zero area boxes
-            threshold = 1
-            y1y2 = y1y2[np.abs(y1y2[:,0] - y1y2[:,1]) >= threshold][:rois_per_box]
-            x1x2 = x1x2[np.abs(x1x2[:,0] - x1x2[:,1]) >= threshold][:rois_per_box]
-            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
-                break
-        
-        # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-        # into x1, y1, x2, y2 order
-        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-        box_rois = np.hstack([y1, x1, y2, x2])
-        rois[rois_per_box*i:rois_per_box*(i+1)] = box_rois
-    
+    gt_y1, gt_x1, gt_y2, gt_x2 = np.split(gt_boxes[:, :4].astype(np.int64), 4, axis=1)
+    h = gt_y2 - gt_y1
+    w = gt_x2 - gt_x1
     # Generate random ROIs anywhere in the image (10% of count)
     remaining_count = count - (rois_per_box * gt_boxes.shape[0])
-    # To avoid generating boxes with zero area, we generate double what
-    # we need and filter out the extra. If we get fewer valid boxes 
-    # than we need, we loop and try again.
-    while True:
-        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
-        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
-        # Filter out zero area boxes
-        threshold = 1
-        y1y2 = y1y2[np.abs(y1y2[:,0] - y1y2[:,1]) >= threshold][:remaining_count]
-        x1x2 = x1x2[np.abs(x1x2[:,0] - x1x2[:,1]) >= threshold][:remaining_count]
-        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
-            break
-    
-    # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-    # into x1, y1, x2, y2 order
-    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-    global_rois = np.hstack([y1, x1, y2, x2])
-    rois[-remaining_count:] = global_rois
-    return rois
+
+    # Range [lo, hi) of the coordinates of each ROI. Around GT boxes first,
+    # then the whole image.
+    def ranges(lo, hi, size):
+        lo = np.concatenate([np.repeat(np.maximum(lo, 0), rois_per_box),
+                             np.zeros([remaining_count], dtype=np.int64)])
+        hi = np.concatenate([np.repeat(np.minimum(hi, size), rois_per_box),
+                             np.full([remaining_count], size, dtype=np.int64)])
+        # A range needs two values for a box with non-zero area. Use the
+        # whole image for the rare GT boxes that don't have that.
+        narrow = hi - lo < 2
+        return np.where(narrow, 0, lo), np.where(narrow, size, hi)
+
+    def random_pairs(lo, hi):
+        """Picks two different integers in [lo, hi), uniformly, and returns
+        them sorted. Same as drawing pairs until they differ, without the
+        loop: pick the second from the n - 1 values left after the first.
+        """
+        n = hi - lo
+        a = lo + np.floor(random_state.random_sample(n.shape) * n).astype(np.int64)
+        b = lo + np.floor(random_state.random_sample(n.shape) * (n - 1)).astype(np.int64)
+        b += b >= a
+        return np.minimum(a, b), np.maximum(a, b)
+
+    y1, y2 = random_pairs(*ranges(gt_y1 - h, gt_y2 + h, image_shape[0]))
+    x1, x2 = random_pairs(*ranges(gt_x1 - w, gt_x2 + w, image_shape[1]))
+    return np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
 
 
 def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
-                   batch_size=1, detection_targets=False):
+                   batch_size=1, detection_targets=False, target_cache=None):
     """A generator that returns images and corresponding target class ids, 
     bounding box deltas, and masks.
 
@@ -1476,6 +1560,8 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
     detection_targets: If True, generate detection targets (class IDs, bbox
         deltas, and masks). Typically for debugging or visualizations because
         in trainig detection targets are generated by DetectionTargetLayer.
+    target_cache: Optional TargetCache of the dataset to read the images and
+        targets from, rather than building them.
 
     Returns a Python generator. Upon calling next() on it, the 
     generator returns two lists, inputs and outputs. The containtes
@@ -1501,11 +1587,12 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, 
-                                              config.RPN_ANCHOR_RATIOS,
-                                              config.BACKBONE_SHAPES,
-                                              config.BACKBONE_STRIDES, 
-                                              config.RPN_ANCHOR_STRIDE)
+    anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                   config.RPN_ANCHOR_RATIOS,
+                                   config.BACKBONE_SHAPES,
+                                   config.BACKBONE_STRIDES,
+                                   config.RPN_ANCHOR_STRIDE)
+    anchors = anchor_grid.anchors
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -1517,17 +1604,25 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
 
             # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
-            image, image_meta, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment, use_mini_mask=config.USE_MINI_MASK)
-            
-            # Skip images that have no instances. This can happen in cases 
-            # where we train on a subset of classes and the image doesn't
-            # have any of the classes we care about.
-            if np.sum(gt_boxes) <= 0:
-                continue
+            if target_cache is not None:
+                # Cached images and RPN targets. None if no instances.
+                sample = target_cache.load(image_id, augment=augment)
+                if sample is None:
+                    continue
+                image, image_meta, gt_boxes, gt_masks, rpn_match, rpn_bbox = sample
+            else:
+                image, image_meta, gt_boxes, gt_masks = \
+                    load_image_gt(dataset, config, image_id, augment=augment, use_mini_mask=config.USE_MINI_MASK)
+
+                # Skip images that have no instances. This can happen in cases
+                # where we train on a subset of classes and the image doesn't
+                # have any of the classes we care about.
+                if np.sum(gt_boxes) <= 0:
+                    continue
 
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors, gt_boxes, config)
+                # RPN Targets
+                rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors, gt_boxes, config,
+                                                        anchor_grid=anchor_grid)
 
             # Mask R-CNN Targets
             if random_rois:
@@ -1609,6 +1704,426 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
 
 
 
+def load_sample(dataset, config, image_id, anchor_grid, augment=False,
+                target_cache=None):
+    """Loads an image and builds the RPN training targets for it. This is
+    what data_generator() does for each image when it's not generating
+    random ROIs.
+    anchor_grid: utils.AnchorGrid of the network anchors.
+    target_cache: Optional TargetCache to read the image and targets from.
+
+    Returns None if the image has no instances. Otherwise returns:
+    image: [height, width, 3] resized image
+    image_meta: image attributes. See compose_image_meta()
+    rpn_match: [N] matches between anchors and GT boxes
+    rpn_bbox: [RPN_TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))]
+    gt_boxes: [instance count, (y1, x1, y2, x2, class_id)]. At most
+        MAX_GT_INSTANCES.
+    gt_masks: [height, width, instance count]
+    """
+    if target_cache is not None:
+        sample = target_cache.load(image_id, augment=augment)
+        if sample is None:
+            return None
+        image, image_meta, gt_boxes, gt_masks, rpn_match, rpn_bbox = sample
+    else:
+        image, image_meta, gt_boxes, gt_masks = \
+            load_image_gt(dataset, config, image_id, augment=augment,
+                          use_mini_mask=config.USE_MINI_MASK)
+
+        # Skip images that have no instances.
+        if np.sum(gt_boxes) <= 0:
+            return None
+
+        # RPN Targets
+        rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchor_grid.anchors,
+                                                gt_boxes, config, anchor_grid=anchor_grid)
+
+    # If more instances than fits in the array, sub-sample from them.
+    if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+        ids = np.random.choice(np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+        gt_boxes = gt_boxes[ids]
+        gt_masks = gt_masks[:, :, ids]
+
+    return image, image_meta, rpn_match, rpn_bbox, gt_boxes, gt_masks
+
+
+def data_loader_worker(dataset, config, anchor_grid, augment, target_cache,
+                       buffers, tasks, results, seed):
+    """Worker process of DataLoader. Builds the samples it receives from
+    the tasks queue and writes them directly into the shared batch arrays.
+
+    buffers: (RawArray, shape, dtype) of each batch array. The RawArrays
+        are passed rather than NumPy views of them, because views would be
+        pickled as copies when processes are spawned instead of forked.
+
+    Tasks are (slot, batch item, image_id) tuples, or None to stop. For
+    each task it puts (slot, batch item, status) in the results queue,
+    where status is "ok", "empty" or "error".
+    """
+    # Forked workers inherit the random state. Re-seed so they don't all
+    # make the same augmentation and sampling choices.
+    np.random.seed(seed)
+    random.seed(seed)
+
+    images, image_metas, rpn_matches, rpn_bboxes, gt_boxes, gt_masks = \
+        [np.frombuffer(buffer, dtype=dtype).reshape(shape)
+         for buffer, shape, dtype in buffers]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, b, image_id = task
+        try:
+            sample = load_sample(dataset, config, image_id, anchor_grid, augment,
+                                 target_cache)
+            if sample is None:
+                results.put((slot, b, "empty"))
+                continue
+            image, image_meta, rpn_match, rpn_bbox, boxes, masks = sample
+
+            np.subtract(image, config.MEAN_PIXEL, out=images[slot, b],
+                        casting="unsafe")
+            image_metas[slot, b] = image_meta
+            rpn_matches[slot, b, :, 0] = rpn_match
+            rpn_bboxes[slot, b] = rpn_bbox
+            gt_boxes[slot, b] = 0
+            gt_boxes[slot, b, :boxes.shape[0]] = boxes
+            gt_masks[slot, b] = False
+            gt_masks[slot, b, :, :, :masks.shape[-1]] = masks
+            results.put((slot, b, "ok"))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            logging.exception("Error processing image {}".format(dataset.image_info[image_id]))
+            results.put((slot, b, "error"))
+
+
+class DataLoader():
+    """Builds training batches in several worker processes. A faster
+    alternative to data_generator() for training.
+
+    Batches are assembled in place in shared memory: the image IDs of each
+    batch are split between the workers, and each worker writes its samples
+    directly into its rows of a batch slot. Batches are returned as views
+    of the slots, so nothing is pickled or copied on the way to the model.
+
+    A slot is reused num_slots batches after it's returned, so consumers
+    must be done with a batch by then. When passed to fit_generator(),
+    use workers=1, use_multiprocessing=False and a max_queue_size of at
+    most queue_size.
+
+    Only the standard training inputs are supported (no random ROIs or
+    detection targets). The outputs list of each batch is empty.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augment=True,
+                 batch_size=1, processes=4, prefetch=2, queue_size=2,
+                 target_cache=None):
+        """
+        dataset: The Dataset object to pick data from
+        config: The model config object
+        shuffle: If True, shuffles the samples before every epoch
+        augment: If True, applies image augmentation to images (currently only
+                 horizontal flips are supported)
+        batch_size: How many images to return in each call
+        processes: Number of worker processes
+        prefetch: Number of batches the workers build ahead of the consumer
+        queue_size: Number of returned batches the consumer might still hold
+            on to, e.g. the max_queue_size of fit_generator()
+        target_cache: Optional TargetCache to read images and targets from
+        """
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.num_slots = queue_size + 2 + prefetch
+        self.image_ids = np.copy(dataset.image_ids)
+        self.image_index = -1
+        self.error_count = 0
+
+        # Anchors
+        # [anchor_count, (y1, x1, y2, x2)]
+        anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                       config.RPN_ANCHOR_RATIOS,
+                                       config.BACKBONE_SHAPES,
+                                       config.BACKBONE_STRIDES,
+                                       config.RPN_ANCHOR_STRIDE)
+        anchors = anchor_grid.anchors
+
+        # Shared batch arrays. [slot, batch item, ...]
+        if config.USE_MINI_MASK:
+            mask_shape = tuple(config.MINI_MASK_SHAPE)
+        else:
+            mask_shape = tuple(config.IMAGE_SHAPE[:2])
+        meta_size = 1 + 3 + 4 + dataset.num_classes
+        shapes = [
+            (tuple(config.IMAGE_SHAPE), np.float32),
+            ((meta_size,), np.float64),
+            ((anchors.shape[0], 1), np.int32),
+            ((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), np.float64),
+            ((config.MAX_GT_INSTANCES, 5), np.int32),
+            (mask_shape + (config.MAX_GT_INSTANCES,), np.bool_),
+        ]
+        self.buffers = []
+        self.arrays = []
+        for shape, dtype in shapes:
+            shape = (self.num_slots, batch_size) + shape
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            buffer = multiprocessing.RawArray(ctypes.c_byte, size)
+            self.buffers.append((buffer, shape, dtype))
+            self.arrays.append(np.frombuffer(buffer, dtype=dtype).reshape(shape))
+
+        # Workers
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for i in range(processes):
+            worker = multiprocessing.Process(
+                target=data_loader_worker,
+                args=(dataset, config, anchor_grid, augment, target_cache, self.buffers,
+                      self.tasks, self.results, np.random.randint(2**31)))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        # Number of completed samples in each slot
+        self.filled = [0] * self.num_slots
+        self.slot = 0
+        for slot in range(prefetch):
+            self.fill(slot)
+
+    def next_image_id(self):
+        """Returns the next image ID. Shuffles at the start of an epoch."""
+        self.image_index = (self.image_index + 1) % len(self.image_ids)
+        if self.shuffle and self.image_index == 0:
+            np.random.shuffle(self.image_ids)
+        return self.image_ids[self.image_index]
+
+    def fill(self, slot):
+        """Sends the samples of the given batch slot to the workers."""
+        self.filled[slot] = 0
+        for b in range(self.batch_size):
+            self.tasks.put((slot, b, self.next_image_id()))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        slot = self.slot
+        # Schedule the batch after the prefetched ones
+        self.fill((slot + self.prefetch) % self.num_slots)
+
+        # Wait for the workers to complete the batch
+        while self.filled[slot] < self.batch_size:
+            try:
+                done_slot, b, status = self.results.get(timeout=1)
+            except queue.Empty:
+                # Workers that exit, e.g. killed for using too much memory,
+                # never report their samples.
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise Exception("Data loader worker exited with code {}".format(
+                            worker.exitcode))
+                continue
+            if status == "ok":
+                self.filled[done_slot] += 1
+                continue
+            if status == "error":
+                self.error_count += 1
+                if self.error_count > 5:
+                    raise Exception("Too many errors in data loader workers")
+            # Replace images that failed or have no instances
+            self.tasks.put((done_slot, b, self.next_image_id()))
+
+        self.slot = (slot + 1) % self.num_slots
+        inputs = [a[slot] for a in self.arrays]
+        outputs = []
+        return inputs, outputs
+
+    # Python 2 style iterator, as used by Keras
+    next = __next__
+
+    def close(self):
+        """Stops the worker processes."""
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+############################################################
+#  Training Target Cache
+############################################################
+
+# Config attributes that change the cached targets. The rest, such as
+# RPN_TRAIN_ANCHORS_PER_IMAGE or MAX_GT_INSTANCES, are applied when reading.
+TARGET_CACHE_CONFIG_KEYS = [
+    "IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_PADDING",
+    "USE_MINI_MASK", "MINI_MASK_SHAPE",
+    "BACKBONE_STRIDES", "RPN_ANCHOR_SCALES", "RPN_ANCHOR_RATIOS",
+    "RPN_ANCHOR_STRIDE",
+]
+TARGET_CACHE_VERSION = 2
+
+
+def target_cache_key(dataset, config):
+    """Returns a hash of the config attributes and dataset classes that the
+    cached targets depend on. The images are checked one at a time, see
+    TargetCache.
+    """
+    values = {k: np.array(getattr(config, k)).tolist()
+              for k in TARGET_CACHE_CONFIG_KEYS}
+    values["version"] = TARGET_CACHE_VERSION
+    values["classes"] = [[info["source"], str(info["id"])]
+                         for info in dataset.class_info]
+    return hashlib.md5(json.dumps(values, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class TargetCache(object):
+    """Caches the training inputs of a dataset on disk: resized images,
+    image meta, GT boxes, masks and the anchor matches of the RPN targets.
+    Without augmentation they are the same in every epoch, so they're
+    built once and read back after that. Only the random subsampling of
+    RPN anchors is redone for every sample.
+
+    The cache is filled lazily. The first time an image is loaded its
+    targets are built and written to a file, one image at a time, so
+    there's no upfront build and memory use doesn't grow with the dataset.
+    Files are written under a new name and then renamed, so data loader
+    processes can share a cache.
+
+    Files are in a sub-directory of cache_dir named after
+    target_cache_key(), and named after Dataset.annotation_key() of their
+    image. Changing the relevant config attributes, the classes or the
+    annotations of an image builds new files. Old ones aren't deleted.
+
+    Each image takes IMAGE_SHAPE bytes, about 3 MB at 1024x1024, so make
+    sure there is enough space. Horizontal flips are applied when reading,
+    and the anchors are matched again for flipped images.
+    """
+
+    def __init__(self, cache_dir, dataset, config):
+        self.dataset = dataset
+        self.config = config
+        self.path = os.path.join(cache_dir, target_cache_key(dataset, config))
+        self.anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                            config.RPN_ANCHOR_RATIOS,
+                                            config.BACKBONE_SHAPES,
+                                            config.BACKBONE_STRIDES,
+                                            config.RPN_ANCHOR_STRIDE)
+
+    def image_file(self, image_id):
+        return os.path.join(self.path, self.dataset.annotation_key(image_id) + ".npz")
+
+    def build(self, image_ids=None, verbose=1):
+        """Caches the images that aren't cached yet. Optional, load()
+        caches images as they're used.
+        image_ids: Images to cache. Defaults to all of them.
+        """
+        if image_ids is None:
+            image_ids = self.dataset.image_ids
+        for i, image_id in enumerate(image_ids):
+            if verbose and i % 1000 == 0:
+                log("Caching targets: image {}/{} in {}".format(
+                    i + 1, len(image_ids), self.path))
+            path = self.image_file(image_id)
+            if not os.path.exists(path):
+                self.save(path, self.build_image(image_id))
+
+    def build_image(self, image_id):
+        """Builds the cached arrays of an image. Returns a dict of arrays."""
+        anchors = self.anchor_grid.anchors
+        image, image_meta, gt_boxes, gt_masks = \
+            load_image_gt(self.dataset, self.config, image_id,
+                          use_mini_mask=self.config.USE_MINI_MASK)
+        if np.sum(gt_boxes) > 0:
+            rpn_match, anchor_iou_argmax = match_rpn_anchors(
+                anchors, gt_boxes, self.anchor_grid)
+            positive_ids = np.where(rpn_match == 1)[0]
+            neutral_ids = np.where(rpn_match == 0)[0]
+        else:
+            positive_ids = neutral_ids = np.zeros([0], dtype=np.int64)
+            anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+        return {
+            "image": image,
+            "image_meta": image_meta.astype(np.int32),
+            "gt_boxes": gt_boxes.astype(np.int32),
+            "gt_masks": gt_masks,
+            "positive_ids": positive_ids.astype(np.int32),
+            "positive_gt_ids": anchor_iou_argmax[positive_ids].astype(np.int32),
+            "neutral_ids": neutral_ids.astype(np.int32),
+        }
+
+    def save(self, path, arrays):
+        """Writes the arrays of an image to a temporary file and renames it,
+        so other processes never read a partial file. The cache is only an
+        optimization, so write errors, such as a full disk, are ignored.
+        """
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temp_path, path)
+        except (IOError, OSError):
+            log("Can't write target cache file {}".format(path))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def load(self, image_id, augment=False):
+        """Loads the cached inputs of an image and samples its RPN targets.
+        Builds and caches them first if they aren't cached.
+
+        augment: If True, flips the image horizontally half of the time.
+
+        Returns None if the image has no instances. Otherwise, returns the
+        same as load_image_gt() followed by the rpn_match and rpn_bbox of
+        build_rpn_targets().
+        """
+        path = self.image_file(image_id)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                arrays = {name: cached[name] for name in cached.files}
+        else:
+            arrays = self.build_image(image_id)
+            self.save(path, arrays)
+
+        gt_boxes = arrays["gt_boxes"]
+        if np.sum(gt_boxes) <= 0:
+            return None
+        image = arrays["image"]
+        image_meta = arrays["image_meta"]
+        gt_masks = arrays["gt_masks"]
+        anchors = self.anchor_grid.anchors
+
+        if augment and random.randint(0, 1):
+            # Flip the image and boxes, and match the anchors again because
+            # they aren't symmetric around the image center.
+            image = np.fliplr(image)
+            gt_masks = np.fliplr(gt_masks)
+            width = image.shape[1]
+            empty = np.all(gt_boxes[:, :4] == 0, axis=1)
+            gt_boxes[:, 1], gt_boxes[:, 3] = width - gt_boxes[:, 3], width - gt_boxes[:, 1]
+            gt_boxes[empty, :4] = 0
+            rpn_match, anchor_iou_argmax = match_rpn_anchors(
+                anchors, gt_boxes, self.anchor_grid)
+        else:
+            rpn_match = np.full([anchors.shape[0]], -1, dtype=np.int32)
+            rpn_match[arrays["neutral_ids"]] = 0
+            positive_ids = arrays["positive_ids"]
+            rpn_match[positive_ids] = 1
+            anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+            anchor_iou_argmax[positive_ids] = arrays["positive_gt_ids"]
+
+        rpn_match, rpn_bbox = sample_rpn_targets(anchors, gt_boxes, rpn_match,
+                                                 anchor_iou_argmax, self.config)
+        return image, image_meta, gt_boxes, gt_masks, rpn_match, rpn_bbox
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1629,7 +2144,18 @@ class MaskRCNN():
         self.mode = mode
         self.config = config
         self.model_dir = model_dir
+        # Path of the last weights loaded by load_weights()
+        self.weights_path = None
         self.set_log_dir()
+
+        # Apply the threading and affinity settings before the graph is
+        # built. This replaces the Keras session, so it's only done if the
+        # config asks for it.
+        set_cpu_affinity(config)
+        tf_config = session_config(config)
+        if tf_config is not None:
+            K.set_session(tf.Session(config=tf_config))
+
         self.keras_model = self.build(mode=mode, config=config)
 
     def build(self, mode, config):
@@ -1731,11 +2257,15 @@ class MaskRCNN():
         # Proposals are [N, (y1, x1, y2, x2)] in normalized coordinates.
         proposal_count = config.POST_NMS_ROIS_TRAINING if mode == "training"\
                          else config.POST_NMS_ROIS_INFERENCE
+        # In inference, the proposal count can be lowered at runtime. The
+        # training heads expect a fixed number of proposals.
         rpn_rois = ProposalLayer(proposal_count=proposal_count,
-                                 nms_threshold=0.7,
+                                 nms_threshold=config.RPN_NMS_THRESHOLD,
                                  name="ROI",
                                  anchors=self.anchors,
-                                 config=config)([rpn_class, rpn_bbox])
+                                 config=config,
+                                 pre_nms_limit=config.PRE_NMS_LIMIT,
+                                 dynamic=mode == "inference")([rpn_class, rpn_bbox])
 
         if mode == "training":
             # Class ID mask to mark class IDs supported by the dataset the image
@@ -1861,13 +2391,14 @@ class MaskRCNN():
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exlude: list of layer names to excluce
+
+        The weights of the ROI layer are the proposal settings, which come
+        from the config (see set_proposal_params()), so they're never
+        loaded. Files that have them are loaded by layer name.
         """
         import h5py
         from keras.engine import topology
 
-        if exclude:
-            by_name = True
-
         if h5py is None:
             raise ImportError('`load_weights` requires h5py.')
         f = h5py.File(filepath, mode='r')
@@ -1882,8 +2413,14 @@ class MaskRCNN():
 
         # Exclude some layers
         if exclude:
+            by_name = True
             layers = filter(lambda l: l.name not in exclude, layers)
-        
+        proposal_layers = [l.name for l in layers if isinstance(l, ProposalLayer)]
+        layers = [l for l in layers if l.name not in proposal_layers]
+        if any(len(f[name].attrs['weight_names']) for name in proposal_layers
+               if name in f):
+            by_name = True
+
         if by_name:
             topology.load_weights_from_hdf5_group_by_name(f, layers)
         else:
@@ -1893,6 +2430,7 @@ class MaskRCNN():
 
         # Update the log directory
         self.set_log_dir(filepath)
+        self.weights_path = filepath
 
     def get_imagenet_weights(self):
         """Downloads ImageNet trained weights from Keras.
@@ -1908,6 +2446,67 @@ class MaskRCNN():
                                 md5_hash='a268eb855778b3df3c7506639542a6af')
         return weights_path
         
+    def export_frozen_graph(self, filepath):
+        """Saves the inference graph and its current weights to a single
+        frozen GraphDef file. Variables are converted to constants and,
+        if the TF graph transforms are available, constant sub-graphs are
+        folded. Load the file with FrozenMaskRCNN to skip building the
+        Keras model and loading the HDF5 weights.
+
+        The detection layer runs in Python (tf.py_func) and can't be
+        serialized, so the names of the tensors around it are stored in
+        the graph as well. FrozenMaskRCNN runs the refinement in Numpy and
+        feeds the detections back into the mask head.
+
+        Variables, including the proposal settings of set_proposal_params(),
+        are saved with their current values and can't be changed later.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        from tensorflow.python.framework import graph_util
+        try:
+            from tensorflow.tools.graph_transforms import TransformGraph
+        except ImportError:
+            TransformGraph = None
+
+        keras_model = self.keras_model
+        outputs = keras_model.outputs
+        # Tensors FrozenMaskRCNN feeds or fetches
+        tensors = {
+            "input_image": keras_model.inputs[0],
+            "input_image_meta": keras_model.inputs[1],
+            "rpn_rois": outputs[4],
+            "mrcnn_class": outputs[1],
+            "mrcnn_bbox": outputs[2],
+            "detections": outputs[0],
+            "mrcnn_mask": outputs[3],
+        }
+        for level in range(2, 6):
+            name = "fpn_p{}".format(level)
+            tensors[name] = keras_model.get_layer(name).output
+        if keras_model.uses_learning_phase:
+            tensors["learning_phase"] = K.learning_phase()
+        names = {k: t.name for k, t in tensors.items()}
+
+        session = K.get_session()
+        with session.graph.as_default():
+            names_node = tf.constant(json.dumps(names),
+                                     name=FROZEN_TENSOR_NAMES)
+        output_nodes = [t.op.name for t in tensors.values()]
+        output_nodes.append(names_node.op.name)
+
+        graph_def = graph_util.convert_variables_to_constants(
+            session, session.graph.as_graph_def(), output_nodes)
+        if TransformGraph is not None:
+            input_nodes = [tensors["input_image"].op.name,
+                           tensors["input_image_meta"].op.name]
+            graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                                       ["fold_constants(ignore_errors=true)",
+                                        "fold_batch_norms",
+                                        "fold_old_batch_norms"])
+        with tf.gfile.GFile(filepath, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        log("Saved frozen graph to {}".format(filepath))
+
     def compile(self, learning_rate, momentum):
         """Gets the model ready for training. Adds losses, regularization, and
         metrics. Then calls the Keras compile() function.
@@ -2047,11 +2646,25 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
+        # Training target caches. Filled as the images are used.
+        train_cache = val_cache = None
+        if self.config.TARGET_CACHE_DIR:
+            train_cache = TargetCache(self.config.TARGET_CACHE_DIR, train_dataset, self.config)
+            val_cache = TargetCache(self.config.TARGET_CACHE_DIR, val_dataset, self.config)
+
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True, 
-                                                batch_size=self.config.BATCH_SIZE)
+        if self.config.DATA_LOADER_PROCESSES:
+            train_generator = DataLoader(train_dataset, self.config, shuffle=True,
+                                         batch_size=self.config.BATCH_SIZE,
+                                         processes=self.config.DATA_LOADER_PROCESSES,
+                                         target_cache=train_cache)
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True, 
+                                                    batch_size=self.config.BATCH_SIZE,
+                                                    target_cache=train_cache)
         val_generator = data_generator(val_dataset, self.config, shuffle=True, 
-                                            batch_size=self.config.BATCH_SIZE)
+                                            batch_size=self.config.BATCH_SIZE,
+                                            target_cache=val_cache)
 
         # Callbacks
         callbacks = [
@@ -2071,6 +2684,14 @@ class MaskRCNN():
             "workers": max(self.config.BATCH_SIZE // 2, 2),
             "use_multiprocessing": True,
         }
+        if self.config.DATA_LOADER_PROCESSES:
+            # The loader builds batches in its own processes and reuses its
+            # buffers, so Keras must not queue more batches than it allows.
+            fit_kwargs.update({
+                "max_queue_size": train_generator.num_slots - train_generator.prefetch - 2,
+                "workers": 1,
+                "use_multiprocessing": False,
+            })
         
         # Train
         log("\nStarting at epoch {}. LR={}\n".format(self.epoch, learning_rate))
@@ -2078,12 +2699,16 @@ class MaskRCNN():
         self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            **fit_kwargs
-            )
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                **fit_kwargs
+                )
+        finally:
+            if self.config.DATA_LOADER_PROCESSES:
+                train_generator.close()
         self.epoch = max(self.epoch, epochs)
             
     def mold_inputs(self, images):
@@ -2224,6 +2849,54 @@ class MaskRCNN():
             })
         return results
 
+    def set_proposal_params(self, pre_nms_limit=None, nms_threshold=None,
+                            proposal_count=None):
+        """Changes how proposals are selected, without rebuilding the graph.
+        Arguments that are None are left unchanged. Lower values trade
+        accuracy for speed. Run "python3 -m lib.benchmark proposals" to
+        measure both.
+
+        pre_nms_limit: Number of top scoring anchors to run NMS on.
+            Default: config.PRE_NMS_LIMIT.
+        nms_threshold: IoU threshold of the RPN NMS.
+            Default: config.RPN_NMS_THRESHOLD.
+        proposal_count: Number of proposals, which is the number of ROIs
+            the classifier head runs on. Only in inference mode.
+            Default: config.POST_NMS_ROIS_INFERENCE.
+
+        export_frozen_graph() stores the current values in the graph as
+        constants, so set them before exporting.
+        """
+        keras_model = self.keras_model.inner_model \
+            if hasattr(self.keras_model, "inner_model") else self.keras_model
+        layer = keras_model.get_layer("ROI")
+        if pre_nms_limit is not None:
+            K.set_value(layer.pre_nms_limit_var, pre_nms_limit)
+        if nms_threshold is not None:
+            K.set_value(layer.nms_threshold_var, nms_threshold)
+        if proposal_count is not None:
+            assert layer.dynamic, "The proposal count is fixed in training mode."
+            K.set_value(layer.proposal_count_var, proposal_count)
+
+    def warmup(self, iterations=None):
+        """Runs detection on synthetic images so that the first real images
+        run at steady-state speed. mold_inputs() pads all images to the same
+        shape and the graph has a fixed batch size, so one shape covers every
+        input.
+
+        iterations: Number of detect() calls. Default: config.WARMUP_ITERATIONS.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        if iterations is None:
+            iterations = self.config.WARMUP_ITERATIONS
+
+        # Noise rather than blank images so the heads see some detections
+        random_state = np.random.RandomState(0)
+        image = random_state.randint(
+            0, 255, tuple(self.config.IMAGE_SHAPE[:2]) + (3,)).astype(np.uint8)
+        for _ in range(iterations):
+            self.detect([image] * self.config.BATCH_SIZE)
+
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
         tensor: TensorFlow symbolic tensor.
@@ -2322,6 +2995,105 @@ class MaskRCNN():
         return outputs_np
 
 
+# Name of the graph node holding the tensor names of a frozen model
+FROZEN_TENSOR_NAMES = "frozen_mask_rcnn_tensor_names"
+
+
+class FrozenMaskRCNN(MaskRCNN):
+    """Runs inference from a graph saved by MaskRCNN.export_frozen_graph().
+
+    The Keras model isn't built, so only detect() and the methods it relies
+    on are supported.
+    """
+
+    def __init__(self, config, filepath):
+        """
+        config: A Sub-class of the Config class. Must match the config the
+            graph was exported with.
+        filepath: Path to the frozen graph file.
+        """
+        self.mode = "inference"
+        self.config = config
+        self.keras_model = None
+        # The graph has the weights
+        self.weights_path = filepath
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(filepath, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        set_cpu_affinity(config)
+        self.session = tf.Session(graph=self.graph,
+                                  config=session_config(config))
+
+        names = self.session.run(FROZEN_TENSOR_NAMES + ":0")
+        names = json.loads(names.decode("utf-8"))
+        self.tensors = {k: self.graph.get_tensor_by_name(v)
+                        for k, v in names.items()}
+
+    def detect(self, images, verbose=0):
+        """Runs the detection pipeline. See MaskRCNN.detect()."""
+        if verbose:
+            log("Processing {} images".format(len(images)))
+            for image in images:
+                log("image", image)
+        # Mold inputs to format expected by the neural network
+        molded_images, image_metas, windows = self.mold_inputs(images)
+        if verbose:
+            log("molded_images", molded_images)
+            log("image_metas", image_metas)
+
+        t = self.tensors
+        feature_maps = [t["fpn_p{}".format(level)] for level in range(2, 6)]
+        feed = {t["input_image"]: molded_images,
+                t["input_image_meta"]: image_metas}
+        if "learning_phase" in t:
+            feed[t["learning_phase"]] = 0
+
+        # Run the backbone, RPN and classifier heads
+        outputs = self.session.run(
+            [t["rpn_rois"], t["mrcnn_class"], t["mrcnn_bbox"]] + feature_maps,
+            feed)
+        rois, mrcnn_class, mrcnn_bbox = outputs[:3]
+
+        # The detection layer can't be frozen, so refine detections here and
+        # feed them and the feature maps to the mask head.
+        detections = build_detections(rois, mrcnn_class, mrcnn_bbox,
+                                      windows, self.config)
+        feed = dict(zip(feature_maps, outputs[3:]))
+        feed[t["detections"]] = detections
+        if "learning_phase" in t:
+            feed[t["learning_phase"]] = 0
+        mrcnn_mask = self.session.run(t["mrcnn_mask"], feed)
+
+        # Process detections
+        results = []
+        for i, image in enumerate(images):
+            final_rois, final_class_ids, final_scores, final_masks =\
+                self.unmold_detections(detections[i], mrcnn_mask[i],
+                                       image.shape, windows[i])
+            results.append({
+                "rois": final_rois,
+                "class_ids": final_class_ids,
+                "scores": final_scores,
+                "masks": final_masks,
+            })
+        return results
+
+    def set_proposal_params(self, pre_nms_limit=None, nms_threshold=None,
+                            proposal_count=None):
+        """Frozen graphs are immutable, and the proposal settings are
+        constants in them. Call MaskRCNN.set_proposal_params() before
+        export_frozen_graph() instead.
+        """
+        raise RuntimeError(
+            "Frozen graphs are immutable, so their proposal settings can't be "
+            "changed. Set them with MaskRCNN.set_proposal_params() before "
+            "exporting the graph.")
+
+
 ############################################################
 #  Data Formatting
 ############################################################
@@ -11,6 +11,10 @@ import sys
 import os
 import math
 import random
+import bisect
+import functools
+import hashlib
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 import scipy.misc
@@ -27,24 +31,21 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    # Rows and columns that each instance occupies, [height or width,
+    # num_instances]. One reduction over the whole stack of masks.
+    horizontal = np.any(mask, axis=0)
+    vertical = np.any(mask, axis=1)
+    # First and last occupied rows and columns. x2 and y2 should not be
+    # part of the box, so they're one past the last ones.
+    x1 = np.argmax(horizontal, axis=0)
+    x2 = horizontal.shape[0] - np.argmax(horizontal[::-1], axis=0)
+    y1 = np.argmax(vertical, axis=0)
+    y2 = vertical.shape[0] - np.argmax(vertical[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(horizontal, axis=0)] = 0
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -68,60 +69,102 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def compute_overlaps(boxes1, boxes2, dtype=np.float64, chunk_size=2 ** 16):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    dtype: Type of the returned overlaps. With np.float32, the IoUs are
+        computed in float32 as well, which is faster and takes half the
+        memory but isn't exact.
+    chunk_size: Maximum number of IoUs computed at once. The boxes1 are
+        processed in chunks of rows, which keeps the temporary arrays small
+        enough to stay in the CPU cache.
 
     For better performance, pass the largest set first and the smaller second.
     """
+    if dtype == np.float32:
+        boxes1 = boxes1.astype(np.float32, copy=False)
+        boxes2 = boxes2.astype(np.float32, copy=False)
+
     # Areas of anchors and GT boxes
     area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
-    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    # Each cell contains the IoU value. Same math as compute_iou(), but
+    # broadcast over blocks of rows. Coordinates are copied to contiguous
+    # arrays, and the temporary arrays are reused.
+    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]), dtype=dtype)
+    rows = max(chunk_size // max(boxes2.shape[0], 1), 1)
+    y1b, x1b, y2b, x2b = np.ascontiguousarray(boxes2.T)
+    for start in range(0, boxes1.shape[0], rows):
+        y1a, x1a, y2a, x2a = boxes1[start:start + rows].T.copy()[..., np.newaxis]
+        # Calculate intersection areas
+        y1 = np.maximum(y1b, y1a)
+        y2 = np.minimum(y2b, y2a)
+        x1 = np.maximum(x1b, x1a)
+        x2 = np.minimum(x2b, x2a)
+        height = np.maximum(np.subtract(y2, y1, out=y2), 0, out=y2)
+        width = np.maximum(np.subtract(x2, x1, out=x2), 0, out=x2)
+        intersection = np.multiply(width, height, out=width)
+        union = area2 + area1[start:start + rows, np.newaxis]
+        union -= intersection
+        np.divide(intersection, union, out=overlaps[start:start + rows])
     return overlaps
 
 
-def non_max_suppression(boxes, scores, threshold):
+def non_max_suppression(boxes, scores, threshold, max_output_size=None,
+                        block_size=128):
     """Performs non-maximum supression and returns indicies of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    max_output_size: Optional maximum number of boxes to keep. Stops as
+        soon as that many are picked.
+    block_size: Number of boxes handled together. The boxes are sorted by
+        score and processed in blocks. Within a block, the IoUs of all
+        pairs are computed at once and the picked boxes mark the ones they
+        suppress. Then the boxes picked in the block suppress the remaining
+        boxes of the later blocks, all in one step. The IoUs are the same
+        as the ones compute_iou() gives, so the result is the same as
+        picking one box at a time.
     """
     assert boxes.shape[0] > 0
     if boxes.dtype.kind != "f":
         boxes = boxes.astype(np.float32)
 
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
     # Get indicies of boxes sorted by scores (highest first)
     ixs = scores.argsort()[::-1]
+    boxes = boxes[ixs]
+    count = boxes.shape[0]
+    max_output_size = max_output_size or count
 
     pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indicies into ixs[1:], so add 1 to get
-        # indicies into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indicies of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    suppressed = np.zeros([count], dtype=bool)
+    for start in range(0, count, block_size):
+        # Boxes of the block that earlier blocks didn't suppress
+        block = np.where(~suppressed[start:start + block_size])[0] + start
+        if not block.shape[0]:
+            continue
+        overlaps = compute_overlaps(boxes[block], boxes[block], dtype=boxes.dtype)
+        block_suppressed = np.zeros([block.shape[0]], dtype=bool)
+        block_pick = []
+        for i in range(block.shape[0]):
+            if block_suppressed[i]:
+                continue
+            # Pick the box and suppress the following ones it overlaps
+            block_pick.append(block[i])
+            if len(pick) + len(block_pick) == max_output_size:
+                return ixs[pick + block_pick].astype(np.int32)
+            block_suppressed[i + 1:] |= overlaps[i, i + 1:] > threshold
+        pick.extend(block_pick)
+
+        # Suppress the boxes of the later blocks that the picked boxes overlap
+        rest = np.where(~suppressed[start + block_size:])[0] + start + block_size
+        if rest.shape[0]:
+            overlaps = compute_overlaps(boxes[rest], boxes[block_pick],
+                                        dtype=boxes.dtype)
+            suppressed[rest[np.any(overlaps > threshold, axis=1)]] = True
+    return ixs[pick].astype(np.int32)
 
 
 def apply_box_deltas(boxes, deltas):
@@ -204,6 +247,273 @@ def box_refinement(box, gt_box):
 #  Dataset
 ############################################################
 
+class _Missing(object):
+    """Marks values of rows that don't have a key. Pickles as a reference
+    to _MISSING, so it stays the same object in other processes.
+    """
+    def __reduce__(self):
+        return "_MISSING"
+
+
+_MISSING = _Missing()
+
+
+def _values_to_array(values):
+    """Converts a list of values to the most compact NumPy array that
+    returns the same values. Strings are stored UTF-8 encoded.
+    """
+    types = set(type(v) for v in values)
+    try:
+        if types <= {int, np.int32, np.int64}:
+            return np.array(values, dtype=np.int64)
+        if types <= {float, np.float32, np.float64}:
+            return np.array(values, dtype=np.float64)
+        if types <= {bool, np.bool_}:
+            return np.array(values, dtype=bool)
+        if types == {str}:
+            return np.array([v.encode("utf-8") for v in values])
+    except OverflowError:
+        pass
+    # Set one by one, so that values like lists aren't broadcast
+    array = np.empty([len(values)], dtype=object)
+    for i, v in enumerate(values):
+        array[i] = v
+    return array
+
+
+def _array_value(array, i):
+    """Returns the Python value at index i of a column array."""
+    value = array[i]
+    if array.dtype.kind == "S":
+        return value.decode("utf-8")
+    if array.dtype.kind != "O":
+        return value.item()
+    return value
+
+
+def _to_object_array(array):
+    """Converts a column array to an object array of its Python values."""
+    if array.dtype.kind == "O":
+        return array
+    values = np.empty([array.shape[0]], dtype=object)
+    values[:] = np.char.decode(array, "utf-8").tolist() if array.dtype.kind == "S" \
+        else array.tolist()
+    return values
+
+
+def _concatenate_columns(arrays):
+    """Concatenates column arrays. Falls back to objects if they have
+    different kinds of values.
+    """
+    if len(set(a.dtype.kind for a in arrays)) > 1:
+        arrays = [_to_object_array(a) for a in arrays]
+    return np.concatenate(arrays)
+
+
+class InfoRow(dict):
+    """A dict of the values of an InfoTable row. Setting a key also sets it
+    in the table, so info["key"] = value works as it does on a list of
+    dicts. Keys can't be removed. Copies and pickles are plain dicts.
+    """
+
+    def __init__(self, table, index, values):
+        super(InfoRow, self).__init__(values)
+        self.table = table
+        self.index = index
+
+    def __setitem__(self, key, value):
+        self.table.set(self.index, key, value)
+        super(InfoRow, self).__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Keys can't be removed from InfoTable rows")
+
+    __delitem__ = pop = popitem = clear = _read_only
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self),)
+
+
+class InfoTable(object):
+    """A list of info dicts, such as Dataset.image_info, stored as columns.
+    Each key is a NumPy array with one value per row. Numbers and strings
+    are stored in compact arrays instead of millions of Python objects,
+    and pages of these arrays stay shared between processes forked from
+    the one that loaded the dataset. Other values, such as lists, are kept
+    as objects.
+
+    Rows are added with append() and extend() and packed into the column
+    arrays by pack(), which Dataset.prepare() calls. Indexing returns an
+    InfoRow, a dict of the row's values that writes assignments back to
+    the table.
+    """
+
+    def __init__(self, rows=()):
+        # {key: array} of the packed rows
+        self.columns = {}
+        self.packed_length = 0
+        # Rows added since the last pack(). Each block is either a list of
+        # row dicts or a (dict of columns, row count) tuple.
+        self.blocks = []
+        self.block_starts = []
+        # {key: {row: value}} of values set() couldn't store in the columns
+        self.updates = {}
+        self.length = 0
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.row(j) for j in range(*i.indices(self.length))]
+        return self.row(self.index(i))
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.row(i)
+
+    def index(self, i):
+        i = int(i)
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("InfoTable index out of range")
+        return i
+
+    def row(self, i):
+        """Returns an InfoRow of the values of row i."""
+        if i >= self.packed_length:
+            block, j = self.find_block(i)
+            if isinstance(block, list):
+                values = block[j].items()
+            else:
+                values = ((k, _array_value(v, j) if isinstance(v, np.ndarray) else v[j])
+                          for k, v in block[0].items())
+        else:
+            values = [(key, _array_value(column, i))
+                      for key, column in self.columns.items()]
+            values += [(key, updates[i]) for key, updates in self.updates.items()
+                       if i in updates]
+        return InfoRow(self, i, ((k, v) for k, v in values if v is not _MISSING))
+
+    def find_block(self, i):
+        """Returns the pending block of row i and the row's index in it."""
+        b = bisect.bisect_right(self.block_starts, i) - 1
+        return self.blocks[b], i - self.block_starts[b]
+
+    def append(self, row):
+        """Appends a row from a dict of its values."""
+        if not self.blocks or not isinstance(self.blocks[-1], list):
+            self.block_starts.append(self.length)
+            self.blocks.append([])
+        self.blocks[-1].append(dict(row))
+        self.length += 1
+
+    def extend(self, columns):
+        """Appends rows from a dict of columns. Each column is a list or
+        array with one value per row. Faster than appending rows one by one.
+        """
+        count = len(next(iter(columns.values())))
+        block = {}
+        for key, values in columns.items():
+            if isinstance(values, np.ndarray) and values.dtype.kind == "U":
+                values = np.char.encode(values, "utf-8")
+            block[key] = values if isinstance(values, np.ndarray) else list(values)
+        self.block_starts.append(self.length)
+        self.blocks.append((block, count))
+        self.length += count
+
+    def set(self, i, key, value):
+        """Sets the value of a key in row i."""
+        i = self.index(i)
+        if i >= self.packed_length:
+            block, j = self.find_block(i)
+            if isinstance(block, list):
+                block[j][key] = value
+                return
+            columns, count = block
+            values = columns.get(key)
+            if values is None:
+                values = columns[key] = [_MISSING] * count
+            elif isinstance(values, np.ndarray):
+                values = columns[key] = _to_object_array(values).tolist()
+            values[j] = value
+            return
+        column = self.columns.get(key)
+        if column is not None:
+            array = _values_to_array([value])
+            if column.dtype.kind == "O" or (array.dtype.kind == column.dtype.kind
+                                            and np.can_cast(array.dtype, column.dtype)):
+                column[i] = value if column.dtype.kind == "O" else array[0]
+                self.updates.get(key, {}).pop(i, None)
+                return
+        # Doesn't fit the column. Keep it until the next pack().
+        self.updates.setdefault(key, {})[i] = value
+
+    def pack(self):
+        """Packs the rows added since the last call into the column arrays.
+        """
+        if not self.blocks and not self.updates:
+            return
+        # All keys, in the order they were first added
+        keys = dict.fromkeys(self.columns)
+        for block in self.blocks:
+            for row in (block if isinstance(block, list) else [block[0]]):
+                keys.update(dict.fromkeys(row))
+        keys.update(dict.fromkeys(self.updates))
+
+        columns = {}
+        for key in keys:
+            arrays = []
+            if key in self.columns:
+                arrays.append(self.columns[key])
+            elif self.packed_length:
+                arrays.append(np.full([self.packed_length], _MISSING, dtype=object))
+            for block in self.blocks:
+                if isinstance(block, list):
+                    arrays.append(_values_to_array(
+                        [row.get(key, _MISSING) for row in block]))
+                elif key in block[0]:
+                    values = block[0][key]
+                    arrays.append(values if isinstance(values, np.ndarray)
+                                  else _values_to_array(values))
+                else:
+                    arrays.append(np.full([block[1]], _MISSING, dtype=object))
+            column = _concatenate_columns(arrays)
+            if key in self.updates:
+                # Repack with the values that didn't fit
+                values = _to_object_array(column).tolist()
+                for i, value in self.updates[key].items():
+                    values[i] = value
+                column = _values_to_array(values)
+            columns[key] = column
+
+        self.columns = columns
+        self.packed_length = self.length
+        self.blocks = []
+        self.block_starts = []
+        self.updates = {}
+
+    def column(self, key):
+        """Returns the array of a column, after packing pending rows.
+        Strings are UTF-8 bytes, and values of rows without the key are
+        _MISSING objects.
+        """
+        self.pack()
+        return self.columns[key]
+
+
 class Dataset(object):
     """The base class for dataset classes.
     To use it, create a new class that adds functions specific to the dataset
@@ -221,19 +531,23 @@ class Dataset(object):
     """
     def __init__(self, class_map=None):
         self._image_ids = []
-        self.image_info = []
+        # Image and class info are stored as columns. Indexing returns a
+        # dict of an image or class. See InfoTable.
+        self.image_info = InfoTable()
         # Background is always the first class
-        self.class_info = [{"source": "", "id": 0, "name": "BG"}]
+        self.class_info = InfoTable([{"source": "", "id": 0, "name": "BG"}])
+        # (source, class_id) of the added classes
+        self.class_keys = {("", 0)}
         self.source_class_ids = {}
 
     def add_class(self, source, class_id, class_name):
         assert "." not in source, "Source name cannot contain a dot"
         # Does the class exist already?
-        for info in self.class_info:
-            if info['source'] == source and info["id"] == class_id:
-                # source.class_id combination already available, skip
-                return
+        if (source, class_id) in self.class_keys:
+            # source.class_id combination already available, skip
+            return
         # Add the class
+        self.class_keys.add((source, class_id))
         self.class_info.append({
             "source": source,
             "id": class_id,
@@ -249,6 +563,21 @@ class Dataset(object):
         image_info.update(kwargs)
         self.image_info.append(image_info)
 
+    def add_images(self, source, image_ids, paths, **kwargs):
+        """Adds many images at once. Faster than calling add_image() for
+        each of them, and doesn't create Python objects for every value.
+        image_ids, paths: Lists or arrays with a value per image.
+        kwargs: Other image attributes, each a list or array with a value
+            per image.
+        """
+        columns = {
+            "id": image_ids,
+            "source": np.full([len(image_ids)], source),
+            "path": paths,
+        }
+        columns.update(kwargs)
+        self.image_info.extend(columns)
+
     def image_reference(self, image_id):
         """Return a link to the image in its source Website or details about
         the image that help looking it up or debugging it.
@@ -268,6 +597,10 @@ class Dataset(object):
             """Returns a shorter version of object names for cleaner display."""
             return ",".join(name.split(",")[:1])
 
+        # Pack the info added since the last call into columns
+        self.image_info.pack()
+        self.class_info.pack()
+
         # Build (or rebuild) everything else from the info dicts.
         self.num_classes = len(self.class_info)
         self.class_ids = np.arange(self.num_classes)
@@ -354,6 +687,29 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def annotation_key(self, image_id):
+        """Returns a hash of the image and its annotations. Caches of the
+        training targets of the image, such as model.TargetCache, are
+        only used while it stays the same.
+
+        This hashes the image info. Override it if load_mask() reads the
+        annotations from somewhere else, such as mask files.
+        """
+        info = self.image_info[image_id]
+        return hashlib.md5(repr(sorted(info.items())).encode("utf-8")).hexdigest()
+
+    def load_mask_resized(self, image_id, scale, padding):
+        """Load instance masks for the given image, resized and padded like
+        the image. See resize_image() for scale and padding.
+
+        This loads the full size masks and resizes them. Override it if
+        your dataset can produce resized masks more efficiently.
+
+        Returns the same as load_mask().
+        """
+        mask, class_ids = self.load_mask(image_id)
+        return resize_mask(mask, scale, padding), class_ids
+
 
 def resize_image(image, min_dim=None, max_dim=None, padding=False):
     """
@@ -421,39 +777,127 @@ def resize_mask(mask, scale, padding):
     return mask
 
 
-def minimize_mask(bbox, mask, mini_shape):
+@functools.lru_cache(maxsize=4096)
+def bilinear_resize_weights(in_size, out_size):
+    """Returns the weights [out_size, in_size] of a 1D bilinear resize, so
+    that resized = weights @ pixels. Uses the pixel centers and triangle
+    filter of PIL's resize(), which scipy.misc.imresize() calls. When
+    shrinking, the filter is widened by the scale, so every source pixel
+    contributes. The returned array is cached and must not be modified.
+    """
+    if not in_size or not out_size:
+        return np.zeros([out_size, in_size], dtype=np.float32)
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    centers = (np.arange(out_size) + 0.5) * scale
+    # Source pixels within the support of each output pixel
+    lo = np.maximum((centers - filter_scale + 0.5).astype(np.int32), 0)
+    hi = np.minimum((centers + filter_scale + 0.5).astype(np.int32), in_size)
+    x = np.arange(in_size)
+    weights = np.maximum(1 - np.abs((x - centers[:, np.newaxis] + 0.5) / filter_scale), 0)
+    weights[(x < lo[:, np.newaxis]) | (x >= hi[:, np.newaxis])] = 0
+    weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+    return weights.astype(np.float32)
+
+
+def minimize_mask(bbox, mask, mini_shape, out=None):
     """Resize masks to a smaller version to cut memory load.
     Mini-masks can then resized back to image scale using expand_masks()
 
+    The box of each instance is cropped and resized with bilinear
+    interpolation, as two matrix products with the weights of
+    bilinear_resize_weights(), and thresholded at 0.5 (128 of 255 in
+    imresize() terms). All instances are written into one array. Each box
+    has its own size, so batching the products would mean padding every
+    crop to the largest box, which is slower.
+
+    A mask that fills its whole box stays full. scipy.misc.imresize()
+    rescaled such a crop to zeros, so these instances used to get empty
+    mini-mask training targets.
+
+    out: Optional bool array [mini height, mini width, instances] to write
+        the mini-masks to.
+
     See inspect_data.ipynb notebook for more details.
     """
-    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    mini_mask = out if out is not None else \
+        np.zeros(tuple(mini_shape) + (mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
         y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        m = scipy.misc.imresize(m.astype(float), mini_shape, interp='bilinear')
-        mini_mask[:, :, i] = np.where(m >= 128, 1, 0)
+        m = mask[y1:y2, x1:x2, i].astype(np.float32)
+        m = bilinear_resize_weights(y2 - y1, mini_shape[0]) @ m \
+            @ bilinear_resize_weights(x2 - x1, mini_shape[1]).T
+        np.greater_equal(m, 0.5, out=mini_mask[:, :, i])
     return mini_mask
 
 
-def expand_mask(bbox, mini_mask, image_shape):
+def expand_mask(bbox, mini_mask, image_shape, out=None):
     """Resizes mini masks back to image size. Reverses the change
-    of minimize_mask().
+    of minimize_mask(), with the same interpolation and threshold.
+
+    out: Optional bool array [height, width, instances] to write the masks
+        to. It must be all zeros.
 
     See inspect_data.ipynb notebook for more details.
     """
-    mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
+    mask = out if out is not None else \
+        np.zeros(tuple(image_shape[:2]) + (mini_mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
         y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
-        m = scipy.misc.imresize(m.astype(float), (h, w), interp='bilinear')
-        mask[y1:y2, x1:x2, i] = np.where(m >= 128, 1, 0)
+        m = mini_mask[:, :, i].astype(np.float32)
+        m = bilinear_resize_weights(m.shape[0], y2 - y1) @ m \
+            @ bilinear_resize_weights(m.shape[1], x2 - x1).T
+        np.greater_equal(m, 0.5, out=mask[y1:y2, x1:x2, i])
     return mask
 
 
+def crop_and_resize_masks(masks, boxes, mask_ids, shape, mini_mask_boxes=None):
+    """Crops regions from masks and resizes them with nearest neighbor
+    interpolation. All regions are done at once by computing the source
+    pixel of each output pixel, rather than by cropping and resizing each
+    one separately.
+
+    masks: [height, width, N] bool. Full size masks, or mini-masks if
+        mini_mask_boxes is provided.
+    boxes: [count, (y1, x1, y2, x2)] the regions to crop in image coordinates.
+    mask_ids: [count] the index of the mask to crop each region from.
+    shape: (height, width) of the output masks.
+    mini_mask_boxes: [N, (y1, x1, y2, x2)] the image boxes that the
+        mini-masks cover. Pixels outside of them are 0.
+
+    Returns: [count, height, width] bool masks.
+    """
+    boxes = boxes.astype(np.int32)
+    # Source pixel of each output pixel in image coordinates. [count, height]
+    # and [count, width]. Same pixel centers as a nearest neighbor resize.
+    h = boxes[:, 2:3] - boxes[:, 0:1]
+    w = boxes[:, 3:4] - boxes[:, 1:2]
+    ys = boxes[:, 0:1] + np.floor((np.arange(shape[0]) + 0.5) * h / shape[0]).astype(np.int32)
+    xs = boxes[:, 1:2] + np.floor((np.arange(shape[1]) + 0.5) * w / shape[1]).astype(np.int32)
+
+    if mini_mask_boxes is not None:
+        # Map image coordinates to mini-mask coordinates through the box
+        # that each mini-mask was resized from.
+        mini_boxes = mini_mask_boxes[mask_ids].astype(np.int32)
+        mini_h = mini_boxes[:, 2:3] - mini_boxes[:, 0:1]
+        mini_w = mini_boxes[:, 3:4] - mini_boxes[:, 1:2]
+        y_valid = (ys >= mini_boxes[:, 0:1]) & (ys < mini_boxes[:, 2:3])
+        x_valid = (xs >= mini_boxes[:, 1:2]) & (xs < mini_boxes[:, 3:4])
+        ys = np.floor((ys - mini_boxes[:, 0:1] + 0.5) * masks.shape[0] /
+                      np.maximum(mini_h, 1)).astype(np.int32)
+        xs = np.floor((xs - mini_boxes[:, 1:2] + 0.5) * masks.shape[1] /
+                      np.maximum(mini_w, 1)).astype(np.int32)
+    else:
+        y_valid = (ys >= 0) & (ys < masks.shape[0])
+        x_valid = (xs >= 0) & (xs < masks.shape[1])
+    ys = np.clip(ys, 0, masks.shape[0] - 1)
+    xs = np.clip(xs, 0, masks.shape[1] - 1)
+
+    # Gather. [count, height, width]
+    result = masks[ys[:, :, None], xs[:, None, :], mask_ids[:, None, None]]
+    return result & y_valid[:, :, None] & x_valid[:, None, :]
+
+
 # TODO: Build and use this function to reduce code duplication
 def mold_mask(mask, config):
     pass
@@ -542,6 +986,105 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class AnchorGrid(object):
+    """Spatial index over the anchors of a feature pyramid. Anchors of each
+    level are centered on a regular grid, so the anchors that can overlap
+    a box are found directly from the box coordinates. This avoids
+    computing the IoU of every anchor with every box, most of which are
+    zero.
+
+    The anchors are the same, and in the same order, as the ones returned
+    by generate_pyramid_anchors() with the same arguments.
+    """
+
+    def __init__(self, scales, ratios, feature_shapes, feature_strides,
+                 anchor_stride):
+        anchors = []
+        self.levels = []
+        offset = 0
+        for i in range(len(scales)):
+            level_anchors = generate_anchors(scales[i], ratios, feature_shapes[i],
+                                             feature_strides[i], anchor_stride)
+            # Anchors are ordered by row, then column, then shape. The first
+            # anchors are the shapes at the grid cell centered on (0, 0).
+            rows = len(range(0, feature_shapes[i][0], anchor_stride))
+            cols = len(range(0, feature_shapes[i][1], anchor_stride))
+            per_cell = level_anchors.shape[0] // (rows * cols)
+            first = level_anchors[:per_cell]
+            self.levels.append({
+                "offset": offset,
+                "rows": rows,
+                "cols": cols,
+                "per_cell": per_cell,
+                # Distance between the centers of neighboring cells
+                "step": feature_strides[i] * anchor_stride,
+                # Largest distance from an anchor center to its edges
+                "half_height": np.max(first[:, 2] - first[:, 0]) / 2,
+                "half_width": np.max(first[:, 3] - first[:, 1]) / 2,
+            })
+            anchors.append(level_anchors)
+            offset += level_anchors.shape[0]
+        self.anchors = np.concatenate(anchors, axis=0)
+        self.areas = (self.anchors[:, 2] - self.anchors[:, 0]) * \
+            (self.anchors[:, 3] - self.anchors[:, 1])
+
+    def overlaps(self, boxes):
+        """Computes the IoU of anchors and boxes for the pairs that overlap.
+        boxes: [N, (y1, x1, y2, x2)]
+
+        Returns a sparse IoU matrix [anchors, boxes] as three arrays:
+        anchor_ids: anchor index of each non-zero IoU
+        box_ids: box index of each non-zero IoU
+        ious: the IoU values. They match compute_overlaps(anchors, boxes).
+        """
+        box_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        anchor_ids = []
+        box_ids = []
+        for level in self.levels:
+            step = level["step"]
+            # Range of grid cells with anchors that can overlap each box.
+            # Inclusive, so it might include anchors that only touch the box.
+            r1 = np.maximum(np.ceil((boxes[:, 0] - level["half_height"]) / step), 0)
+            r2 = np.minimum(np.floor((boxes[:, 2] + level["half_height"]) / step),
+                            level["rows"] - 1)
+            c1 = np.maximum(np.ceil((boxes[:, 1] - level["half_width"]) / step), 0)
+            c2 = np.minimum(np.floor((boxes[:, 3] + level["half_width"]) / step),
+                            level["cols"] - 1)
+            rows = np.maximum(r2 - r1 + 1, 0).astype(np.int64)
+            cols = np.maximum(c2 - c1 + 1, 0).astype(np.int64)
+            counts = rows * cols * level["per_cell"]
+            if not counts.sum():
+                continue
+            # Enumerate the candidate anchors of all boxes at once
+            ids = np.repeat(np.arange(boxes.shape[0]), counts)
+            local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            cell = local // level["per_cell"]
+            row = r1[ids].astype(np.int64) + cell // cols[ids]
+            col = c1[ids].astype(np.int64) + cell % cols[ids]
+            anchor_ids.append(level["offset"] + (row * level["cols"] + col) *
+                              level["per_cell"] + local % level["per_cell"])
+            box_ids.append(ids)
+        if not anchor_ids:
+            return np.zeros([0], np.int64), np.zeros([0], np.int64), np.zeros([0])
+        anchor_ids = np.concatenate(anchor_ids)
+        box_ids = np.concatenate(box_ids)
+
+        # IoU of each candidate pair. Same math as compute_iou().
+        anchors = self.anchors[anchor_ids]
+        b = boxes[box_ids]
+        y1 = np.maximum(b[:, 0], anchors[:, 0])
+        y2 = np.minimum(b[:, 2], anchors[:, 2])
+        x1 = np.maximum(b[:, 1], anchors[:, 1])
+        x2 = np.minimum(b[:, 3], anchors[:, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = box_area[box_ids] + self.areas[anchor_ids] - intersection
+        ious = intersection / union
+
+        # Drop the candidates that don't overlap
+        keep = np.where(ious > 0)[0]
+        return anchor_ids[keep], box_ids[keep], ious[keep]
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -556,6 +1099,96 @@ def trim_zeros(x):
     return x[~np.all(x == 0, axis=1)]
 
 
+# IoU thresholds of the COCO AP metric, 0.5:0.05:0.95
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+def compute_matches(gt_boxes, gt_class_ids,
+                    pred_boxes, pred_class_ids, pred_scores,
+                    iou_thresholds=(0.5,)):
+    """Matches predictions to GT boxes at several IoU thresholds at once.
+    Going from the highest score to the lowest, each prediction is matched
+    to the unmatched GT box of the same class that it overlaps the most,
+    if the IoU is at least the threshold. The overlaps are computed once
+    and shared by all thresholds.
+
+    iou_thresholds: List of T IoU thresholds.
+
+    Returns:
+    gt_match: [T, GT boxes]. 1 for matched GT boxes, 0 otherwise.
+    pred_match: [T, pred boxes] in the order of pred_scores from high to
+        low. 1 for matched predictions, 0 otherwise.
+    overlaps: [pred_boxes, gt_boxes] IoU overlaps, with the predictions
+        sorted by score from high to low.
+    """
+    # Sort predictions by score from high to low
+    indices = np.argsort(pred_scores)[::-1]
+    pred_boxes = pred_boxes[indices]
+    pred_class_ids = pred_class_ids[indices]
+
+    # Compute IoU overlaps [pred_boxes, gt_boxes]
+    overlaps = compute_overlaps(pred_boxes, gt_boxes)
+
+    thresholds = np.array(iou_thresholds, dtype=np.float64).reshape([-1])
+    pred_match = np.zeros([len(thresholds), pred_boxes.shape[0]])
+    gt_match = np.zeros([len(thresholds), gt_boxes.shape[0]])
+    if not overlaps.size:
+        return gt_match, pred_match, overlaps
+
+    # Predictions can only match GT boxes of the same class. Only loop
+    # over the predictions that can match at the lowest threshold.
+    ious = np.where(pred_class_ids[:, np.newaxis] == gt_class_ids[np.newaxis, :gt_boxes.shape[0]],
+                    overlaps, -1)
+    candidates = np.where(np.max(ious, axis=1) >= np.min(thresholds))[0]
+    rows = np.arange(len(thresholds))
+    for i in candidates:
+        # IoU with the unmatched GT boxes at each threshold [T, GT boxes]
+        iou = np.where(gt_match == 1, -1, ious[i])
+        # Take the last of equal IoUs, like argsort()[::-1] does
+        j = iou.shape[1] - 1 - np.argmax(iou[:, ::-1], axis=1)
+        match = iou[rows, j] >= thresholds
+        gt_match[match, j[match]] = 1
+        pred_match[match, i] = 1
+    return gt_match, pred_match, overlaps
+
+
+def compute_ap_curves(pred_match, gt_count):
+    """Computes precision/recall curves and AP from the matches of
+    predictions sorted by score, for each IoU threshold.
+
+    pred_match: [T, pred boxes] from compute_matches()
+    gt_count: Number of GT boxes
+
+    Returns:
+    APs: [T] Average Precision at each threshold
+    precisions: [T, pred boxes + 2] precisions at different class score
+        thresholds, padded with a start and end value.
+    recalls: [T, pred boxes + 2] recall values at different class score
+        thresholds, padded with a start and end value.
+    """
+    # Compute precision and recall at each prediction box step
+    cumsum = np.cumsum(pred_match, axis=1)
+    precisions = cumsum / (np.arange(pred_match.shape[1]) + 1)
+    recalls = cumsum.astype(np.float32) / gt_count
+
+    # Pad with start and end values to simplify the math
+    count = pred_match.shape[0]
+    precisions = np.concatenate([np.zeros([count, 1]), precisions,
+                                 np.zeros([count, 1])], axis=1)
+    recalls = np.concatenate([np.zeros([count, 1]), recalls,
+                              np.ones([count, 1])], axis=1)
+
+    # Ensure precision values decrease but don't increase. This way, the
+    # precision value at each recall threshold is the maximum it can be
+    # for all following recall thresholds, as specified by the VOC paper.
+    precisions = np.maximum.accumulate(precisions[:, ::-1], axis=1)[:, ::-1]
+
+    # Compute mean AP over recall range. Steps where the recall doesn't
+    # change add 0.
+    APs = np.sum((recalls[:, 1:] - recalls[:, :-1]) * precisions[:, 1:], axis=1)
+    return APs, precisions, recalls
+
+
 def compute_ap(gt_boxes, gt_class_ids,
                pred_boxes, pred_class_ids, pred_scores,
                iou_threshold=0.5):
@@ -567,60 +1200,65 @@ def compute_ap(gt_boxes, gt_class_ids,
     recalls: List of recall values at different class score thresholds.
     overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
-    # Trim zero padding and sort predictions by score from high to low
+    # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
     pred_boxes = trim_zeros(pred_boxes)
     pred_scores = pred_scores[:pred_boxes.shape[0]]
-    indices = np.argsort(pred_scores)[::-1]
-    pred_boxes = pred_boxes[indices]
-    pred_class_ids = pred_class_ids[indices]
-    pred_scores = pred_scores[indices]
 
-    # Compute IoU overlaps [pred_boxes, gt_boxes]
-    overlaps = compute_overlaps(pred_boxes, gt_boxes)
+    gt_match, pred_match, overlaps = compute_matches(
+        gt_boxes, gt_class_ids, pred_boxes, pred_class_ids, pred_scores,
+        [iou_threshold])
+    APs, precisions, recalls = compute_ap_curves(pred_match, gt_match.shape[1])
+    return APs[0], precisions[0], recalls[0], overlaps
 
-    # Loop through ground truth boxes and find matching predictions
-    match_count = 0
-    pred_match = np.zeros([pred_boxes.shape[0]])
-    gt_match = np.zeros([gt_boxes.shape[0]])
-    for i in range(len(pred_boxes)):
-        # Find best matching ground truth box
-        sorted_ixs = np.argsort(overlaps[i])[::-1]
-        for j in sorted_ixs:
-            # If ground truth box is already matched, go to next one
-            if gt_match[j] == 1:
-                continue
-            # If we reach IoU smaller than the threshold, end the loop
-            iou = overlaps[i, j]
-            if iou < iou_threshold:
-                break
-            # Do we have a match?
-            if pred_class_ids[i] == gt_class_ids[j]:
-                match_count += 1
-                gt_match[j] = 1
-                pred_match[i] = 1
-                break
 
-    # Compute precision and recall at each prediction box step
-    precisions = np.cumsum(pred_match) / (np.arange(len(pred_match))+1)
-    recalls = np.cumsum(pred_match).astype(np.float32) / len(gt_match)
+def compute_ap_range(gt_boxes, gt_class_ids,
+                     pred_boxes, pred_class_ids, pred_scores,
+                     iou_thresholds=COCO_IOU_THRESHOLDS):
+    """Computes AP of one image at several IoU thresholds, matching
+    the predictions at all thresholds together.
 
-    # Pad with start and end values to simplify the math
-    precisions = np.concatenate([[0], precisions, [0]])
-    recalls = np.concatenate([[0], recalls, [1]])
+    Returns: APs [T] at each of the IoU thresholds.
+    """
+    gt_boxes = trim_zeros(gt_boxes)
+    pred_boxes = trim_zeros(pred_boxes)
+    pred_scores = pred_scores[:pred_boxes.shape[0]]
 
-    # Ensure precision values decrease but don't increase. This way, the
-    # precision value at each recall threshold is the maximum it can be
-    # for all following recall thresholds, as specified by the VOC paper.
-    for i in range(len(precisions)-2, -1, -1):
-        precisions[i] = np.maximum(precisions[i], precisions[i+1])
+    gt_match, pred_match, _ = compute_matches(
+        gt_boxes, gt_class_ids, pred_boxes, pred_class_ids, pred_scores,
+        iou_thresholds)
+    return compute_ap_curves(pred_match, gt_match.shape[1])[0]
+
+
+def _compute_ap_range_sample(args):
+    """Unpacks the arguments of compute_ap_range() for Pool.imap()."""
+    sample, iou_thresholds = args
+    return compute_ap_range(*sample, iou_thresholds=iou_thresholds)
 
-    # Compute mean AP over recall range
-    indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
-    mAP = np.sum((recalls[indices] - recalls[indices - 1]) * precisions[indices])
 
-    return mAP, precisions, recalls, overlaps
+def compute_dataset_ap(samples, iou_thresholds=COCO_IOU_THRESHOLDS,
+                       processes=0):
+    """Computes the AP of each image of a dataset at several IoU thresholds.
+
+    samples: Iterable of (gt_boxes, gt_class_ids, pred_boxes,
+        pred_class_ids, pred_scores) of each image, as taken by compute_ap().
+    iou_thresholds: List of T IoU thresholds. Defaults to the COCO
+        thresholds 0.5:0.05:0.95.
+    processes: Number of processes to split the images between. 0 to
+        compute them in this process.
+
+    Returns: APs [images, T]. The mAP at each threshold is APs.mean(axis=0),
+    and the COCO style mAP is APs.mean().
+    """
+    iou_thresholds = np.array(iou_thresholds, dtype=np.float64).reshape([-1])
+    tasks = ((sample, iou_thresholds) for sample in samples)
+    if processes:
+        with multiprocessing.Pool(processes) as pool:
+            APs = list(pool.imap(_compute_ap_range_sample, tasks, chunksize=16))
+    else:
+        APs = [_compute_ap_range_sample(task) for task in tasks]
+    return np.array(APs, dtype=np.float64).reshape([-1, len(iou_thresholds)])
 
 
 def compute_recall(pred_boxes, gt_boxes, iou):
@@ -229,7 +229,7 @@ class Window(QWidget):
         if self.thread.loadedWeights:
             self.statusLabel.setText('Status: Ready')
         else:
-            self.statusLabel.setText('Status: Loading weights...')
+            self.statusLabel.setText('Status: ' + (self.thread.loadingStatus or 'Loading weights...'))
 
         # Loads weights and idles
         if not self.thread.isRunning():
@@ -270,14 +270,18 @@ class Window(QWidget):
         return "%d:%02d:%02d" % (hours, minutes, seconds)
 
     def action(self, action):
-        # Reported when weighs are about to load
+        # Reported at each stage of loading the model and its weights
         if action is Actions.LOADING_WEIGHTS:
-            self.statusLabel.setText('Status: Loading weights...')
+            self.statusLabel.setText('Status: ' + self.thread.loadingStatus)
 
         # Reported when weights have been loaded
         if action is Actions.LOADED_WEIGHTS:
-            self.statusLabel.setText('Status: Ready')
-            self.startButton.setEnabled(True)
+            # The weights load in the background at startup, so a video might not have been chosen yet
+            if self.thread.filePath is None:
+                self.statusLabel.setText('Status: Please choose a video')
+            else:
+                self.statusLabel.setText('Status: Ready')
+            self.startButton.setEnabled(self.thread.filePath is not None)
             self.pauseButton.setEnabled(False)
             self.resumeButton.setEnabled(False)
             self.stopButton.setEnabled(False)
@@ -339,4 +343,7 @@ window = Window()
 window.setWindowTitle('Mask - RCNN')
 window.show()
 
+# Load the model in the background so the window is usable straight away
+window.thread.start()
+
 sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,475 @@
+"""
+Tests of the COCO dataset and evaluation code on a small synthetic COCO
+subset, written to a temporary directory. Skipped if TensorFlow, Keras or
+pycocotools isn't installed.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+
+import os
+import json
+import itertools
+
+import numpy as np
+import pytest
+import scipy.misc
+
+tf = pytest.importorskip("tensorflow")
+K = pytest.importorskip("keras.backend")
+pytest.importorskip("pycocotools")
+
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+from pycocotools import mask as maskUtils
+from lib import coco
+from lib import utils
+
+
+############################################################
+#  Synthetic COCO Subset
+############################################################
+
+# (height, width) of the images. The last one has no annotations.
+IMAGE_SIZES = [(40, 60), (50, 30), (32, 32), (45, 45), (30, 40)]
+
+
+def write_coco(dataset_dir, subset="val", seed=0):
+    """Writes random PNG images and an instances file with polygon, RLE,
+    crowd and empty annotations of two classes with non-contiguous IDs.
+    Returns the path of the instances file.
+    """
+    random_state = np.random.RandomState(seed)
+    image_dir, annotations_path = coco.coco_paths(dataset_dir, subset)
+    os.makedirs(image_dir)
+    os.makedirs(os.path.dirname(annotations_path))
+    images = []
+    annotations = []
+    for i, (height, width) in enumerate(IMAGE_SIZES):
+        image_id = 100 + i
+        file_name = "{:012d}.png".format(image_id)
+        scipy.misc.imsave(os.path.join(image_dir, file_name),
+                          random_state.randint(0, 255, (height, width, 3)).astype(np.uint8))
+        images.append({"id": image_id, "file_name": file_name,
+                       "height": height, "width": width})
+        if i == len(IMAGE_SIZES) - 1:
+            continue
+        for j in range(3):
+            y1, x1, h, w = (random_state.randint(0, 10, 4) + [0, 0, 5, 5]).tolist()
+            y2, x2 = y1 + h, x1 + w
+            annotations.append({
+                "id": len(annotations) + 1, "image_id": image_id,
+                "category_id": [1, 3][(i + j) % 2], "iscrowd": 0,
+                "bbox": [x1, y1, x2 - x1, y2 - y1], "area": (x2 - x1) * (y2 - y1),
+                "segmentation": [[x1, y1, x2, y1, (x1 + x2) / 2, y2]],
+            })
+        # Uncompressed RLE of a crowd, which masks leave out
+        mask = np.zeros([height, width], dtype=np.uint8)
+        mask[2:10, 3:20] = 1
+        # Run lengths in column-major order, starting with a run of zeros
+        counts = [len(list(g)) for _, g in
+                  itertools.groupby(np.r_[0, mask.ravel(order="F")])]
+        counts[0] -= 1
+        annotations.append({
+            "id": len(annotations) + 1, "image_id": image_id, "category_id": 1,
+            "iscrowd": 1, "bbox": [3, 2, 17, 8], "area": int(mask.sum()),
+            "segmentation": {"size": [height, width], "counts": counts},
+        })
+        # Less than a pixel, so it has no mask
+        annotations.append({
+            "id": len(annotations) + 1, "image_id": image_id, "category_id": 3,
+            "iscrowd": 0, "bbox": [5, 5, 0.2, 0.2], "area": 0.02,
+            "segmentation": [[5, 5, 5.2, 5, 5.2, 5.2]],
+        })
+    categories = [{"id": 1, "name": "cat", "supercategory": "animal"},
+                  {"id": 3, "name": "dog", "supercategory": "animal"}]
+    with open(annotations_path, "w") as f:
+        json.dump({"images": images, "annotations": annotations,
+                   "categories": categories}, f)
+    return annotations_path
+
+
+def load_dataset(dataset_dir, subset="val", **kwargs):
+    dataset = coco.CocoDataset()
+    dataset.load_coco(dataset_dir, subset, **kwargs)
+    dataset.prepare()
+    return dataset
+
+
+def coco_masks(coco_api, dataset, image_id):
+    """Returns the masks and class IDs of an image, rasterized by
+    pycocotools from the instances file. Like CocoDataset.load_mask(),
+    leaves out crowds and annotations without pixels.
+    """
+    info = dataset.image_info[image_id]
+    annotations = coco_api.loadAnns(coco_api.getAnnIds(imgIds=[info["id"]], iscrowd=False))
+    masks = [coco_api.annToMask(a) for a in annotations]
+    keep = [i for i, m in enumerate(masks) if m.any()]
+    class_ids = [dataset.map_source_class_id("coco.{}".format(annotations[i]["category_id"]))
+                 for i in keep]
+    return np.stack([masks[i] for i in keep], axis=2), np.array(class_ids)
+
+
+############################################################
+#  Dataset
+############################################################
+
+def check_annotation_index(index, annotations_path):
+    """Checks an annotations index against the instances file."""
+    coco_api = COCO(annotations_path)
+    image_ids = sorted(coco_api.imgs)
+    np.testing.assert_array_equal(index["image_ids"], image_ids)
+    np.testing.assert_array_equal(index["heights"], [s[0] for s in IMAGE_SIZES])
+    np.testing.assert_array_equal(index["widths"], [s[1] for s in IMAGE_SIZES])
+    np.testing.assert_array_equal(index["class_ids"], [1, 3])
+    np.testing.assert_array_equal(index["class_names"], ["cat", "dog"])
+    for i, image_id in enumerate(image_ids):
+        info = coco_api.imgs[image_id]
+        assert index["file_names"][i] == info["file_name"]
+        annotations = coco_api.loadAnns(coco_api.getAnnIds(imgIds=[image_id]))
+        start, end = index["ann_starts"][i:i + 2]
+        assert end - start == len(annotations)
+        for a, annotation in zip(range(start, end), annotations):
+            assert index["ann_ids"][a] == annotation["id"]
+            assert index["category_ids"][a] == annotation["category_id"]
+            assert index["iscrowd"][a] == annotation["iscrowd"]
+            np.testing.assert_allclose(index["bboxes"][a], annotation["bbox"], rtol=1e-6)
+            rle_start, rle_end = index["rle_starts"][a:a + 2]
+            rle = {"size": [info["height"], info["width"]],
+                   "counts": index["rle_counts"][rle_start:rle_end].tobytes()}
+            np.testing.assert_array_equal(maskUtils.decode(rle),
+                                          coco_api.annToMask(annotation))
+
+
+def test_annotation_index_cache(tmpdir, monkeypatch):
+    dataset_dir = str(tmpdir)
+    annotations_path = write_coco(dataset_dir)
+    cache_path = annotations_path.replace(".json", ".index.npz")
+
+    # Without the cache, nothing is written
+    index = coco.load_annotation_index(annotations_path, cache=False)
+    check_annotation_index(index, annotations_path)
+    assert not os.path.exists(cache_path)
+
+    # The first load builds the index and caches it
+    index = coco.load_annotation_index(annotations_path)
+    check_annotation_index(index, annotations_path)
+    assert os.path.exists(cache_path)
+
+    # Later loads read the cache
+    def fail(*args):
+        raise AssertionError("Index built again")
+    with monkeypatch.context() as patch:
+        patch.setattr(coco, "COCO", fail)
+        patch.setattr(coco, "build_annotation_index", fail)
+        cached = coco.load_annotation_index(annotations_path)
+    assert sorted(cached) == sorted(index)
+    for key in index:
+        np.testing.assert_array_equal(cached[key], index[key])
+
+    # A changed annotations file makes the cache stale, so the index is
+    # built again and the cache replaced
+    with open(annotations_path) as f:
+        instances = json.load(f)
+    instances["annotations"][0]["category_id"] = 3
+    with open(annotations_path, "w") as f:
+        json.dump(instances, f)
+    stat = os.stat(annotations_path)
+    os.utime(annotations_path, (stat.st_atime, stat.st_mtime + 10))
+    index = coco.load_annotation_index(annotations_path)
+    assert index["category_ids"][0] == 3
+    check_annotation_index(index, annotations_path)
+    with monkeypatch.context() as patch:
+        patch.setattr(coco, "COCO", fail)
+        patch.setattr(coco, "build_annotation_index", fail)
+        cached = coco.load_annotation_index(annotations_path)
+    np.testing.assert_array_equal(cached["category_ids"], index["category_ids"])
+
+
+def test_load_mask_from_cached_index(tmpdir, monkeypatch):
+    dataset_dir = str(tmpdir)
+    annotations_path = write_coco(dataset_dir)
+    coco_api = COCO(annotations_path)
+    # Builds the index and caches it next to the instances file
+    load_dataset(dataset_dir)
+
+    # Loading again reads the cached index. The instances file isn't
+    # parsed, and polygons aren't converted to RLE again.
+    def fail(*args):
+        raise AssertionError("Annotations converted again")
+    monkeypatch.setattr(coco, "COCO", fail)
+    monkeypatch.setattr(coco.CocoDataset, "annToRLE", fail)
+    dataset = load_dataset(dataset_dir)
+    assert dataset.num_images == len(IMAGE_SIZES) - 1
+    for image_id in dataset.image_ids:
+        mask, class_ids = dataset.load_mask(image_id)
+        expected_mask, expected_class_ids = coco_masks(coco_api, dataset, image_id)
+        np.testing.assert_array_equal(mask, expected_mask)
+        np.testing.assert_array_equal(class_ids, expected_class_ids)
+
+
+def test_annotation_key(tmpdir):
+    dataset_dir = str(tmpdir)
+    annotations_path = write_coco(dataset_dir)
+    dataset = load_dataset(dataset_dir)
+    keys = [dataset.annotation_key(i) for i in dataset.image_ids]
+    assert len(set(keys)) == len(keys)
+    assert keys == [dataset.annotation_key(i) for i in load_dataset(dataset_dir).image_ids]
+
+    # Changing an annotation only changes the key of its image
+    with open(annotations_path) as f:
+        instances = json.load(f)
+    instances["annotations"][0]["segmentation"][0][0] += 1
+    with open(annotations_path, "w") as f:
+        json.dump(instances, f)
+    dataset = load_dataset(dataset_dir, cache_index=False)
+    new_keys = [dataset.annotation_key(i) for i in dataset.image_ids]
+    assert new_keys[0] != keys[0]
+    assert new_keys[1:] == keys[1:]
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("class_ids", [None, [3]])
+def test_pack_coco(tmpdir, mmap, class_ids):
+    dataset_dir = str(tmpdir.join("coco"))
+    pack_dir = str(tmpdir.join("packed"))
+    write_coco(dataset_dir)
+    # Small shards, so the images are spread over several of them
+    coco.pack_coco(dataset_dir, "val", pack_dir, shard_bytes=8000)
+    assert os.path.exists(os.path.join(pack_dir, "val_0002.bin"))
+
+    dataset = load_dataset(dataset_dir, class_ids=class_ids)
+    packed = coco.PackedCocoDataset()
+    packed.load_packed(pack_dir, "val", class_ids=class_ids, mmap=mmap)
+    packed.prepare()
+    assert packed.class_names == dataset.class_names
+    assert [info["id"] for info in packed.image_info] == \
+        [info["id"] for info in dataset.image_info]
+    for image_id in dataset.image_ids:
+        np.testing.assert_array_equal(packed.load_image(image_id),
+                                      dataset.load_image(image_id))
+        mask, class_ids = packed.load_mask(image_id)
+        expected_mask, expected_class_ids = dataset.load_mask(image_id)
+        np.testing.assert_array_equal(mask, expected_mask)
+        np.testing.assert_array_equal(class_ids, expected_class_ids)
+
+
+############################################################
+#  Evaluation
+############################################################
+
+class GroundTruthModel(object):
+    """Stands in for a MaskRCNN in inference mode. Detects the ground truth
+    instances of the images, shifted on every other image and missing on
+    the third image, so the evaluation scores are not all perfect.
+    """
+
+    def __init__(self, dataset, batch_size, weights_path="weights.h5"):
+        self.dataset = dataset
+        self.config = coco.CocoConfig()
+        self.config.BATCH_SIZE = batch_size
+        self.weights_path = weights_path
+        self.image_ids = {dataset.load_image(i).tobytes(): i for i in dataset.image_ids}
+        # IDs of the images that detect() ran on
+        self.detected = set()
+
+    def detect(self, images, verbose=0):
+        assert len(images) == self.config.BATCH_SIZE
+        results = []
+        for image in images:
+            image_id = self.image_ids[image.tobytes()]
+            self.detected.add(image_id)
+            masks, class_ids = self.dataset.load_mask(image_id)
+            if image_id % 2:
+                masks = np.roll(masks, 3, axis=1)
+            if image_id == 2:
+                masks, class_ids = masks[:, :, :0], class_ids[:0]
+            results.append({
+                "rois": utils.extract_bboxes(masks),
+                "class_ids": class_ids,
+                "scores": np.linspace(0.9, 0.5, len(class_ids)),
+                "masks": masks,
+            })
+        return results
+
+
+def build_coco_results_loop(dataset, image_ids, rois, class_ids, scores, masks):
+    """The original build_coco_results(), with a result dict per detection."""
+    # If no results, return an empty list
+    if rois is None:
+        return []
+
+    results = []
+    for image_id in image_ids:
+        # Loop through detections
+        for i in range(rois.shape[0]):
+            class_id = class_ids[i]
+            score = scores[i]
+            bbox = np.around(rois[i], 1)
+            mask = masks[:, :, i]
+
+            result = {
+                "image_id": image_id,
+                "category_id": dataset.get_source_class_id(class_id, "coco"),
+                "bbox": [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
+                "score": score,
+                "segmentation": maskUtils.encode(np.asfortranarray(mask))
+            }
+            results.append(result)
+    return results
+
+
+@pytest.mark.parametrize("count", [0, 1, 7])
+@pytest.mark.parametrize("dtype", [np.int32, np.float32])
+def test_build_coco_results(count, dtype):
+    dataset = coco.CocoDataset()
+    dataset.add_class("coco", 1, "cat")
+    dataset.add_class("coco", 3, "dog")
+    dataset.prepare()
+    random_state = np.random.RandomState(count)
+    rois = (random_state.rand(count, 4) * 50).astype(dtype)
+    class_ids = random_state.randint(1, 3, count)
+    scores = random_state.rand(count).astype(np.float32)
+    masks = random_state.rand(40, 50, count) > 0.5
+    image_ids = [100, 101]
+
+    results = coco.build_coco_results(dataset, image_ids, rois, class_ids, scores, masks)
+    expected = build_coco_results_loop(dataset, image_ids, rois, class_ids, scores, masks)
+    assert len(results) == len(expected) == count * len(image_ids)
+    for result, e in zip(results, expected):
+        assert result["image_id"] == e["image_id"]
+        assert result["category_id"] == e["category_id"]
+        np.testing.assert_allclose(result["bbox"], e["bbox"], rtol=1e-6)
+        assert result["score"] == pytest.approx(e["score"])
+        assert result["segmentation"] == e["segmentation"]
+    assert coco.build_coco_results(dataset, image_ids, None, None, None, None) == []
+
+
+def evaluate_coco_loop(model, dataset, coco_api, eval_type="bbox"):
+    """The original evaluate_coco(), which runs the images through the
+    model and encodes their results one at a time.
+    """
+    image_ids = dataset.image_ids
+    coco_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
+    results = []
+    for i, image_id in enumerate(image_ids):
+        image = dataset.load_image(image_id)
+        # The model has a fixed batch size
+        r = model.detect([image] * model.config.BATCH_SIZE, verbose=0)[0]
+        results.extend(build_coco_results_loop(dataset, coco_image_ids[i:i + 1],
+                                               r["rois"], r["class_ids"],
+                                               r["scores"], r["masks"]))
+    coco_results = coco_api.loadRes(results)
+    cocoEval = COCOeval(coco_api, coco_results, eval_type)
+    cocoEval.params.imgIds = coco_image_ids
+    cocoEval.evaluate()
+    cocoEval.accumulate()
+    cocoEval.summarize()
+    return cocoEval
+
+
+def detections(cocoEval):
+    """Returns the detections that a COCOeval evaluated, in a comparable form."""
+    return sorted((a["image_id"], a["category_id"], np.round(a["bbox"], 1).tolist(),
+                   round(float(a["score"]), 6), a["area"], a["segmentation"]["counts"])
+                  for a in cocoEval.cocoDt.anns.values())
+
+
+def load_eval_dataset(dataset_dir):
+    write_coco(dataset_dir)
+    dataset = coco.CocoDataset()
+    coco_api = dataset.load_coco(dataset_dir, "val", return_coco=True)
+    dataset.prepare()
+    return dataset, coco_api
+
+
+@pytest.mark.parametrize("eval_type", ["bbox", "segm"])
+def test_evaluate_coco(tmpdir, eval_type):
+    dataset, coco_api = load_eval_dataset(str(tmpdir))
+    # 4 images in batches of 3, so the last batch is padded
+    expected = evaluate_coco_loop(GroundTruthModel(dataset, 1), dataset, coco_api, eval_type)
+    cocoEval = coco.evaluate_coco(GroundTruthModel(dataset, 3), dataset, coco_api, eval_type,
+                                  loader_threads=2, encode_processes=2)
+    assert 0 < expected.stats[0] < 1
+    np.testing.assert_array_equal(cocoEval.stats, expected.stats)
+    assert detections(cocoEval) == detections(expected)
+
+
+def test_result_journal_resume(tmpdir):
+    dataset, coco_api = load_eval_dataset(str(tmpdir))
+    journal_path = str(tmpdir.join("results.jsonl"))
+    expected = coco.evaluate_coco(GroundTruthModel(dataset, 2), dataset, coco_api, "segm")
+
+    # An evaluation of the first images, then of all of them, only runs
+    # the model on the images that aren't in the journal yet
+    model = GroundTruthModel(dataset, 2)
+    coco.evaluate_coco(model, dataset, coco_api, "segm", limit=2, journal_path=journal_path)
+    assert model.detected == {0, 1}
+    model = GroundTruthModel(dataset, 2)
+    cocoEval = coco.evaluate_coco(model, dataset, coco_api, "segm", journal_path=journal_path)
+    assert model.detected == {2, 3}
+    np.testing.assert_array_equal(cocoEval.stats, expected.stats)
+    assert detections(cocoEval) == detections(expected)
+
+    # The journal has the weights and config, and a line per image
+    with open(journal_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0] == coco.result_journal_header(model)
+    assert lines[0]["weights"] == os.path.abspath("weights.h5")
+    assert lines[0]["config"]["NAME"] == "coco"
+    assert sorted(line["image_id"] for line in lines[1:]) == [100, 101, 102, 103]
+
+
+def test_result_journal_truncated_line(tmpdir):
+    dataset, coco_api = load_eval_dataset(str(tmpdir))
+    journal_path = str(tmpdir.join("results.jsonl"))
+    expected = coco.evaluate_coco(GroundTruthModel(dataset, 1), dataset, coco_api, "segm")
+
+    # A crash while writing the last image leaves part of its line
+    coco.evaluate_coco(GroundTruthModel(dataset, 1), dataset, coco_api, "segm",
+                       limit=2, journal_path=journal_path)
+    with open(journal_path) as f:
+        lines = f.readlines()
+    with open(journal_path, "w") as f:
+        f.write("".join(lines[:-1]) + lines[-1][:20])
+    assert [image_id for image_id, _ in coco.read_result_journal(journal_path)] == [100]
+
+    # The cut line is removed and its image evaluated again
+    model = GroundTruthModel(dataset, 1)
+    cocoEval = coco.evaluate_coco(model, dataset, coco_api, "segm", journal_path=journal_path)
+    assert model.detected == {1, 2, 3}
+    np.testing.assert_array_equal(cocoEval.stats, expected.stats)
+    with open(journal_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert sorted(line["image_id"] for line in lines[1:]) == [100, 101, 102, 103]
+
+    # So is a header that was cut short
+    with open(journal_path, "w") as f:
+        f.write('{"weights": ')
+    model = GroundTruthModel(dataset, 1)
+    cocoEval = coco.evaluate_coco(model, dataset, coco_api, "segm", journal_path=journal_path)
+    assert model.detected == {0, 1, 2, 3}
+    np.testing.assert_array_equal(cocoEval.stats, expected.stats)
+
+
+def test_result_journal_mismatch(tmpdir):
+    dataset, coco_api = load_eval_dataset(str(tmpdir))
+    journal_path = str(tmpdir.join("results.jsonl"))
+    coco.evaluate_coco(GroundTruthModel(dataset, 1), dataset, coco_api, limit=2,
+                       journal_path=journal_path)
+
+    # Other weights or detection settings aren't mixed into the journal
+    model = GroundTruthModel(dataset, 1, weights_path="other.h5")
+    with pytest.raises(Exception, match="different weights"):
+        coco.evaluate_coco(model, dataset, coco_api, journal_path=journal_path)
+    model = GroundTruthModel(dataset, 1)
+    model.config.DETECTION_MIN_CONFIDENCE = 0.5
+    with pytest.raises(Exception, match="different DETECTION_MIN_CONFIDENCE"):
+        coco.evaluate_coco(model, dataset, coco_api, journal_path=journal_path)
+    assert not model.detected
+
+    # The batch size doesn't change the results
+    model = GroundTruthModel(dataset, 3)
+    coco.evaluate_coco(model, dataset, coco_api, journal_path=journal_path)
+    assert model.detected == {2, 3}
@@ -0,0 +1,493 @@
+"""
+Smoke tests that build small Mask R-CNN graphs and run them on random
+images, and checks of the training targets against the reference loops
+in lib.benchmark. Skipped if TensorFlow or Keras isn't installed.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+K = pytest.importorskip("keras.backend")
+
+from lib.config import Config
+from lib import model as modellib
+from lib import utils
+from lib import benchmark
+
+
+class SmallConfig(Config):
+    NAME = "test"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 3
+    IMAGE_MIN_DIM = 128
+    IMAGE_MAX_DIM = 128
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+    PRE_NMS_LIMIT = 1000
+    POST_NMS_ROIS_TRAINING = 64
+    POST_NMS_ROIS_INFERENCE = 50
+    TRAIN_ROIS_PER_IMAGE = 16
+    MAX_GT_INSTANCES = 10
+    # The weights are random and their detections can be empty boxes, which
+    # masks can't be resized to. Drop all detections.
+    DETECTION_MIN_CONFIDENCE = 1.1
+
+
+def build_model(tmpdir, mode="inference", images_per_gpu=1):
+    K.clear_session()
+    tf.set_random_seed(0)
+    config = SmallConfig()
+    config.IMAGES_PER_GPU = images_per_gpu
+    config.__init__()
+    return modellib.MaskRCNN(mode, config, str(tmpdir))
+
+
+def random_images(count, shape=(100, 120)):
+    random_state = np.random.RandomState(0)
+    return [random_state.randint(0, 255, shape + (3,)).astype(np.uint8)
+            for _ in range(count)]
+
+
+def predict_rois(model, images):
+    molded_images, image_metas, _ = model.mold_inputs(images)
+    return model.keras_model.predict([molded_images, image_metas])[4]
+
+
+@pytest.fixture(scope="module")
+def model(tmpdir_factory):
+    return build_model(tmpdir_factory.mktemp("logs"))
+
+
+def test_detect(model):
+    results = model.detect(random_images(1))
+    assert len(results) == 1
+    assert results[0]["rois"].shape[1:] == (4,)
+
+
+def test_warmup(model, monkeypatch):
+    images = random_images(1)
+    expected = model.detect(images)[0]
+    expected_rois = predict_rois(model, images)
+
+    # Each iteration runs a full batch of images with the molded shape
+    calls = []
+    detect = model.detect
+    def counting_detect(images, verbose=0):
+        calls.append([image.shape for image in images])
+        return detect(images, verbose)
+    monkeypatch.setattr(model, "detect", counting_detect)
+    model.warmup(iterations=2)
+    monkeypatch.undo()
+    shape = tuple(model.config.IMAGE_SHAPE[:2]) + (3,)
+    assert calls == [[shape] * model.config.BATCH_SIZE] * 2
+
+    # Later images get the same proposals and detections as without the
+    # warmup. SmallConfig drops all detections, so compare both.
+    np.testing.assert_array_equal(predict_rois(model, images), expected_rois)
+    result = model.detect(images)[0]
+    for key in ["rois", "class_ids", "scores", "masks"]:
+        np.testing.assert_array_equal(result[key], expected[key])
+
+
+def test_proposal_params(model):
+    images = random_images(1)
+    config = model.config
+    try:
+        model.set_proposal_params(proposal_count=20)
+        assert predict_rois(model, images).shape == (1, 20, 4)
+        model.detect(images)
+        model.set_proposal_params(proposal_count=config.POST_NMS_ROIS_INFERENCE)
+
+        # A lower threshold suppresses more boxes. Keep all the boxes NMS
+        # returns, so the counts can differ.
+        model.set_proposal_params(proposal_count=config.PRE_NMS_LIMIT)
+        rois = predict_rois(model, images)
+        model.set_proposal_params(nms_threshold=0.01)
+        low = predict_rois(model, images)
+        assert np.count_nonzero(np.any(low, axis=2)) < \
+            np.count_nonzero(np.any(rois, axis=2))
+        model.detect(images)
+        model.set_proposal_params(nms_threshold=config.RPN_NMS_THRESHOLD,
+                                  proposal_count=config.POST_NMS_ROIS_INFERENCE)
+
+        # Only the top 30 anchors go into NMS
+        model.set_proposal_params(pre_nms_limit=30)
+        rois = predict_rois(model, images)
+        assert np.count_nonzero(np.any(rois, axis=2)) <= 30
+        model.detect(images)
+    finally:
+        model.set_proposal_params(pre_nms_limit=config.PRE_NMS_LIMIT,
+                                  nms_threshold=config.RPN_NMS_THRESHOLD,
+                                  proposal_count=config.POST_NMS_ROIS_INFERENCE)
+
+
+def test_load_weights_keeps_proposal_params(model, tmpdir):
+    path = str(tmpdir.join("weights.h5"))
+    model.set_proposal_params(pre_nms_limit=30)
+    model.keras_model.save_weights(path)
+    model.set_proposal_params(pre_nms_limit=model.config.PRE_NMS_LIMIT)
+    model.load_weights(path)
+    assert model.weights_path == path
+    layer = model.keras_model.get_layer("ROI")
+    assert K.get_value(layer.pre_nms_limit_var) == model.config.PRE_NMS_LIMIT
+
+
+def test_frozen_graph(model, tmpdir):
+    path = str(tmpdir.join("frozen.pb"))
+    model.export_frozen_graph(path)
+    frozen = modellib.FrozenMaskRCNN(model.config, path)
+    images = random_images(1)
+    expected = model.detect(images)[0]
+    result = frozen.detect(images)[0]
+    for key in ["rois", "class_ids", "scores", "masks"]:
+        np.testing.assert_array_equal(result[key], expected[key])
+
+    # Proposals and classifier outputs match the Keras model
+    molded_images, image_metas, _ = model.mold_inputs(images)
+    outputs = model.keras_model.predict([molded_images, image_metas])
+    t = frozen.tensors
+    feed = {t["input_image"]: molded_images, t["input_image_meta"]: image_metas}
+    if "learning_phase" in t:
+        feed[t["learning_phase"]] = 0
+    rois, mrcnn_class = frozen.session.run([t["rpn_rois"], t["mrcnn_class"]], feed)
+    np.testing.assert_allclose(rois, outputs[4], atol=1e-5)
+    np.testing.assert_allclose(mrcnn_class, outputs[1], atol=1e-5)
+    with pytest.raises(RuntimeError, match="immutable"):
+        frozen.set_proposal_params(proposal_count=10)
+
+
+def test_detect_batch(tmpdir):
+    model = build_model(tmpdir, images_per_gpu=2)
+    images = random_images(2)
+    assert predict_rois(model, images).shape == \
+        (2, model.config.POST_NMS_ROIS_INFERENCE, 4)
+    assert len(model.detect(images)) == 2
+
+    # Each image's ROIs are classified with its own features
+    def classify(images):
+        molded_images, image_metas, _ = model.mold_inputs(images)
+        return model.keras_model.predict([molded_images, image_metas])[1]
+    mrcnn_class = classify(images)
+    np.testing.assert_allclose(classify(images[::-1]), mrcnn_class[::-1],
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_build_training_batch(tmpdir):
+    model = build_model(tmpdir, mode="training", images_per_gpu=2)
+    assert model.keras_model.get_layer("roi_align_classifier")\
+        .output_shape[:2] == (None, model.config.TRAIN_ROIS_PER_IMAGE)
+
+
+def random_rpn_gt_boxes(config, count):
+    gt_boxes = benchmark.random_gt_boxes(config.IMAGE_SHAPE, count,
+                                         np.random.RandomState(count))
+    # A duplicate box ties on every IoU, and an empty box overlaps nothing
+    return np.concatenate([gt_boxes, gt_boxes[:1], np.zeros_like(gt_boxes[:1])])
+
+
+def rpn_anchor_grid(config):
+    return utils.AnchorGrid(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                            config.BACKBONE_SHAPES, config.BACKBONE_STRIDES, 1)
+
+
+@pytest.mark.parametrize("count", [1, 10, 50])
+def test_build_rpn_targets(count):
+    config = SmallConfig()
+    anchor_grid = rpn_anchor_grid(config)
+    anchors = anchor_grid.anchors
+    gt_boxes = random_rpn_gt_boxes(config, count)
+    np.random.seed(0)
+    expected = benchmark.build_rpn_targets_loop(config.IMAGE_SHAPE, anchors,
+                                                gt_boxes, config)
+    for grid in [None, anchor_grid]:
+        np.random.seed(0)
+        rpn_match, rpn_bbox = modellib.build_rpn_targets(
+            config.IMAGE_SHAPE, anchors, gt_boxes, config, anchor_grid=grid)
+        np.testing.assert_array_equal(rpn_match, expected[0])
+        np.testing.assert_array_equal(rpn_bbox, expected[1])
+
+
+@pytest.mark.parametrize("count", [1, 10, 50])
+def test_match_anchors_sparse(count):
+    config = SmallConfig()
+    anchor_grid = rpn_anchor_grid(config)
+    anchors = anchor_grid.anchors
+    gt_boxes = random_rpn_gt_boxes(config, count)
+    overlaps = utils.compute_overlaps(anchors, gt_boxes[:, :4])
+    anchor_iou_argmax, anchor_iou_max, gt_iou_argmax = \
+        modellib.match_anchors_sparse(anchors.shape[0], gt_boxes, anchor_grid)
+    np.testing.assert_array_equal(anchor_iou_argmax, np.argmax(overlaps, axis=1))
+    np.testing.assert_array_equal(anchor_iou_max, np.max(overlaps, axis=1))
+    np.testing.assert_array_equal(gt_iou_argmax, np.argmax(overlaps, axis=0))
+
+
+def generate_random_rois_loop(image_shape, count, gt_boxes):
+    """The original generate_random_rois(), which draws coordinate pairs
+    and rejects equal ones until it has enough, one GT box at a time.
+    """
+    rois = np.zeros((count, 4), dtype=np.int32)
+    rois_per_box = int(0.9 * count / gt_boxes.shape[0])
+    for i in range(gt_boxes.shape[0]):
+        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i, :4]
+        h = gt_y2 - gt_y1
+        w = gt_x2 - gt_x1
+        r_y1 = max(gt_y1 - h, 0)
+        r_y2 = min(gt_y2 + h, image_shape[0])
+        r_x1 = max(gt_x1 - w, 0)
+        r_x2 = min(gt_x2 + w, image_shape[1])
+        while True:
+            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
+            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
+            y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >= 1][:rois_per_box]
+            x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >= 1][:rois_per_box]
+            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
+                break
+        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
+        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
+        rois[rois_per_box * i:rois_per_box * (i + 1)] = np.hstack([y1, x1, y2, x2])
+
+    remaining_count = count - (rois_per_box * gt_boxes.shape[0])
+    while True:
+        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
+        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
+        y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >= 1][:remaining_count]
+        x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >= 1][:remaining_count]
+        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
+            break
+    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
+    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
+    rois[-remaining_count:] = np.hstack([y1, x1, y2, x2])
+    return rois
+
+
+def test_generate_random_rois():
+    image_shape = (128, 160, 3)
+    gt_boxes = benchmark.random_gt_boxes(image_shape, 4, np.random.RandomState(0))
+    # Small boxes at the edges, so their ranges are clipped to the image
+    gt_boxes = np.concatenate([gt_boxes, [[0, 0, 3, 2, 1], [126, 158, 128, 160, 2]]])
+    count = 6005
+    rois_per_box = int(0.9 * count / len(gt_boxes))
+    rois = modellib.generate_random_rois(image_shape, count, gt_boxes,
+                                         np.random.RandomState(1))
+    np.testing.assert_array_equal(
+        rois, modellib.generate_random_rois(image_shape, count, gt_boxes,
+                                            np.random.RandomState(1)))
+    np.random.seed(2)
+    expected = generate_random_rois_loop(image_shape, count, gt_boxes)
+    assert rois.shape == expected.shape == (count, 4)
+    assert rois.dtype == np.int32
+
+    # The first ROIs are within the GT boxes grown by their size on every
+    # side, rois_per_box for each. The rest are anywhere in the image.
+    # Neither has empty ROIs.
+    near = len(gt_boxes) * rois_per_box
+    y1, x1, y2, x2 = np.split(gt_boxes[:, :4], 4, axis=1)
+    h, w = y2 - y1, x2 - x1
+    grown = np.hstack([y1 - h, x1 - w, y2 + h, x2 + w])
+    lo = np.maximum(np.repeat(grown[:, :2], rois_per_box, axis=0), 0)
+    hi = np.minimum(np.repeat(grown[:, 2:], rois_per_box, axis=0), image_shape[:2])
+    for r in [rois, expected]:
+        assert np.all(r[:near, :2] >= lo) and np.all(r[:near, 2:] < hi)
+        assert np.all(r >= 0) and np.all(r[near:, 2:] < image_shape[:2])
+        assert np.all(r[:, 2:] > r[:, :2])
+
+    # Same distribution as the rejection sampler, compared for each GT box
+    # and for the random ROIs. Means and standard deviations of the
+    # coordinates and sizes agree within 5 standard errors.
+    starts = list(range(0, near + 1, rois_per_box)) + [count]
+    for start, end in zip(starts[:-1], starts[1:]):
+        values = [np.hstack([r, r[:, 2:] - r[:, :2]])[start:end].astype(np.float64)
+                  for r in [rois, expected]]
+        std = values[1].std(axis=0)
+        error = np.maximum(std, 0.5) * np.sqrt(2.0 / (end - start))
+        assert np.all(np.abs(values[0].mean(axis=0) - values[1].mean(axis=0)) < 5 * error)
+        assert np.all(np.abs(values[0].std(axis=0) - std) < 5 * error)
+
+    # A GT box without area uses the whole image rather than failing
+    rois = modellib.generate_random_rois(image_shape, 20, np.array([[5, 5, 5, 5, 1]]),
+                                         np.random.RandomState(0))
+    assert np.all(rois[:, 2:] > rois[:, :2]) and np.all(rois[:, 2:] < image_shape[:2])
+
+
+class RandomBoxDataset(utils.Dataset):
+    """Noise images with rectangular instances. Image 2 has no instances."""
+
+    def load_boxes(self, count):
+        self.add_class("boxes", 1, "box")
+        self.add_class("boxes", 2, "wide box")
+        for i in range(count):
+            self.add_image("boxes", i, None)
+
+    def load_image(self, image_id):
+        random_state = np.random.RandomState(image_id)
+        return random_state.randint(0, 255, (100, 120, 3)).astype(np.uint8)
+
+    def load_mask(self, image_id):
+        # Changing the seed of an image changes its instances
+        random_state = np.random.RandomState(
+            self.image_info[image_id].get("seed", image_id))
+        count = 0 if image_id == 2 else 3
+        mask = np.zeros([100, 120, count], dtype=np.uint8)
+        for i in range(count):
+            y1, x1 = random_state.randint(0, 60, 2)
+            h, w = random_state.randint(10, 40, 2)
+            mask[y1:y1 + h, x1:x1 + w, i] = 1
+        return mask, np.array([1, 2, 1][:count], dtype=np.int32)
+
+
+def test_data_loader():
+    config = SmallConfig()
+    dataset = RandomBoxDataset()
+    dataset.load_boxes(5)
+    dataset.prepare()
+    anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                   config.RPN_ANCHOR_RATIOS,
+                                   config.BACKBONE_SHAPES,
+                                   config.BACKBONE_STRIDES,
+                                   config.RPN_ANCHOR_STRIDE)
+    loader = modellib.DataLoader(dataset, config, shuffle=False, augment=False,
+                                 batch_size=2, processes=2)
+    try:
+        image_ids = []
+        for _ in range(3):
+            inputs, outputs = next(loader)
+            assert outputs == []
+            images, image_metas, rpn_match, rpn_bbox, gt_boxes, gt_masks = inputs
+            for b in range(2):
+                image_id = int(image_metas[b, 0])
+                image_ids.append(image_id)
+                image, image_meta, match, bbox, boxes, masks = modellib.load_sample(
+                    dataset, config, image_id, anchor_grid)
+                np.testing.assert_array_equal(
+                    images[b], (image - config.MEAN_PIXEL).astype(np.float32))
+                np.testing.assert_array_equal(image_metas[b], image_meta)
+                np.testing.assert_array_equal(gt_boxes[b, :boxes.shape[0]], boxes)
+                assert not gt_boxes[b, boxes.shape[0]:].any()
+                np.testing.assert_array_equal(
+                    gt_masks[b, :, :, :masks.shape[-1]], masks)
+                # Negative anchors are sampled at random, positives aren't
+                # while there are few of them.
+                positive = match == 1
+                np.testing.assert_array_equal(rpn_match[b, :, 0] == 1, positive)
+                np.testing.assert_array_equal(rpn_bbox[b], bbox)
+                assert np.sum(rpn_match[b] == -1) == \
+                    config.RPN_TRAIN_ANCHORS_PER_IMAGE - np.sum(positive)
+        # The image without instances is replaced
+        assert 2 not in image_ids
+        assert set(image_ids) == {0, 1, 3, 4}
+    finally:
+        loader.close()
+
+
+class ExitingDataset(RandomBoxDataset):
+    """Exits the worker process that loads an image."""
+
+    def load_image(self, image_id):
+        os._exit(3)
+
+
+def test_data_loader_worker_exit():
+    dataset = ExitingDataset()
+    dataset.load_boxes(2)
+    dataset.prepare()
+    loader = modellib.DataLoader(dataset, SmallConfig(), batch_size=1,
+                                 processes=1)
+    try:
+        with pytest.raises(Exception, match="exited with code 3"):
+            next(loader)
+    finally:
+        loader.close()
+
+
+def check_cached_sample(dataset, config, image_id, sample):
+    """Checks a TargetCache sample against load_image_gt() and
+    build_rpn_targets() with the same random seed.
+    """
+    expected = modellib.load_image_gt(dataset, config, image_id,
+                                      use_mini_mask=config.USE_MINI_MASK)
+    for actual, value in zip(sample[:4], expected):
+        np.testing.assert_array_equal(actual, value)
+    anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                   config.RPN_ANCHOR_RATIOS,
+                                   config.BACKBONE_SHAPES,
+                                   config.BACKBONE_STRIDES,
+                                   config.RPN_ANCHOR_STRIDE)
+    np.random.seed(image_id)
+    rpn_match, rpn_bbox = modellib.build_rpn_targets(
+        expected[0].shape, anchor_grid.anchors, expected[2], config,
+        anchor_grid=anchor_grid)
+    np.testing.assert_array_equal(sample[4], rpn_match)
+    np.testing.assert_allclose(sample[5], rpn_bbox, rtol=1e-6)
+
+
+def load_cached_sample(cache, image_id):
+    np.random.seed(image_id)
+    return cache.load(image_id)
+
+
+def test_target_cache(tmpdir, monkeypatch):
+    config = SmallConfig()
+    dataset = RandomBoxDataset()
+    dataset.load_boxes(4)
+    dataset.prepare()
+    cache = modellib.TargetCache(str(tmpdir), dataset, config)
+
+    # Misses build the targets and write a file per image
+    for image_id in dataset.image_ids:
+        assert not os.path.exists(cache.image_file(image_id))
+        sample = load_cached_sample(cache, image_id)
+        assert os.path.exists(cache.image_file(image_id))
+        if image_id == 2:
+            assert sample is None
+        else:
+            check_cached_sample(dataset, config, image_id, sample)
+
+    # Hits read the files without loading the images
+    def fail(image_id):
+        raise AssertionError("Image {} isn't cached".format(image_id))
+    with monkeypatch.context() as patch:
+        patch.setattr(dataset, "load_image", fail)
+        patch.setattr(dataset, "load_mask", fail)
+        samples = [load_cached_sample(cache, image_id)
+                   for image_id in dataset.image_ids]
+    assert samples[2] is None
+    for image_id in [0, 1, 3]:
+        check_cached_sample(dataset, config, image_id, samples[image_id])
+
+
+def test_target_cache_invalidation(tmpdir):
+    config = SmallConfig()
+    dataset = RandomBoxDataset()
+    dataset.load_boxes(2)
+    dataset.prepare()
+    cache = modellib.TargetCache(str(tmpdir), dataset, config)
+    cache.build()
+    old_file = cache.image_file(0)
+    old_sample = load_cached_sample(cache, 0)
+
+    # Changed annotations use a new file with the new instances
+    dataset.image_info[0]["seed"] = 10
+    assert cache.image_file(0) != old_file
+    assert cache.image_file(1) == modellib.TargetCache(
+        str(tmpdir), dataset, config).image_file(1)
+    sample = load_cached_sample(cache, 0)
+    assert not np.array_equal(sample[2], old_sample[2])
+    check_cached_sample(dataset, config, 0, sample)
+
+    # So does a config change that affects the targets, but not one that's
+    # applied when reading
+    class ReadConfig(SmallConfig):
+        MAX_GT_INSTANCES = 50
+
+    class TargetConfig(SmallConfig):
+        IMAGE_MIN_DIM = IMAGE_MAX_DIM = 64
+
+    assert modellib.TargetCache(str(tmpdir), dataset, ReadConfig()).path == cache.path
+    assert modellib.TargetCache(str(tmpdir), dataset, TargetConfig()).path != cache.path
@@ -0,0 +1,408 @@
+"""
+Tests of lib.utils. The vectorized functions are checked against the
+reference loops in lib.benchmark.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+
+import copy
+import json
+import pickle
+
+import numpy as np
+import pytest
+import scipy.misc
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("skimage")
+
+from lib import utils
+from lib import benchmark
+
+
+############################################################
+#  Bounding Boxes
+############################################################
+
+def extract_bboxes_loop(mask):
+    """The original extract_bboxes(), one instance at a time."""
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    for i in range(mask.shape[-1]):
+        horizontal_indicies = np.where(np.any(mask[:, :, i], axis=0))[0]
+        vertical_indicies = np.where(np.any(mask[:, :, i], axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            boxes[i] = [y1, x1, y2 + 1, x2 + 1]
+    return boxes
+
+
+def test_extract_bboxes():
+    masks = np.random.RandomState(0).rand(40, 50, 6) > 0.995
+    masks[:, :, 0] = False
+    masks[:, :, 1] = False
+    masks[5, 7, 1] = True
+    masks[:, :, 2] = True
+    boxes = utils.extract_bboxes(masks)
+    assert boxes.dtype == np.int32
+    np.testing.assert_array_equal(boxes, extract_bboxes_loop(masks))
+    np.testing.assert_array_equal(boxes[:3], [[0, 0, 0, 0], [5, 7, 6, 8],
+                                              [0, 0, 40, 50]])
+    assert utils.extract_bboxes(masks[:, :, :0]).shape == (0, 4)
+
+
+def test_compute_overlaps():
+    random_state = np.random.RandomState(0)
+    boxes1 = benchmark.random_gt_boxes((1024, 1024), 1000, random_state)[:, :4]
+    boxes2 = benchmark.random_gt_boxes((1024, 1024), 30, random_state)[:, :4]
+    expected = benchmark.compute_overlaps_loop(boxes1, boxes2)
+    np.testing.assert_array_equal(utils.compute_overlaps(boxes1, boxes2), expected)
+    # Many small chunks of rows
+    np.testing.assert_array_equal(
+        utils.compute_overlaps(boxes1, boxes2, chunk_size=100), expected)
+    overlaps = utils.compute_overlaps(boxes1, boxes2, dtype=np.float32)
+    assert overlaps.dtype == np.float32
+    np.testing.assert_allclose(overlaps, expected, atol=1e-6)
+
+    boxes1, _ = benchmark.random_clustered_boxes(500, random_state)
+    boxes2, _ = benchmark.random_clustered_boxes(40, random_state)
+    np.testing.assert_array_equal(utils.compute_overlaps(boxes1, boxes2),
+                                  benchmark.compute_overlaps_loop(boxes1, boxes2))
+    assert utils.compute_overlaps(boxes1, boxes2[:0]).shape == (500, 0)
+
+
+@pytest.mark.parametrize("count", [1, 100, 1000])
+@pytest.mark.parametrize("threshold", [0.3, 0.7])
+def test_non_max_suppression(count, threshold):
+    boxes, scores = benchmark.random_clustered_boxes(count, np.random.RandomState(0))
+    expected = benchmark.non_max_suppression_loop(boxes, scores, threshold)
+    for block_size in [128, 7]:
+        pick = utils.non_max_suppression(boxes, scores, threshold,
+                                         block_size=block_size)
+        np.testing.assert_array_equal(pick, expected)
+        # Stops after the first picks
+        pick = utils.non_max_suppression(boxes, scores, threshold,
+                                         max_output_size=10,
+                                         block_size=block_size)
+        np.testing.assert_array_equal(pick, expected[:10])
+    # Integer boxes
+    boxes = np.round(boxes).astype(np.int32)
+    np.testing.assert_array_equal(
+        utils.non_max_suppression(boxes, scores, threshold),
+        benchmark.non_max_suppression_loop(boxes, scores, threshold))
+
+
+############################################################
+#  Dataset
+############################################################
+
+def test_info_table():
+    table = utils.InfoTable()
+    expected = []
+    for i in range(5):
+        row = {"id": i, "source": "a", "path": "image{}.jpg".format(i)}
+        if i % 2:
+            row["annotations"] = [{"id": i}]
+        table.append(row)
+        expected.append(row)
+        # Reading while adding rows doesn't pack them
+        assert table[i] == row
+    table.extend({"id": np.arange(5, 8), "source": np.array(["b"] * 3),
+                  "path": ["x", "y", "z"], "width": np.array([10, 20, 30])})
+    expected += [{"id": 5, "source": "b", "path": "x", "width": 10},
+                 {"id": 6, "source": "b", "path": "y", "width": 20},
+                 {"id": 7, "source": "b", "path": "z", "width": 30}]
+    assert list(table) == expected
+    assert table.blocks
+
+    table.pack()
+    assert not table.blocks
+    assert table.columns["id"].dtype == np.int64
+    assert table.columns["source"].dtype.kind == "S"
+    assert list(table) == expected
+    assert table[-1] == expected[-1]
+    assert table[2:4] == expected[2:4]
+
+    # Rows are plain dicts
+    assert json.loads(json.dumps(table[1])) == expected[1]
+    assert copy.deepcopy(table[1]) == expected[1]
+    assert pickle.loads(pickle.dumps(table))[:] == expected
+
+    # Setting a key of a row sets it in the table
+    row = table[0]
+    row["id"] = 100
+    assert table[0]["id"] == 100
+    table.set(1, "id", "first")
+    table[2].update(new=1.5)
+    expected[0]["id"] = 100
+    expected[1]["id"] = "first"
+    expected[2]["new"] = 1.5
+    assert list(table) == expected
+    with pytest.raises(TypeError):
+        del table[0]["id"]
+    # Only the value that doesn't fit makes the column an object array
+    assert table.columns["id"].dtype == np.int64
+    table.pack()
+    assert table.columns["id"].dtype == object
+    assert list(table) == expected
+
+
+def test_info_table_pending_rows():
+    table = utils.InfoTable()
+    table.extend({"id": np.arange(3), "path": ["a", "b", "c"]})
+    table.append({"id": 3})
+    # Keys that other rows of a pending block don't have
+    table.set(0, "extra", 1)
+    table[3]["path"] = "d"
+    expected = [{"id": 0, "path": "a", "extra": 1}, {"id": 1, "path": "b"},
+                {"id": 2, "path": "c"}, {"id": 3, "path": "d"}]
+    assert list(table) == expected
+    table.pack()
+    assert list(table) == expected
+    # Rows added after packing
+    table.extend({"id": [4]})
+    table[4]["extra"] = 2
+    assert table[1] == expected[1]
+    assert table[4] == {"id": 4, "extra": 2}
+
+
+############################################################
+#  Masks
+############################################################
+
+def random_masks(shape, count, random_state):
+    """Elliptical masks of random sizes and positions. [height, width, count]"""
+    masks = np.zeros(tuple(shape) + (count,), dtype=bool)
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    for i in range(count):
+        h, w = random_state.randint(4, min(shape), 2)
+        y1 = random_state.randint(0, shape[0] - h)
+        x1 = random_state.randint(0, shape[1] - w)
+        masks[:, :, i] = ((y - y1 - h / 2) / (h / 2)) ** 2 + \
+            ((x - x1 - w / 2) / (w / 2)) ** 2 <= 1
+    return masks
+
+
+def test_mini_mask_matches_imresize():
+    imresize = getattr(scipy.misc, "imresize", None)
+    if imresize is None:
+        pytest.skip("scipy.misc.imresize() was removed in SciPy 1.3")
+    masks = random_masks((200, 300), 20, np.random.RandomState(0))
+    boxes = utils.extract_bboxes(masks)
+    mini_masks = utils.minimize_mask(boxes, masks, (56, 56))
+    expanded = utils.expand_mask(boxes, mini_masks, masks.shape)
+    mini_diff = expanded_diff = 0
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        m = imresize(masks[y1:y2, x1:x2, i].astype(float), (56, 56),
+                     interp="bilinear") >= 128
+        mini_diff += np.count_nonzero(m != mini_masks[:, :, i])
+        m = imresize(mini_masks[:, :, i].astype(float), (y2 - y1, x2 - x1),
+                     interp="bilinear") >= 128
+        expanded_diff += np.count_nonzero(m != expanded[y1:y2, x1:x2, i])
+    # PIL rounds to uint8 between its two passes, so pixels that are close
+    # to the threshold can differ.
+    assert mini_diff <= 0.01 * mini_masks.size
+    assert expanded_diff <= 0.01 * np.sum((boxes[:, 2] - boxes[:, 0]) *
+                                          (boxes[:, 3] - boxes[:, 1]))
+
+
+def test_mini_mask_full_box():
+    # imresize() turned masks that fill their box into empty mini-masks
+    masks = np.zeros((50, 60, 2), dtype=bool)
+    masks[10:20, 5:45, 0] = True
+    masks[:, :, 1] = random_masks((50, 60), 1, np.random.RandomState(0))[:, :, 0]
+    boxes = utils.extract_bboxes(masks)
+    mini_masks = utils.minimize_mask(boxes, masks, (28, 28))
+    assert mini_masks[:, :, 0].all()
+    np.testing.assert_array_equal(
+        utils.expand_mask(boxes, mini_masks, masks.shape)[:, :, 0], masks[:, :, 0])
+
+    # No instances
+    mini_masks = utils.minimize_mask(np.zeros((0, 4), np.int32),
+                                     np.zeros((50, 60, 0), bool), (28, 28))
+    assert mini_masks.shape == (28, 28, 0)
+    assert utils.expand_mask(np.zeros((0, 4), np.int32), mini_masks,
+                             (50, 60)).shape == (50, 60, 0)
+
+
+def resize_nearest(mask, shape):
+    """Nearest neighbor resize of a 2D mask, sampling the source pixel
+    under the center of each output pixel.
+    """
+    ys = np.floor((np.arange(shape[0]) + 0.5) * mask.shape[0] / shape[0]).astype(np.int32)
+    xs = np.floor((np.arange(shape[1]) + 0.5) * mask.shape[1] / shape[1]).astype(np.int32)
+    return mask[ys[:, None], xs[None, :]]
+
+
+def imresize_nearest(mask, shape):
+    """scipy.misc.imresize() of a bool mask. It's passed as uint8, because
+    imresize() rescales float values, which turned crops without any 0
+    into zeros.
+    """
+    return scipy.misc.imresize(mask.astype(np.uint8) * 255, shape, interp="nearest") >= 128
+
+
+def crop_and_resize_masks_loop(masks, boxes, mask_ids, shape, resize,
+                               mini_mask_boxes=None, image_shape=None):
+    """The per-instance loop of the original build_detection_targets().
+    Expands each mini-mask into its box in a full size mask, then crops the
+    region and resizes it with the given nearest neighbor resize function.
+    """
+    result = np.zeros((len(boxes),) + tuple(shape), dtype=bool)
+    for i, (box, mask_id) in enumerate(zip(boxes, mask_ids)):
+        mask = masks[:, :, mask_id]
+        if mini_mask_boxes is not None:
+            placeholder = np.zeros(image_shape, dtype=bool)
+            y1, x1, y2, x2 = mini_mask_boxes[mask_id]
+            placeholder[y1:y2, x1:x2] = resize(mask, (y2 - y1, x2 - x1))
+            mask = placeholder
+        y1, x1, y2, x2 = box.astype(np.int32)
+        result[i] = resize(mask[y1:y2, x1:x2], shape)
+    return result
+
+
+@pytest.mark.parametrize("use_mini_mask", [False, True])
+def test_crop_and_resize_masks(use_mini_mask):
+    random_state = np.random.RandomState(0)
+    image_shape = (100, 120)
+    masks = random_masks(image_shape, 8, random_state)
+    gt_boxes = utils.extract_bboxes(masks)
+    # ROIs of all sizes, often only partly over their GT box, and some
+    # that are smaller than the output masks
+    count = 200
+    y1 = random_state.randint(0, image_shape[0] - 1, count)
+    x1 = random_state.randint(0, image_shape[1] - 1, count)
+    y2 = y1 + 1 + (random_state.rand(count) * (image_shape[0] - 1 - y1)).astype(np.int32)
+    x2 = x1 + 1 + (random_state.rand(count) * (image_shape[1] - 1 - x1)).astype(np.int32)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.float32)
+    mask_ids = random_state.randint(0, masks.shape[-1], count)
+
+    if use_mini_mask:
+        masks = utils.minimize_mask(gt_boxes, masks, (28, 28))
+        mini_mask_boxes = gt_boxes
+    else:
+        mini_mask_boxes = None
+    result = utils.crop_and_resize_masks(masks, boxes, mask_ids, (28, 28),
+                                         mini_mask_boxes=mini_mask_boxes)
+    assert result.dtype == bool and result.shape == (count, 28, 28)
+    assert result.any()
+    expected = crop_and_resize_masks_loop(masks, boxes, mask_ids, (28, 28), resize_nearest,
+                                          mini_mask_boxes=mini_mask_boxes,
+                                          image_shape=image_shape)
+    np.testing.assert_array_equal(result, expected)
+
+    # PIL computes the source pixels in fixed point, so pixel centers that
+    # fall exactly on a source pixel boundary can round the other way.
+    if getattr(scipy.misc, "imresize", None) is not None:
+        expected = crop_and_resize_masks_loop(masks, boxes, mask_ids, (28, 28),
+                                              imresize_nearest,
+                                              mini_mask_boxes=mini_mask_boxes,
+                                              image_shape=image_shape)
+        assert np.count_nonzero(result != expected) <= 0.001 * result.size
+
+
+############################################################
+#  Anchors
+############################################################
+
+@pytest.mark.parametrize("anchor_stride", [1, 2])
+def test_anchor_grid_overlaps(anchor_stride):
+    config = benchmark.BenchmarkConfig()
+    anchor_grid = utils.AnchorGrid(config.RPN_ANCHOR_SCALES,
+                                   config.RPN_ANCHOR_RATIOS,
+                                   config.BACKBONE_SHAPES,
+                                   config.BACKBONE_STRIDES, anchor_stride)
+    np.testing.assert_array_equal(
+        anchor_grid.anchors,
+        utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                       config.RPN_ANCHOR_RATIOS,
+                                       config.BACKBONE_SHAPES,
+                                       config.BACKBONE_STRIDES, anchor_stride))
+    boxes = benchmark.random_gt_boxes(config.IMAGE_SHAPE, 20,
+                                      np.random.RandomState(0))[:, :4]
+    # Boxes at the edges of the image
+    boxes = np.concatenate([boxes, [[0, 0, 8, 8], [1016, 1016, 1024, 1024]]])
+    anchor_ids, box_ids, ious = anchor_grid.overlaps(boxes)
+    sparse = np.zeros([anchor_grid.anchors.shape[0], boxes.shape[0]])
+    sparse[anchor_ids, box_ids] = ious
+    np.testing.assert_array_equal(
+        sparse, utils.compute_overlaps(anchor_grid.anchors, boxes))
+    # Each pair once
+    assert len(set(zip(anchor_ids, box_ids))) == len(anchor_ids)
+
+
+############################################################
+#  Miscellaneous
+############################################################
+
+def compute_ap_loop(gt_boxes, gt_class_ids, pred_boxes, pred_class_ids,
+                    pred_scores, iou_threshold=0.5):
+    """The original compute_ap(), which matches one prediction at a time."""
+    gt_boxes = utils.trim_zeros(gt_boxes)
+    pred_boxes = utils.trim_zeros(pred_boxes)
+    pred_scores = pred_scores[:pred_boxes.shape[0]]
+    indices = np.argsort(pred_scores)[::-1]
+    pred_boxes = pred_boxes[indices]
+    pred_class_ids = pred_class_ids[indices]
+    overlaps = benchmark.compute_overlaps_loop(pred_boxes, gt_boxes)
+
+    pred_match = np.zeros([pred_boxes.shape[0]])
+    gt_match = np.zeros([gt_boxes.shape[0]])
+    for i in range(len(pred_boxes)):
+        for j in np.argsort(overlaps[i])[::-1]:
+            if gt_match[j] == 1:
+                continue
+            if overlaps[i, j] < iou_threshold:
+                break
+            if pred_class_ids[i] == gt_class_ids[j]:
+                gt_match[j] = 1
+                pred_match[i] = 1
+                break
+
+    precisions = np.cumsum(pred_match) / (np.arange(len(pred_match)) + 1)
+    recalls = np.cumsum(pred_match).astype(np.float32) / len(gt_match)
+    precisions = np.concatenate([[0], precisions, [0]])
+    recalls = np.concatenate([[0], recalls, [1]])
+    for i in range(len(precisions) - 2, -1, -1):
+        precisions[i] = np.maximum(precisions[i], precisions[i + 1])
+    indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
+    return np.sum((recalls[indices] - recalls[indices - 1]) * precisions[indices])
+
+
+def random_ap_sample(random_state, gt_count=10, pred_count=30):
+    """GT boxes padded with zeros, and predictions that are jittered copies
+    of them plus random boxes. Some predictions have the wrong class.
+    """
+    gt_boxes, _ = benchmark.random_clustered_boxes(gt_count, random_state, 256)
+    gt_boxes = np.concatenate([gt_boxes, np.zeros([3, 4], np.float32)])
+    gt_class_ids = random_state.randint(1, 4, gt_count + 3)
+    ids = random_state.randint(0, gt_count, pred_count)
+    pred_boxes = gt_boxes[ids] + random_state.normal(0, 8, [pred_count, 4])
+    pred_boxes[::5] = benchmark.random_clustered_boxes(
+        len(pred_boxes[::5]), random_state, 256)[0]
+    pred_class_ids = gt_class_ids[ids]
+    pred_class_ids[::4] = random_state.randint(1, 4, len(pred_class_ids[::4]))
+    pred_scores = random_state.uniform(0, 1, pred_count)
+    return gt_boxes, gt_class_ids, pred_boxes, pred_class_ids, pred_scores
+
+
+def test_compute_ap():
+    random_state = np.random.RandomState(0)
+    samples = [random_ap_sample(random_state) for _ in range(10)]
+    samples.append(random_ap_sample(random_state, pred_count=0))
+    expected = np.array([[compute_ap_loop(*sample, iou_threshold=t)
+                          for t in utils.COCO_IOU_THRESHOLDS]
+                         for sample in samples])
+    assert 0 < expected.mean() < 1
+    for sample, APs in zip(samples, expected):
+        np.testing.assert_allclose(utils.compute_ap(*sample)[0], APs[0])
+        np.testing.assert_allclose(
+            utils.compute_ap(*sample, iou_threshold=0.75)[0], APs[5])
+        np.testing.assert_allclose(utils.compute_ap_range(*sample), APs)
+    np.testing.assert_allclose(utils.compute_dataset_ap(samples), expected)
+    np.testing.assert_allclose(
+        utils.compute_dataset_ap(iter(samples), iou_thresholds=[0.5, 0.75],
+                                 processes=2),
+        expected[:, [0, 5]])
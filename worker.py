@@ -1,13 +1,10 @@
 import os
 import time
 import cv2
-import visualize
 
 from PyQt5.QtCore import QThread, pyqtSignal
 from enums import Actions, Requests
 from enum import Enum
-from lib import model as modellib
-from lib import coco
 
 # COCO Class names
 # Index of the class in the list is its ID. For example, to get ID of
@@ -28,15 +25,6 @@ class_names = ['BG', 'person', 'bicycle', 'car', 'motorcycle', 'airplane',
                'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors',
                'teddy bear', 'hair drier', 'toothbrush']
 
-class InferenceConfig(coco.CocoConfig):
-    # Set batch size to 1 since we'll be running inference on
-    # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
-    GPU_COUNT = 1
-    IMAGES_PER_GPU = 1
-
-config = InferenceConfig()
-config.print()
-
 # Root directory of the project
 ROOT_DIR = os.getcwd()
 
@@ -48,6 +36,11 @@ MODEL_DIR = os.path.join(ROOT_DIR, "logs")
 # project (See README file for details)
 COCO_MODEL_PATH = os.path.join(ROOT_DIR, "weights/mask_rcnn_coco.h5")
 
+# Path to the frozen inference graph. If it exists it's loaded instead of
+# building the model and loading the weights above. Create it with:
+# python -m lib.coco export --model=coco --output=weights/mask_rcnn_coco.pb
+FROZEN_MODEL_PATH = os.path.join(ROOT_DIR, "weights/mask_rcnn_coco.pb")
+
 # Directory of images to run detection on
 IMAGE_DIR = os.path.join(ROOT_DIR, "images")
 
@@ -67,6 +60,8 @@ class Worker(QThread):
         self.showBoxes = False
         self.saveVideo = False
         self.fps = 0
+        self.filePath = None
+        self.loadingStatus = ''
 
     def setVideo(self, filePath):
         self.filePath = filePath
@@ -113,11 +108,48 @@ class Worker(QThread):
         if request is Requests.SAVE_OFF and self.stopped:
             self.saveVideo = False
 
-    def run(self):
+    def reportLoading(self, status):
+        # The window reads the status when it receives the action
+        self.loadingStatus = status
         self.communicator.emit(Actions.LOADING_WEIGHTS)
 
-        model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR, config=config)
-        model.load_weights(COCO_MODEL_PATH, by_name=True)
+    def loadModel(self):
+        # TensorFlow and Keras are imported here rather than at the top of the
+        # file so the window can be shown before they have finished loading
+        self.reportLoading('Importing TensorFlow...')
+        from lib import model as modellib
+        from lib import coco
+
+        class InferenceConfig(coco.CocoConfig):
+            # Set batch size to 1 since we'll be running inference on
+            # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
+            GPU_COUNT = 1
+            IMAGES_PER_GPU = 1
+
+        config = InferenceConfig()
+        config.print()
+
+        if os.path.exists(FROZEN_MODEL_PATH):
+            self.reportLoading('Loading frozen model...')
+            model = modellib.FrozenMaskRCNN(config, FROZEN_MODEL_PATH)
+        else:
+            self.reportLoading('Building model...')
+            model = modellib.MaskRCNN(mode="inference", model_dir=MODEL_DIR, config=config)
+
+            self.reportLoading('Loading weights...')
+            model.load_weights(COCO_MODEL_PATH, by_name=True)
+
+        # Run a few detections so the first frames of the video aren't slow
+        self.reportLoading('Warming up...')
+        model.warmup()
+
+        return model
+
+    def run(self):
+        model = self.loadModel()
+
+        # Imported lazily for the same reason as the model
+        import visualize
 
         self.loadedWeights = True
 